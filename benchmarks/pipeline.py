@@ -0,0 +1,209 @@
+"""
+Time every stage of the depth map pipeline on synthetic terrain.
+
+    python -m benchmarks.pipeline --sizes 500 1000 2000 --cameras 4 --output results.jsonl
+    python -m benchmarks.pipeline --baseline results.jsonl
+
+Each size prints one JSON object, with the fastest and median seconds of every stage over --repeat runs, tagged with
+the git commit. --output appends them to a JSON lines file, and --baseline compares this run against the last
+result of each size in such a file.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+from benchmarks.synthetic import SyntheticDtmType, synthetic_poses
+from depthmap.depthmap import camera_rays, make_camera, write_depthmap
+from depthmap.export import write_point_cloud
+from raytrace.backends import available_backends, get_backend, make_dtm_intersector
+from raytrace.scenecache import SceneRegistry
+
+STAGES = ["raster_load", "vertices", "indices", "mesh_build", "bvh_commit", "ray_generation", "intersection",
+          "output"]
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_once(size: int, options: dict) -> (dict, dict):
+    """
+    Run the pipeline once over a size x size metre DTM at 1 m
+
+    :return: Seconds spent in every stage, and counts of the work done
+    """
+    timings = {s: 0.0 for s in STAGES}
+
+    @contextmanager
+    def stage(name):
+        start = time.perf_counter()
+        yield
+        timings[name] += time.perf_counter() - start
+
+    # A patch of southern England, in EPSG:3857
+    bbox = (-150000.0, 6600000.0, -150000.0 + size, 6600000.0 + size)
+
+    with stage("raster_load"):
+        dtm = SyntheticDtmType(bbox, resolution=(size, size), max_error=options["max_error"], seed=options["seed"])
+        dtm.read_heights()
+
+    if options["max_error"] is None:
+        with stage("vertices"):
+            vertices = dtm.get_vertices()
+        with stage("indices"):
+            faces = dtm.get_indices()
+    else:
+        # The adaptive mesh builds both at once
+        with stage("vertices"):
+            vertices, faces = dtm.get_simplified_mesh(options["max_error"])
+
+    dtm._vertices, dtm._faces = vertices, faces
+
+    with stage("mesh_build"):
+        # Backends that can't build from the float32 arrays (see make_dtm_intersector) trace the trimesh
+        if not hasattr(get_backend(options["backend"]), "from_dtm"):
+            dtm.trimesh
+
+    with stage("bvh_commit"):
+        # A fresh registry, so the scene is always built
+        intersector = make_dtm_intersector(dtm, backend=options["backend"], registry=SceneRegistry(),
+                                           workers=options["threads"])
+        intersector.build_scene()
+
+    rays = 0
+    hits = 0
+    with tempfile.TemporaryDirectory() as out:
+        poses = synthetic_poses(bbox, options["cameras"], seed=options["seed"],
+                                resolution=(options["width"], options["height"]))
+
+        for i, (img, coords) in enumerate(poses):
+            m_cam = make_camera(img, coords, dtm, resolution_scale=1)
+            width, height = (int(v) for v in m_cam.resolution)
+
+            with stage("ray_generation"):
+                vectors = camera_rays(m_cam) @ m_cam.image.rs_matrix()[:3, :3].T
+                origin = np.asarray(m_cam.cam_pt, dtype=np.float64)
+                origins = np.broadcast_to(origin, vectors.shape)
+
+            with stage("intersection"):
+                locs, distances, _ = intersector.intersects_first_location(origins, vectors)
+
+            with stage("output"):
+                hit = np.isfinite(distances)
+                depth = np.where(hit, np.round(distances), 0).astype(np.float32).reshape([height, width])
+                write_depthmap(depth, os.path.join(out, f"{i}.tiff"))
+                write_point_cloud(os.path.join(out, f"{i}.ply"), origin, locs[hit])
+
+            rays += len(vectors)
+            hits += int(hit.sum())
+
+    return timings, {"vertices": len(vertices), "faces": len(faces), "rays": rays, "hits": hits}
+
+
+def benchmark(size: int, options: dict) -> dict:
+    runs = [run_once(size, options) for _ in range(options["repeat"])]
+    counts = runs[-1][1]
+
+    stages = {}
+    for s in STAGES:
+        seconds = [timings[s] for timings, _ in runs]
+        stages[s] = {"min": min(seconds), "median": statistics.median(seconds)}
+
+    intersection = stages["intersection"]["min"]
+
+    return {
+        "benchmark": "pipeline",
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "backend": options["backend"] or available_backends()[0],
+        "threads": options["threads"],
+        "size": size,
+        "max_error": options["max_error"],
+        "cameras": options["cameras"],
+        "resolution": [options["width"], options["height"]],
+        "repeat": options["repeat"],
+        **counts,
+        "rays_per_sec": counts["rays"] / intersection if intersection > 0 else None,
+        "total": sum(v["min"] for v in stages.values()),
+        "stages": stages,
+    }
+
+
+def read_baseline(path: str) -> {int: dict}:
+    """
+    :return: The last result of every DTM size in a JSON lines file
+    """
+    baseline = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                result = json.loads(line)
+                baseline[result["size"]] = result
+
+    return baseline
+
+
+def compare(result: dict, baseline: dict) -> dict:
+    """
+    :return: Speedup of every stage over the baseline, above 1 is faster
+    """
+    speedup = {}
+    for s, v in result["stages"].items():
+        before = baseline["stages"].get(s, {}).get("min")
+        speedup[s] = before / v["min"] if before and v["min"] > 0 else None
+
+    speedup["total"] = baseline["total"] / result["total"] if result["total"] > 0 else None
+    return speedup
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[500, 1000, 2000],
+                        help="Edge lengths of the synthetic DTMs, in pixels at 1 m")
+    parser.add_argument("--cameras", type=int, default=4, help="Cameras rendered per DTM")
+    parser.add_argument("--width", type=int, default=1000, help="Rendered image width in pixels")
+    parser.add_argument("--height", type=int, default=750, help="Rendered image height in pixels")
+    parser.add_argument("--max-error", type=float, default=None, help="Benchmark the adaptive mesh instead")
+    parser.add_argument("--backend", default=None, choices=available_backends(),
+                        help="Ray intersector backend, defaults to the fastest available")
+    parser.add_argument("--threads", type=int, default=1, help="Threads to trace rays on")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per size")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="JSON lines file to append results to")
+    parser.add_argument("--baseline", default=None, help="JSON lines file of earlier results to compare against")
+    args = parser.parse_args(argv)
+
+    options = vars(args)
+    baseline = read_baseline(args.baseline) if args.baseline else {}
+
+    for size in args.sizes:
+        result = benchmark(size, options)
+        if size in baseline:
+            result["baseline_commit"] = baseline[size].get("commit")
+            result["speedup"] = compare(result, baseline[size])
+
+        line = json.dumps(result)
+        print(line)
+
+        if args.output:
+            with open(args.output, "a") as f:
+                f.write(line + "\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""
+Synthetic terrain and camera poses, so the pipeline can be benchmarked without any network access.
+"""
+
+import numpy as np
+import trimesh
+from osgeo import gdal
+
+from dtm import rtin
+from dtm.dtm import DtmType
+from dtm.image import Image
+
+# Radius of the EPSG:3857 sphere
+_earth_radius = 6378137.0
+
+
+def fractal_heights(width: int, height: int, relief: float = 100.0, octaves: int = 6, seed: int = 0) -> np.ndarray:
+    """
+    Rolling terrain, as a sum of randomly oriented sine waves that halve in amplitude as they double in frequency
+
+    :param relief: Rough height difference between the highest and lowest points, in metres
+    :return: (height, width) float32 elevations
+    """
+    rng = np.random.default_rng(seed)
+    yy = np.arange(height, dtype=np.float32)[:, None]
+    xx = np.arange(width, dtype=np.float32)[None, :]
+
+    zz = np.zeros((height, width), dtype=np.float32)
+    wavelength = max(width, height) / 2
+    amplitude = relief / 2
+
+    for _ in range(octaves):
+        for angle, phase in rng.uniform(0, 2 * np.pi, (3, 2)):
+            k = 2 * np.pi / wavelength
+            zz += amplitude / 3 * np.sin(k * (np.cos(angle) * xx + np.sin(angle) * yy) + phase)
+
+        wavelength /= 2
+        amplitude /= 2
+
+    return zz - zz.min()
+
+
+def synthetic_mesh(size: int) -> trimesh.Trimesh:
+    """
+    :return: A size x size grid of rolling terrain with one metre cells, triangulated like DtmType
+    """
+    yy, xx = np.mgrid[0:size, 0:size].astype(np.float32)
+    zz = 20 * np.sin(xx / 50) * np.cos(yy / 70) + 5 * np.sin(xx / 7 + yy / 11)
+
+    vertices = np.column_stack((xx.ravel(), yy.ravel(), zz.ravel()))
+
+    return trimesh.Trimesh(vertices=vertices, faces=rtin.grid_faces(size, size), process=False)
+
+
+class SyntheticDtmType(DtmType):
+    """
+    A DTM of generated terrain, held in a GDAL MEM dataset
+
+    The heights are generated once per size and seed, so timing the raster load only measures GDAL.
+    """
+    srs = "3857"
+
+    _heights = {}
+
+    def __init__(self, bbox: (int, int, int, int), resolution: (int, int) = (2000, 2000), scale: float = 1,
+                 max_error: float = None, relief: float = 100.0, seed: int = 0):
+        self.relief = relief
+        self.seed = seed
+        super().__init__(bbox, resolution, scale, max_error=max_error)
+
+    @classmethod
+    def heights(cls, width: int, height: int, relief: float, seed: int) -> np.ndarray:
+        key = (width, height, relief, seed)
+        if key not in cls._heights:
+            cls._heights[key] = fractal_heights(width, height, relief, seed=seed)
+
+        return cls._heights[key]
+
+    def get_raster(self, bbox: (int, int, int, int)):
+        # bbox fmt: (minx, miny, maxx, maxy)
+        width, height = (int(round(x * self.scale)) for x in self.resolution)
+        minx, miny, maxx, maxy = bbox
+
+        ds: gdal.Dataset = gdal.GetDriverByName("MEM").Create("", width, height, 1, gdal.GDT_Float32)
+        ds.SetGeoTransform((minx, (maxx - minx) / width, 0, maxy, 0, -(maxy - miny) / height))
+        ds.GetRasterBand(1).WriteArray(self.heights(width, height, self.relief, self.seed))
+
+        return ds
+
+
+def synthetic_image(index: int, coords: (float, float), altitude: float = 150.0, pitch: float = -35.0,
+                    yaw: float = 0.0, resolution: (int, int) = (4000, 3000), fov: float = 60.0) -> Image:
+    """
+    An Image posed at a point of the EPSG:3857 plane, as if read from an imageinfo CSV
+
+    :param coords: Camera position, in EPSG:3857
+    :param altitude: Height of the camera above the ground below it, see depthmap.make_camera
+    :param pitch: Degrees below the horizon, -90 looks straight down
+    """
+    lon = np.degrees(coords[0] / _earth_radius)
+    lat = np.degrees(2 * np.arctan(np.exp(coords[1] / _earth_radius)) - np.pi / 2)
+
+    return Image({
+        "file_name": f"synthetic_{index}.jpg",
+        "wkt_geom": f"[{lon} {lat} {altitude}]",
+        "vp_geom": f"[{lon} {lat} 0]",
+        "roll": "0",
+        "pitch": str(pitch),
+        "yaw": str(yaw),
+        "x_pixels": str(resolution[0]),
+        "y_pixels": str(resolution[1]),
+        "fov": str(fov),
+    })
+
+
+def synthetic_poses(bbox: (float, float, float, float), count: int, seed: int = 0,
+                    resolution: (int, int) = (4000, 3000)) -> [(Image, (float, float))]:
+    """
+    Random oblique cameras over the middle of a bbox, looking in every direction
+
+    :return: (image, coords) of every camera
+    """
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = bbox
+    cx, cy = (minx + maxx) / 2, (miny + maxy) / 2
+    rx, ry = (maxx - minx) / 4, (maxy - miny) / 4
+
+    poses = []
+    for i in range(count):
+        coords = (cx + rng.uniform(-rx, rx), cy + rng.uniform(-ry, ry))
+        img = synthetic_image(i, coords, altitude=rng.uniform(50, 300), pitch=rng.uniform(-60, -20),
+                              yaw=rng.uniform(0, 360), resolution=resolution)
+        poses.append((img, coords))
+
+    return poses
@@ -0,0 +1,78 @@
+"""
+Measure how ray tracing throughput scales with the number of threads an intersector backend traces on.
+
+    python -m benchmarks.trace_scaling --size 1000 --rays 1000000 [--backend numpy]
+
+Prints one JSON object per worker count.
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from benchmarks.synthetic import synthetic_mesh
+from raytrace.backends import available_backends, make_intersector
+
+
+def synthetic_rays(size: int, count: int, seed: int = 0) -> (np.ndarray, np.ndarray):
+    """
+    :return: Rays from an oblique camera above the middle of the terrain
+    """
+    rng = np.random.default_rng(seed)
+
+    origins = np.tile([size / 2, size / 2, 200.0], (count, 1))
+    directions = np.column_stack((rng.uniform(-1, 1, count), rng.uniform(-1, 1, count), -rng.uniform(0.2, 1, count)))
+    directions /= np.linalg.norm(directions, axis=1)[:, None]
+
+    return origins, directions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size", type=int, default=1000, help="Terrain grid size in vertices")
+    parser.add_argument("--rays", type=int, default=1_000_000, help="Rays per run")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per worker count, the fastest is reported")
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count())
+    parser.add_argument("--backend", default=None, choices=available_backends(meshes=True),
+                        help="Ray intersector backend, defaults to the fastest available")
+    args = parser.parse_args(argv)
+
+    mesh = synthetic_mesh(args.size)
+    origins, directions = synthetic_rays(args.size, args.rays)
+
+    serial = None
+    workers = 1
+    while workers <= args.max_workers:
+        intersector = make_intersector(mesh, backend=args.backend, workers=workers)
+
+        # Build the scene outside of the timings
+        intersector.intersects_first(origins[:1], directions[:1])
+
+        best = np.inf
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            tri = intersector.intersects_first(origins, directions)
+            best = min(best, time.perf_counter() - start)
+
+        if serial is None:
+            serial = (best, tri)
+
+        print(json.dumps({
+            "backend": type(intersector).__module__,
+            "workers": workers,
+            "rays": args.rays,
+            "faces": len(mesh.faces),
+            "seconds": best,
+            "rays_per_sec": args.rays / best,
+            "speedup": serial[0] / best,
+            "identical": bool(np.array_equal(tri, serial[1])),
+        }))
+
+        workers *= 2
+
+
+if __name__ == '__main__':
+    main()
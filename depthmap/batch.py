@@ -0,0 +1,290 @@
+"""
+Render depth maps for every image in an imageinfo CSV.
+
+Images are clustered on a grid of terrain tiles by their ground footprints (see depthmap.planner), so the DTM and the
+Embree scene are built once per cluster, and the clusters are spread over a process pool:
+
+    python -m depthmap.batch tmp/imageinfo.csv --out out/ --workers 8
+"""
+
+import argparse
+import faulthandler
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from osgeo import gdal
+
+import instrument
+from depthmap.depthmap import read_images, image_coords, make_camera, render_depthmap, write_depthmap
+from depthmap.export import FIELDS, open_point_writer
+from depthmap.incremental import render_frame
+from depthmap.lookup import write_pose
+from depthmap.planner import image_footprint, plan_clusters
+from depthmap.progressive import render_progressive
+from depthmap.tiled import render_tiled
+from dtm.DefraDtmType import DefraDtmType
+from dtm.image import Image
+from raytrace.backends import available_backends, make_dtm_intersector
+from raytrace.shardedintersector import ShardedIntersector
+
+
+def bbox_union(a: (float, float, float, float), b: (float, float, float, float)) -> (float, float, float, float):
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+
+def bbox_grow(bbox: (float, float, float, float), margin: float) -> (float, float, float, float):
+    return bbox[0] - margin, bbox[1] - margin, bbox[2] + margin, bbox[3] + margin
+
+
+def bbox_contains(a: (float, float, float, float), b: (float, float, float, float)) -> bool:
+    return a[0] <= b[0] and a[1] <= b[1] and b[2] <= a[2] and b[3] <= a[3]
+
+
+def setup_group(jobs: [(str, Image, (float, float))], bbox: (float, float, float, float), options: dict,
+                dtm_type=DefraDtmType):
+    """
+    Fetch and mesh the terrain a cluster of images can see
+
+    The cluster is planned with the cameras at their recorded altitude, but make_camera raises them above the ground
+    below them, from where they see further. The fetch is widened until it covers the footprints of the cameras as
+    they are rendered.
+
+    :param bbox: Terrain of the cluster, see depthmap.planner
+    :param dtm_type: DtmType to fetch the terrain with
+    :return: The DTM, a camera for every job, and the intersector over the terrain
+    """
+    margin = options["margin"]
+    bbox = bbox_grow(bbox, margin)
+
+    while True:
+        # Keep the default ground resolution of one pixel per metre, whatever the size of the cluster
+        resolution = (int(round(bbox[2] - bbox[0])), int(round(bbox[3] - bbox[1])))
+        dtm = dtm_type(bbox, resolution=resolution, scale=options["dtm_scale"], max_error=options["max_error"])
+
+        cameras = [make_camera(img, coords, dtm, options["resolution_scale"]) for _, img, coords in jobs]
+
+        # Only mesh the terrain that at least one camera of the cluster can see
+        ground_z = dtm.elevation_range()[0]
+        footprint = None
+        for m_cam in cameras:
+            f = m_cam.ground_footprint(ground_z, max_distance=options["radius"])
+            footprint = f if footprint is None else bbox_union(footprint, f)
+
+        # Footprints are capped at the radius around each camera, so this stops once the fetch reaches it
+        needed = bbox_grow(footprint, margin)
+        if bbox_contains(bbox, needed):
+            break
+
+        dtm.close()
+        bbox = bbox_union(bbox, needed)
+
+    dtm.set_window(footprint, margin=margin)
+
+    if options["shard_size"]:
+        # Only mesh the terrain tiles that rays actually reach
+        intersector = ShardedIntersector.from_dtm(dtm, tile_size=options["shard_size"], backend=options["backend"],
+                                                  workers=options["threads"])
+    else:
+        intersector = make_dtm_intersector(dtm, backend=options["backend"], workers=options["threads"])
+        # Build the scene here, so it is recorded with the cluster's setup rather than its first image
+        intersector.build_scene()
+
+    return dtm, cameras, intersector
+
+
+def process_group(jobs: [(str, Image, (float, float))], bbox: (float, float, float, float), options: dict) -> [dict]:
+    """
+    Render every image of a cluster against one shared DTM and intersector
+
+    :param jobs: (output stem, image, camera coords) of each image, in render order
+    :param bbox: Terrain of the cluster, see depthmap.planner
+    :param options: Parsed command line options, as a dict
+    :return: Timing stats of every image, with its instrument record under "metrics"
+    """
+    gdal.UseExceptions()
+    setup_start = time.perf_counter()
+
+    def recorder(name):
+        return instrument.Recorder(name, profile=options["profile"], trace_memory=options["trace_memory"],
+                                   profile_dir=options["out"])
+
+    # The fetch, mesh and scene builds are shared by the cluster, so they are recorded once for all of its images
+    group = recorder("group")
+    with instrument.recording(group):
+        dtm, cameras, intersector = setup_group(jobs, bbox, options)
+    setup = time.perf_counter() - setup_start
+
+    stats = []
+    previous = None
+    try:
+        for (stem, img, _), m_cam in zip(jobs, cameras):
+            start = time.perf_counter()
+
+            depth_path = os.path.join(options["out"], f"{stem}.tiff")
+            points_path = os.path.join(options["out"], f"{stem}.{options['points']}")
+            fields = options["point_fields"]
+
+            metrics = recorder(stem)
+            with instrument.recording(metrics):
+                points = open_point_writer(points_path, m_cam.cam_pt, fields)
+                try:
+                    if options["tile_size"]:
+                        # Stream every tile to disk, so memory stays flat at any resolution
+                        hits = render_tiled(m_cam, intersector, depth_path, tile_size=options["tile_size"],
+                                            on_tile=lambda w, depth, locs, tri, hit: points.write(locs, hit, w, tri),
+                                            return_triangles=True, return_hits=True)
+                    else:
+                        if options["incremental"]:
+                            # Reuse the cluster's previous frame wherever the camera has barely moved since
+                            previous = render_frame(m_cam, intersector, previous)
+                            depth, locs, hit = previous.depth, previous.hits, previous.hit_mask
+                            triangles = previous.triangles[previous.triangles >= 0]
+                        elif options["progressive"]:
+                            depth, locs, triangles, hit = render_progressive(m_cam, intersector,
+                                                                             block=options["progressive"],
+                                                                             preview=options["preview"],
+                                                                             return_triangles=True, return_hits=True)
+                        else:
+                            depth, locs, triangles, hit = render_depthmap(m_cam, intersector, return_triangles=True,
+                                                                          return_hits=True)
+
+                        write_depthmap(depth, depth_path)
+                        points.write(locs, hit, triangles=triangles)
+                        hits = len(locs)
+                finally:
+                    points.close()
+
+                # So pixels can be looked up in world coordinates later, see depthmap.lookup
+                write_pose(m_cam, depth_path)
+
+            elapsed = time.perf_counter() - start
+            rays = int(np.prod(m_cam.resolution))
+
+            metrics.set(image=img.uri, resolution=[int(v) for v in m_cam.resolution], seconds=elapsed,
+                        group_size=len(jobs), group_setup_seconds=setup, group=group.to_dict())
+            stats.append({"image": img.uri, "stem": stem, "seconds": elapsed, "rays": rays, "hits": hits,
+                          "rays_per_sec": rays / elapsed if elapsed > 0 else float("inf"),
+                          "group_size": len(jobs), "group_setup_seconds": setup, "metrics": metrics.to_dict()})
+    finally:
+        # Free the cluster's raster, workers go on to render other clusters
+        dtm.close()
+
+    return stats
+
+
+def output_stems(images: [Image]) -> [str]:
+    """
+    :return: A unique output file name (without extension) for every image
+    """
+    stems = []
+    seen = set()
+
+    for i, img in enumerate(images):
+        stem = os.path.splitext(os.path.basename(img.uri))[0] if img.uri else f"image_{i}"
+        if stem in seen:
+            stem = f"{stem}_{i}"
+
+        seen.add(stem)
+        stems.append(stem)
+
+    return stems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render depth maps for every image in an imageinfo CSV")
+    parser.add_argument("csv", help="Tab separated imageinfo file, one row per image")
+    parser.add_argument("--out", default="out", help="Directory to write depth maps and point clouds to")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of worker processes")
+    parser.add_argument("--threads", type=int, default=1, help="Threads each worker traces rays on")
+    parser.add_argument("--backend", default=None, choices=available_backends(),
+                        help="Ray intersector backend, defaults to the fastest available that traces meshes")
+    parser.add_argument("--resolution-scale", type=float, default=0.15,
+                        help="Fraction of the image resolution to render at")
+    parser.add_argument("--tile-size", type=int, default=0,
+                        help="Render in screen tiles of this many pixels, streaming them to disk (0 to disable)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Reproject each image's hits into the next one of its cluster, only tracing the pixels "
+                             "that changed, for sequential frames")
+    parser.add_argument("--progressive", type=int, default=0, metavar="BLOCK",
+                        help="Cast a grid of rays this many pixels apart first, and only trace the blocks between "
+                             "them at full rate where the terrain isn't smooth (0 to disable)")
+    parser.add_argument("--preview", action="store_true",
+                        help="With --progressive, only cast the first grid of rays, for quick previews")
+    parser.add_argument("--points", default="ply", choices=["ply", "npy", "xyz"],
+                        help="Point cloud format, binary PLY, a .npy record array or XYZ text")
+    parser.add_argument("--point-fields", nargs="*", default=[], choices=FIELDS, metavar="FIELD",
+                        help=f"Extra per point fields to write to PLY and .npy point clouds, of {', '.join(FIELDS)}")
+    parser.add_argument("--dtm-scale", type=float, default=0.1, help="Scale of the DTM raster to download")
+    parser.add_argument("--max-error", type=float, default=None,
+                        help="Simplify the terrain mesh to this vertical error in metres, instead of 2 triangles a "
+                             "cell")
+    parser.add_argument("--shard-size", type=int, default=0, metavar="CELLS",
+                        help="Split the terrain into tiles of this many DTM cells, each meshed and traced on its own "
+                             "once a ray reaches it (0 for one mesh)")
+    parser.add_argument("--radius", type=float, default=2000,
+                        help="Furthest distance from a camera the terrain is loaded to")
+    parser.add_argument("--ground-z", type=float, default=0,
+                        help="Lowest terrain elevation, camera footprints are planned down to this plane")
+    parser.add_argument("--cluster-size", type=float, default=6000,
+                        help="Images whose footprints centre on the same tile of this size share one terrain build")
+    parser.add_argument("--margin", type=float, default=50, help="Terrain kept around the camera footprints")
+    parser.add_argument("--metrics", default=None,
+                        help="JSON lines file to append the stage timings and counters of every image to")
+    parser.add_argument("--profile", nargs="*", default=[], metavar="STAGE",
+                        help="Stages to run under cProfile, e.g. trace, the stats are written to --out")
+    parser.add_argument("--trace-memory", nargs="*", default=[], metavar="STAGE",
+                        help="Stages to record the peak Python allocations of, with tracemalloc")
+    args = parser.parse_args(argv)
+
+    if args.shard_size and (args.incremental or args.progressive):
+        parser.error("--incremental and --progressive need a single terrain mesh, they can't be used with --shard-size")
+    if args.points == "xyz" and args.point_fields:
+        parser.error("XYZ point clouds only hold x, y and z, use --points ply or npy for --point-fields")
+    if args.backend == "heightfield" and (args.shard_size or args.max_error is not None):
+        parser.error("--backend heightfield traces the full resolution grid as it is, it can't be used with "
+                     "--shard-size or --max-error")
+
+    faulthandler.enable()
+    os.makedirs(args.out, exist_ok=True)
+    options = vars(args)
+
+    images = read_images(args.csv)
+    coords = [image_coords(img) for img in images]
+    stems = output_stems(images)
+
+    footprints = [image_footprint(img, c, args.radius, args.ground_z) for img, c in zip(images, coords)]
+    # Incremental frames reuse the one before, so they follow the capture order of the CSV along each flight line
+    clusters = plan_clusters(footprints, cluster_size=args.cluster_size, capture_order=args.incremental)
+    print(f"Rendering {len(images)} images in {len(clusters)} terrain clusters on {args.workers} workers")
+
+    jobs = [[(stems[i], images[i], coords[i]) for i in cluster.images] for cluster in clusters]
+
+    start = time.perf_counter()
+    total_images = 0
+    total_rays = 0
+
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        # Submitted in curve order, so workers build neighbouring terrain at around the same time
+        futures = [pool.submit(process_group, job, cluster.bbox, options) for job, cluster in zip(jobs, clusters)]
+
+        for future in as_completed(futures):
+            for s in future.result():
+                total_images += 1
+                total_rays += s["rays"]
+                print(f"{s['stem']}: {s['seconds']:.2f}s, {s['rays']} rays, {s['hits']} hits, "
+                      f"{s['rays_per_sec']:.0f} rays/sec")
+
+                if args.metrics:
+                    with open(args.metrics, "a") as f:
+                        f.write(json.dumps(s["metrics"]) + "\n")
+
+    elapsed = time.perf_counter() - start
+    print(f"Rendered {total_images} images in {elapsed:.2f}s: {total_images / elapsed:.2f} images/sec, "
+          f"{total_rays / elapsed:.0f} rays/sec")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,2 +1,164 @@
+import csv
 
+import PIL.Image
+import numpy as np
+from pyproj import Transformer
 
+import instrument
+from depthmap.export import XyzPointWriter
+from depthmap.rays import image_rays, ray_bundle
+from dtm.camera import DTCamera
+from dtm.dtm import DtmType
+from dtm.image import Image
+
+_transformer: Transformer = None
+
+
+def read_images(path: str) -> [Image]:
+    """
+    Read every image from an imageinfo CSV
+
+    :param path: Tab separated file, with a header row followed by one row per image
+    :return: The images, in file order
+    """
+    with open(path, "r") as f:
+        reader = csv.reader(f, delimiter="\t")
+        keys = next(reader)
+
+        return [Image({k: v for k, v in zip(keys, vals)}) for vals in reader if vals]
+
+
+def image_coords(img: Image) -> (float, float):
+    """
+    :return: The camera position of an image, in EPSG:3857
+    """
+    global _transformer
+
+    if _transformer is None:
+        _transformer = Transformer.from_crs("epsg:4326", "epsg:3857")
+
+    return _transformer.transform(*reversed(img.campos[:2]))
+
+
+def make_camera(img: Image, coords: (float, float), dtm: DtmType, resolution_scale: float = 0.15) -> DTCamera:
+    """
+    Create the camera for an image, placed relative to the ground below it
+
+    :param img: Image to render
+    :param coords: Camera position in the DTM SRS, see image_coords
+    :param dtm: Terrain the camera looks at
+    :param resolution_scale: Fraction of the image resolution to render at
+    """
+    m_cam = DTCamera(image=img, coords=coords)
+    m_cam.resolution = [img.width * resolution_scale, img.height * resolution_scale]
+
+    # Sample the ground directly below the camera
+    m_cam.z_offset = dtm.height_at(*coords) * 2
+
+    return m_cam
+
+
+def camera_rays(m_cam: DTCamera, window: (int, int, int, int) = None) -> np.ndarray:
+    """
+    Unit ray directions through the centre of every pixel, in the camera frame (looking down -z)
+
+    These are the same rays as DTCamera.to_rays, but in row major image order with the top row first, so per ray
+    results reshape straight into an image.
+
+    Whole images share one read only bundle of rays per camera model, see depthmap.rays. Windows of a pinhole camera
+    are generated on their own, so tiled renders never hold the rays of a whole image. Undistorting is much dearer
+    than generating, so windows of a distorted lens are cut from the shared bundle instead.
+
+    :param m_cam: Camera to generate rays for
+    :param window: Only generate rays for this part of the image, as (col,row,width,height) in pixels
+    :return: (height * width, 3) float32 array
+    """
+    if window is None:
+        return ray_bundle(m_cam).directions
+
+    width, height = (int(v) for v in m_cam.resolution)
+    if getattr(m_cam, "distortion", None) is not None:
+        col, row, w, h = window
+        rays = ray_bundle(m_cam).directions.reshape([height, width, 3])
+        return rays[row:row + h, col:col + w].reshape([-1, 3])
+
+    return image_rays(width, height, np.broadcast_to(m_cam.fov, 2), window)
+
+
+def trace_window(m_cam: DTCamera, intersector, window: (int, int, int, int) = None,
+                 return_triangles: bool = False, return_hits: bool = False) -> (np.ndarray, np.ndarray):
+    """
+    Ray trace part of a depth map, see render_depthmap
+
+    :param m_cam: Camera to render from
+    :param intersector: Ray intersector for the terrain, e.g. RayMeshIntersector
+    :param window: Part of the image to trace, as (col,row,width,height) in pixels, defaults to the whole image
+    :param return_triangles: Also return the (n,) faces hit
+    :param return_hits: Also return the (height, width) bool mask of the pixels that hit, last. The depth can't
+     stand in for it, as hits closer than half a metre round to 0
+    :return: (height, width) float32 depth of the window, and the (n, 3) hit locations
+    """
+    width, height = (int(v) for v in m_cam.resolution)
+    _, _, w, h = window if window is not None else (0, 0, width, height)
+
+    with instrument.span(instrument.RAY_GENERATION):
+        # Rotate every ray into the world frame with a single matrix product
+        vectors = camera_rays(m_cam, window) @ m_cam.image.rs_matrix()[:3, :3].T
+        origin = np.asarray(m_cam.cam_pt, dtype=np.float64)
+        origins = np.broadcast_to(origin, vectors.shape)
+
+    with instrument.span(instrument.TRACE):
+        # Results stay aligned to the rays, so the depth is a plain reshape
+        locs, distances, triangles = intersector.intersects_first_location(origins, vectors)
+        hit = np.isfinite(distances)
+
+    instrument.count("rays", len(vectors))
+    instrument.count("hits", int(hit.sum()))
+
+    depth = np.where(hit, np.round(distances), 0).astype(np.float32)
+
+    result = (depth.reshape([h, w]), locs[hit])
+    if return_triangles:
+        result += (triangles[hit],)
+    if return_hits:
+        result += (hit.reshape([h, w]),)
+
+    return result
+
+
+def render_depthmap(m_cam: DTCamera, intersector, return_triangles: bool = False,
+                    return_hits: bool = False) -> (np.ndarray, np.ndarray):
+    """
+    Ray trace one depth map
+
+    Depth is the distance along each pixel's ray to the terrain, which for unit rays is also the euclidean distance
+    from the camera. Pixels that miss the terrain are 0.
+
+    The whole image is traced at once, see depthmap.tiled.render_tiled for large resolutions.
+
+    :param m_cam: Camera to render from
+    :param intersector: Ray intersector for the terrain, e.g. RayMeshIntersector
+    :param return_triangles: Also return the (n,) faces hit, e.g. for depthmap.export
+    :param return_hits: Also return the (height, width) bool mask of the pixels that hit, e.g. for depthmap.export
+    :return: (height, width) float32 depth image with the top row first, and the (n, 3) hit locations
+    """
+    return trace_window(m_cam, intersector, return_triangles=return_triangles, return_hits=return_hits)
+
+
+def write_depthmap(depth: np.ndarray, path: str):
+    with instrument.span(instrument.WRITE):
+        img = PIL.Image.fromarray(depth.astype(np.float32), mode="F")
+        img.save(path, "TIFF")
+
+
+def write_points(m_cam: DTCamera, locs: np.ndarray, path: str, append: bool = False):
+    """
+    Write hit locations as XYZ text, the first point is the camera, see depthmap.export for binary point clouds
+
+    :param append: Add the points to an existing file, as written by a previous call, rather than starting a new one
+    """
+    writer = XyzPointWriter(path, m_cam.cam_pt, append=append)
+    try:
+        writer.write(locs)
+    finally:
+        writer.close()
@@ -0,0 +1,276 @@
+"""
+Write hit locations as binary point clouds, for photogrammetry tools to pick up.
+
+Points are written a whole array at a time, as binary little endian PLY or as a structured .npy array, with x, y, z
+(EPSG:3857, float64) and optionally:
+
+- depth: distance from the camera, float32
+- triangle: index of the terrain face hit, int32
+- pixel: col and row of the pixel the ray went through, int32
+
+Both formats keep the point count in a fixed width header field that is filled in on close, so tiled renders can keep
+adding to one file, and reopen it with append=True later.
+"""
+
+import os
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+import instrument
+
+FIELDS = ("depth", "triangle", "pixel")
+
+_ply_types = {"f8": "double", "f4": "float", "i4": "int"}
+
+# Room for the largest point count in fixed width headers
+_count_digits = 15
+
+
+def point_dtype(fields: (str,) = ()) -> np.dtype:
+    """
+    :param fields: Optional fields to add to x, y and z, from FIELDS
+    :return: Packed little endian record type of one point
+    """
+    unknown = set(fields) - set(FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown point fields {sorted(unknown)}, expected some of {FIELDS}")
+
+    dtype = [("x", "<f8"), ("y", "<f8"), ("z", "<f8")]
+    if "depth" in fields:
+        dtype.append(("depth", "<f4"))
+    if "triangle" in fields:
+        dtype.append(("triangle", "<i4"))
+    if "pixel" in fields:
+        dtype += [("col", "<i4"), ("row", "<i4")]
+
+    return np.dtype(dtype)
+
+
+class PointWriter(ABC):
+    """
+    Base of the point cloud writers, turns hits into records
+    """
+
+    def __init__(self, path: str, camera: (float, float, float), fields: (str,) = ()):
+        """
+        :param path: Output file
+        :param camera: Camera position, to measure depths from
+        :param fields: Optional fields to write, from FIELDS
+        """
+        self.path = path
+        self.camera = np.asarray(camera, dtype=np.float64)
+        self.fields = tuple(f for f in FIELDS if f in fields)
+        self.dtype = point_dtype(self.fields)
+        self.count = 0
+
+    def records(self, locs: np.ndarray, hits: np.ndarray = None, window: (int, int, int, int) = None,
+                triangles: np.ndarray = None) -> np.ndarray:
+        """
+        :param locs: (n, 3) hit locations, in image order as trace_window returns them
+        :param hits: (h, w) bool mask of the pixels whose ray hit, as trace_window returns it with return_hits, needed
+         for the pixel field
+        :param window: Part of the image the mask covers, as (col,row,width,height), for tiled renders
+        :param triangles: (n,) face hit by every point, needed for the triangle field
+        :return: (n,) records
+        """
+        locs = np.asarray(locs, dtype=np.float64).reshape([-1, 3])
+        records = np.empty(len(locs), dtype=self.dtype)
+        records["x"], records["y"], records["z"] = locs.T
+
+        if "depth" in self.fields:
+            records["depth"] = np.linalg.norm(locs - self.camera, axis=1)
+
+        if "triangle" in self.fields:
+            if triangles is None or len(triangles) != len(locs):
+                raise ValueError("The triangle field needs the face of every hit")
+            records["triangle"] = triangles
+
+        if "pixel" in self.fields:
+            if hits is None:
+                raise ValueError("The pixel field needs the mask of the pixels that hit")
+
+            rows, cols = np.nonzero(hits)
+            if len(rows) != len(locs):
+                raise ValueError(f"{len(locs)} hits, but {len(rows)} pixels in the hit mask")
+
+            col, row = window[:2] if window is not None else (0, 0)
+            records["col"] = cols + col
+            records["row"] = rows + row
+
+        return records
+
+    def write(self, locs: np.ndarray, hits: np.ndarray = None, window: (int, int, int, int) = None,
+              triangles: np.ndarray = None):
+        """
+        Add hits to the file, see records
+        """
+        records = self.records(locs, hits, window, triangles)
+        with instrument.span(instrument.WRITE):
+            self.f.write(records.tobytes())
+        self.count += len(records)
+
+    def close(self):
+        if self.f is not None:
+            with instrument.span(instrument.WRITE):
+                self.write_header()
+                self.f.close()
+            self.f = None
+
+    @abstractmethod
+    def header(self) -> bytes:
+        """
+        :return: The file header, which is the same size whatever the point count
+        """
+
+    def write_header(self):
+        self.f.seek(0)
+        self.f.write(self.header())
+        self.f.seek(0, os.SEEK_END)
+
+
+class PlyPointWriter(PointWriter):
+    """
+    Writes points as a binary little endian PLY
+    """
+
+    def __init__(self, path: str, camera: (float, float, float), fields: (str,) = (), append: bool = False):
+        super().__init__(path, camera, fields)
+
+        if append and os.path.exists(path):
+            self.f = open(path, "r+b")
+            header = self.read_header()
+            if header["properties"] != list(self.dtype.names):
+                raise ValueError(f"Can't append {list(self.dtype.names)} to {path} of {header['properties']}")
+
+            self.count = header["count"]
+            self.f.seek(0, os.SEEK_END)
+        else:
+            self.f = open(path, "wb")
+            self.write_header()
+
+    def header(self) -> bytes:
+        lines = ["ply", "format binary_little_endian 1.0",
+                 "comment camera " + " ".join(repr(float(v)) for v in self.camera),
+                 f"element vertex {self.count:0{_count_digits}d}"]
+        lines += [f"property {_ply_types[self.dtype[name].str[1:]]} {name}" for name in self.dtype.names]
+        lines.append("end_header")
+
+        return ("\n".join(lines) + "\n").encode("ascii")
+
+    def read_header(self) -> dict:
+        """
+        :return: Point count and property names of the file, which has to have been written by a PlyPointWriter
+        """
+        count, properties = None, []
+        for line in iter(self.f.readline, b""):
+            words = line.decode("ascii").split()
+            if words[:2] == ["element", "vertex"]:
+                if len(words[2]) != _count_digits:
+                    raise ValueError(f"{self.path} wasn't written by a PlyPointWriter, its point count can't grow")
+                count = int(words[2])
+            elif words[:1] == ["property"]:
+                properties.append(words[2])
+            elif words == ["end_header"]:
+                break
+
+        return {"count": count, "properties": properties}
+
+
+class NpyPointWriter(PointWriter):
+    """
+    Writes points as a .npy array of records, see point_dtype
+    """
+
+    def __init__(self, path: str, camera: (float, float, float), fields: (str,) = (), append: bool = False):
+        super().__init__(path, camera, fields)
+
+        if append and os.path.exists(path):
+            self.f = open(path, "r+b")
+            np.lib.format.read_magic(self.f)
+            shape, _, dtype = np.lib.format.read_array_header_1_0(self.f)
+            if dtype != self.dtype:
+                raise ValueError(f"Can't append {self.dtype} to {path} of {dtype}")
+            if self.f.tell() != len(self.header()):
+                raise ValueError(f"{path} wasn't written by a NpyPointWriter, its point count can't grow")
+
+            self.count = shape[0]
+            self.f.seek(0, os.SEEK_END)
+        else:
+            self.f = open(path, "wb")
+            self.write_header()
+
+    def header(self) -> bytes:
+        header = repr({"descr": np.lib.format.dtype_to_descr(self.dtype), "fortran_order": False,
+                       "shape": (self.count,)})
+
+        # Pad to the size of the largest count, so the header never moves, aligned as the .npy format asks
+        longest = len(header) - len(str(self.count)) + _count_digits
+        size = -(-(10 + longest + 1) // 64) * 64
+        header = header.ljust(size - 10 - 1) + "\n"
+
+        return b"\x93NUMPY\x01\x00" + np.uint16(len(header)).astype("<u2").tobytes() + header.encode("latin1")
+
+
+class XyzPointWriter(PointWriter):
+    """
+    Writes points as comma separated text, the first line is the camera
+    """
+
+    def __init__(self, path: str, camera: (float, float, float), fields: (str,) = (), append: bool = False):
+        super().__init__(path, camera, ())
+        if fields:
+            raise ValueError("XYZ files only hold x, y and z")
+
+        if append and os.path.exists(path):
+            self.f = open(path, "a")
+        else:
+            self.f = open(path, "w")
+            self.f.write(self.header().decode("ascii"))
+
+    def write(self, locs: np.ndarray, hits: np.ndarray = None, window: (int, int, int, int) = None,
+              triangles: np.ndarray = None):
+        locs = np.asarray(locs, dtype=np.float64).reshape([-1, 3])
+        with instrument.span(instrument.WRITE):
+            # Same text as dtm.helpers.coord_string, in one write
+            self.f.write("".join("{},{},{}\n".format(*l) for l in locs.tolist()))
+        self.count += len(locs)
+
+    def header(self) -> bytes:
+        """
+        :return: The camera line, which holds no point count
+        """
+        return "{},{},{}\n".format(*self.camera.tolist()).encode("ascii")
+
+    def write_header(self):
+        # The camera line was written on open and never changes
+        pass
+
+
+def open_point_writer(path: str, camera: (float, float, float), fields: (str,) = (), append: bool = False):
+    """
+    :param path: Output file, .npy files are written as a record array, .xyz files as text, everything else as
+     binary PLY
+    :param camera: Camera position, to measure depths from
+    :param fields: Optional fields to write, from FIELDS
+    :param append: Add to the points of an existing file written by a point writer, with the same fields
+    :return: A PlyPointWriter, NpyPointWriter or XyzPointWriter
+    """
+    if path.lower().endswith(".npy"):
+        return NpyPointWriter(path, camera, fields, append)
+    if path.lower().endswith(".xyz"):
+        return XyzPointWriter(path, camera, fields, append)
+
+    return PlyPointWriter(path, camera, fields, append)
+
+
+def write_point_cloud(path: str, camera: (float, float, float), locs: np.ndarray, hits: np.ndarray = None,
+                      triangles: np.ndarray = None, fields: (str,) = ()):
+    """
+    Write the hits of a whole depth map in one go, see PointWriter.records
+    """
+    writer = open_point_writer(path, camera, fields)
+    try:
+        writer.write(locs, hits, triangles=triangles)
+    finally:
+        writer.close()
@@ -0,0 +1,232 @@
+"""
+Render sequences of depth maps incrementally, reusing the previous frame where the camera has barely moved.
+
+The previous frame's hit points are reprojected into the new camera, keeping the nearest one landing on each pixel.
+Every new pixel's ray is then tested against just the triangles reprojected around it, and where it hits one at about
+the reprojected distance, that hit is kept without tracing. Pixels nothing lands near (disocclusions and the image
+edges), pixels on depth edges, and pixels whose ray misses the triangles around it are traced as usual.
+
+Reused hits are exact hits on the mesh, but not necessarily the first: terrain that comes in front of them, and that
+wasn't visible in the previous frame, is never tested. Moving smoothly over a height field, that mostly happens at
+depth edges, which are traced, so frames are close to a full render rather than identical to it.
+"""
+
+import warnings
+
+import numpy as np
+
+import instrument
+from depthmap.depthmap import camera_rays
+from dtm.camera import DTCamera
+from dtm.distortion import distort
+from raytrace.triangles import ray_triangle
+
+
+class Frame:
+    """
+    A rendered depth map, with the per pixel hits needed to reproject it into the next camera
+    """
+
+    def __init__(self, m_cam: DTCamera, depth: np.ndarray, locations: np.ndarray, triangles: np.ndarray):
+        """
+        :param m_cam: Camera the frame is rendered from
+        :param depth: (height, width) float32 depth, 0 where rays missed
+        :param locations: (height * width, 3) hit of every pixel, NaN where rays missed
+        :param triangles: (height * width,) face hit by every pixel, -1 where rays missed
+        """
+        self.m_cam = m_cam
+        self.depth = depth
+        self.locations = locations
+        self.triangles = triangles
+
+        self.traced = len(triangles)
+
+    @property
+    def hits(self) -> np.ndarray:
+        """
+        :return: (n, 3) hit locations, like render_depthmap returns
+        """
+        return self.locations[self.triangles >= 0]
+
+    @property
+    def hit_mask(self) -> np.ndarray:
+        """
+        :return: (height, width) bool mask of the pixels that hit, like render_depthmap returns with return_hits
+        """
+        return (self.triangles >= 0).reshape(self.depth.shape)
+
+
+def project(m_cam: DTCamera, points: np.ndarray) -> (np.ndarray, np.ndarray, np.ndarray):
+    """
+    Project world points into a camera's image, the inverse of camera_rays
+
+    :return: Fractional (cols, rows) of every point, and its distance from the camera, NaN behind the camera
+    """
+    width, height = (int(v) for v in m_cam.resolution)
+    right, top = np.tan(np.radians(m_cam.fov) / 2.0) * (1 - 1.0 / np.asarray(m_cam.resolution))
+
+    offsets = points - np.asarray(m_cam.cam_pt, dtype=np.float64)
+    local = offsets @ m_cam.image.rs_matrix()[:3, :3]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        forward = -local[:, 2]
+        forward[forward <= 0] = np.nan
+
+        x = local[:, 0] / forward
+        y = local[:, 1] / forward
+
+        distortion = getattr(m_cam, "distortion", None)
+        if distortion is not None:
+            # dtm.distortion has y down
+            x, y = distort(x, -y, distortion)
+            y = -y
+
+        cols = (x + right) * (width - 1) / (2 * right)
+        rows = (top - y) * (height - 1) / (2 * top)
+
+    return cols, rows, np.linalg.norm(offsets, axis=1)
+
+
+def reproject(previous: Frame, m_cam: DTCamera) -> (np.ndarray, np.ndarray):
+    """
+    Splat the previous frame's hits into a new camera, keeping the nearest hit landing on each pixel
+
+    :return: (height * width,) triangle and distance of the hit landing on every pixel, -1 and inf where none does
+    """
+    width, height = (int(v) for v in m_cam.resolution)
+
+    hit = np.nonzero(previous.triangles >= 0)[0]
+    cols, rows, distance = project(m_cam, previous.locations[hit])
+
+    with np.errstate(invalid="ignore"):
+        col = np.round(cols)
+        row = np.round(rows)
+        inside = (col >= 0) & (col < width) & (row >= 0) & (row < height)
+
+    pixel = (row[inside] * width + col[inside]).astype(np.int64)
+    distance = distance[inside]
+    source = hit[inside]
+
+    # Z-buffer, the nearest point of every pixel comes first
+    order = np.lexsort((distance, pixel))
+    pixel = pixel[order]
+    first = np.r_[True, pixel[1:] != pixel[:-1]]
+
+    triangles = np.full(width * height, -1, dtype=np.int64)
+    distances = np.full(width * height, np.inf)
+    triangles[pixel[first]] = previous.triangles[source[order][first]]
+    distances[pixel[first]] = distance[order][first]
+
+    return triangles, distances
+
+
+def neighbourhoods(triangles: np.ndarray, distances: np.ndarray, width: int, height: int) -> \
+        (np.ndarray, np.ndarray, np.ndarray):
+    """
+    Gather the reprojected hits of every pixel's 3x3 neighbourhood
+
+    :param triangles: (height * width,) reprojected triangle of every pixel, -1 where none landed
+    :param distances: (height * width,) reprojected distance of every pixel, inf where none landed
+    :return: (9, height * width) candidate triangles, and the nearest and furthest distance in every neighbourhood,
+     NaN where no hit landed in it
+    """
+    tri = np.pad(triangles.reshape([height, width]), 1, mode="constant", constant_values=-1)
+    dist = np.pad(distances.reshape([height, width]), 1, mode="constant", constant_values=np.nan)
+    dist[np.isinf(dist)] = np.nan
+
+    candidates = np.stack([tri[r:r + height, c:c + width].ravel() for r in range(3) for c in range(3)])
+    neighbours = np.stack([dist[r:r + height, c:c + width].ravel() for r in range(3) for c in range(3)])
+
+    with np.errstate(invalid="ignore"), warnings.catch_warnings():
+        # All NaN neighbourhoods are expected, where nothing was reprojected
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return candidates, np.nanmin(neighbours, axis=0), np.nanmax(neighbours, axis=0)
+
+
+def render_frame(m_cam: DTCamera, intersector, previous: Frame = None, tolerance: float = 0.02,
+                 edge_ratio: float = 0.05) -> Frame:
+    """
+    Ray trace a depth map, reusing the hits of a previous frame where they are still valid
+
+    A pixel is reused when its neighbourhood of reprojected hits is smooth, and its ray hits one of their triangles
+    at a distance within that neighbourhood. Reused pixels are hits on the mesh, but a closer occluder that wasn't
+    visible in the previous frame is missed.
+
+    :param m_cam: Camera to render from
+    :param intersector: Ray intersector for the terrain, e.g. RayMeshIntersector, the previous frame must have been
+     rendered with the same mesh
+    :param previous: Frame to reuse, None to trace every pixel
+    :param tolerance: Relative slack on the reprojected distances a reused hit must lie between
+    :param edge_ratio: Pixels whose neighbourhood spans more than this fraction of its depth are always traced
+    :return: The frame, traced pixels match render_depthmap exactly
+    """
+    width, height = (int(v) for v in m_cam.resolution)
+
+    with instrument.span(instrument.RAY_GENERATION):
+        vectors = camera_rays(m_cam) @ m_cam.image.rs_matrix()[:3, :3].T
+        origin = np.asarray(m_cam.cam_pt, dtype=np.float64)
+
+    locations = np.full((len(vectors), 3), np.nan)
+    distances = np.full(len(vectors), np.inf, dtype=np.float32)
+    triangles = np.full(len(vectors), -1, dtype=np.int64)
+    trace = np.ones(len(vectors), dtype=bool)
+
+    if previous is not None:
+        with instrument.span("reproject"):
+            candidates, near, far = neighbourhoods(*reproject(previous, m_cam), width, height)
+
+            with np.errstate(invalid="ignore"):
+                test = np.nonzero(far - near <= edge_ratio * near)[0]
+
+            # Test each ray against the triangles around it, relative to the camera for precision
+            best_t = np.full(len(test), np.inf)
+            best_tri = np.full(len(test), -1, dtype=np.int64)
+            for tri in candidates[:, test]:
+                has = np.nonzero(tri >= 0)[0]
+                corners = intersector.mesh.triangles[tri[has]] - origin
+                t = ray_triangle(np.zeros((len(has), 3)), vectors[test[has]],
+                                  corners[:, 0], corners[:, 1], corners[:, 2])
+
+                with np.errstate(invalid="ignore"):
+                    nearer = t < best_t[has]
+                best_t[has[nearer]] = t[nearer]
+                best_tri[has[nearer]] = tri[has[nearer]]
+
+            valid = (best_t >= near[test] * (1 - tolerance)) & (best_t <= far[test] * (1 + tolerance))
+            reuse = test[valid]
+
+            locations[reuse] = origin + vectors[reuse] * best_t[valid, None]
+            distances[reuse] = best_t[valid]
+            triangles[reuse] = best_tri[valid]
+            trace[reuse] = False
+
+        instrument.count("reused_pixels", len(reuse))
+
+    traced = np.nonzero(trace)[0]
+    with instrument.span(instrument.TRACE):
+        locs, dist, tri = intersector.intersects_first_location(np.broadcast_to(origin, (len(traced), 3)),
+                                                                vectors[traced])
+    locations[traced] = locs
+    distances[traced] = dist
+    triangles[traced] = tri
+
+    instrument.count("rays", len(traced))
+    instrument.count("hits", int((tri >= 0).sum()))
+
+    depth = np.where(triangles >= 0, np.round(distances), 0).astype(np.float32).reshape([height, width])
+
+    frame = Frame(m_cam, depth, locations, triangles)
+    frame.traced = len(traced)
+    return frame
+
+
+def render_sequence(cameras: [DTCamera], intersector, **kwargs):
+    """
+    Render consecutive frames, each reusing the one before it, see render_frame
+
+    :return: Generator of Frames
+    """
+    previous = None
+    for m_cam in cameras:
+        previous = render_frame(m_cam, intersector, previous, **kwargs)
+        yield previous
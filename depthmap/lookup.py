@@ -0,0 +1,204 @@
+"""
+Turn pixels of a rendered depth map back into world coordinates, in batches.
+
+Every depth map can be written with a pose sidecar (see write_pose), holding the camera position, rotation, field of
+view and lens distortion it was rendered with. A DepthMapLookup memory maps the depth map once, and then answers any
+number of (u, v) -> (x, y, z) queries with a few array operations, without ray tracing or reopening the image:
+
+    lookup = DepthMapLookup.open("out/IMG_0001.tiff")
+    xyz = lookup.uv_to_world(u, v, srs="EPSG:4326")
+"""
+
+import json
+import os
+
+import PIL.Image
+import numpy as np
+from pyproj import Transformer
+
+from dtm.distortion import undistort
+
+_transformers = {}
+
+
+def pose_path(depth_path: str) -> str:
+    """
+    :return: Path of the pose sidecar of a depth map
+    """
+    return os.path.splitext(depth_path)[0] + ".pose.json"
+
+
+def camera_pose(m_cam) -> dict:
+    """
+    :param m_cam: DTCamera the depth map is rendered from
+    :return: Everything needed to turn its pixels back into rays
+    """
+    width, height = (int(v) for v in m_cam.resolution)
+    distortion = getattr(m_cam, "distortion", None)
+
+    return {
+        "width": width,
+        "height": height,
+        "fov": [float(v) for v in m_cam.fov],
+        "position": [float(v) for v in m_cam.cam_pt],
+        "rotation": np.asarray(m_cam.image.rs_matrix())[:3, :3].tolist(),
+        "distortion": list(distortion) if distortion is not None else None,
+        "srs": "EPSG:3857",
+        "image": m_cam.image.uri,
+    }
+
+
+def write_pose(m_cam, depth_path: str):
+    """
+    Write the pose sidecar of a depth map, see pose_path
+    """
+    with open(pose_path(depth_path), "w") as f:
+        json.dump(camera_pose(m_cam), f, indent=2)
+
+
+def map_depth(path: str) -> np.ndarray:
+    """
+    Open a depth map as a read only memory map where the file allows it
+
+    .npy files, and uncompressed TIFFs such as depthmap.write_depthmap writes, are mapped in place. Anything else,
+    like a compressed tiled GeoTIFF, is read into memory once.
+
+    :return: (height, width) float32 depths
+    """
+    if path.lower().endswith(".npy"):
+        return np.load(path, mmap_mode="r")
+
+    with PIL.Image.open(path) as im:
+        width, height = im.size
+        tiles = im.tile
+
+        # Uncompressed strips stored back to back are one contiguous array
+        if im.mode == "F" and tiles and all(t[0] == "raw" for t in tiles):
+            offsets = [t[2] for t in tiles]
+            rows = [t[1][3] - t[1][1] for t in tiles]
+            raw_mode = tiles[0][3][0] if isinstance(tiles[0][3], tuple) else tiles[0][3]
+            contiguous = all(b - a == r * width * 4 for a, b, r in zip(offsets, offsets[1:], rows))
+
+            if contiguous and raw_mode in ("F;32F", "F;32BF"):
+                dtype = np.dtype("<f4") if raw_mode == "F;32F" else np.dtype(">f4")
+                return np.memmap(path, dtype=dtype, mode="r", offset=offsets[0], shape=(height, width))
+
+        return np.asarray(im, dtype=np.float32)
+
+
+def _transformer(srs: str) -> Transformer:
+    if srs not in _transformers:
+        _transformers[srs] = Transformer.from_crs("EPSG:3857", srs, always_xy=True)
+
+    return _transformers[srs]
+
+
+class DepthMapLookup:
+    """
+    Batched pixel to world queries over one depth map
+    """
+
+    def __init__(self, depth: np.ndarray, pose: dict):
+        """
+        :param depth: (height, width) distance along each pixel's ray, 0 where the ray missed
+        :param pose: Camera pose, see camera_pose
+        """
+        self.depth = depth
+        self.pose = pose
+
+        self.width = pose["width"]
+        self.height = pose["height"]
+        self.position = np.asarray(pose["position"], dtype=np.float64)
+        self.rotation = np.asarray(pose["rotation"], dtype=np.float64)
+        self.distortion = pose.get("distortion")
+
+        if depth.shape != (self.height, self.width):
+            raise ValueError(f"Depth map is {depth.shape[1]}x{depth.shape[0]}, but the pose is for "
+                             f"{self.width}x{self.height}")
+
+        # Image plane extent of the outermost pixel centres, as in depthmap.camera_rays
+        self.right, self.top = np.tan(np.radians(pose["fov"]) / 2.0) * (1 - 1.0 / np.array([self.width,
+                                                                                          self.height]))
+
+    @classmethod
+    def open(cls, depth_path: str, pose_file: str = None):
+        """
+        :param depth_path: Depth map, as a TIFF or .npy
+        :param pose_file: Pose sidecar, defaults to the one next to the depth map
+        """
+        with open(pose_file or pose_path(depth_path)) as f:
+            pose = json.load(f)
+
+        return cls(map_depth(depth_path), pose)
+
+    def pixels_to_rays(self, cols: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        """
+        :param cols: Pixel columns, fractional coordinates are allowed, 0 is the centre of the leftmost pixel
+        :param rows: Pixel rows, 0 is the centre of the top row
+        :return: (n, 3) unit ray directions in the world frame
+        """
+        cols = np.asarray(cols, dtype=np.float64)
+        rows = np.asarray(rows, dtype=np.float64)
+
+        rays = np.empty((cols.size, 3))
+        rays[:, 0] = -self.right + cols.ravel() * (2 * self.right / max(self.width - 1, 1))
+        rays[:, 1] = self.top - rows.ravel() * (2 * self.top / max(self.height - 1, 1))
+        rays[:, 2] = -1
+
+        if self.distortion is not None:
+            # As in depthmap.rays.image_rays
+            x, y = undistort(rays[:, 0], -rays[:, 1], self.distortion)
+            rays[:, 0] = x
+            rays[:, 1] = -y
+
+        rays /= np.linalg.norm(rays, axis=1)[:, None]
+
+        return rays @ self.rotation.T
+
+    def pixels_to_world(self, cols: np.ndarray, rows: np.ndarray, srs: str = "EPSG:3857") -> np.ndarray:
+        """
+        Find the terrain point seen at every pixel
+
+        Depths are read from the nearest pixel, so points near depth edges don't blend the foreground and background.
+
+        :param cols: Pixel columns, see pixels_to_rays
+        :param rows: Pixel rows
+        :param srs: Output SRS, EPSG:3857 (x, y, z) or e.g. EPSG:4326 (lon, lat, z)
+        :return: (n, 3) points, NaN where the pixel is outside the image or its ray missed the terrain
+        """
+        cols = np.asarray(cols, dtype=np.float64).ravel()
+        rows = np.asarray(rows, dtype=np.float64).ravel()
+
+        col_idx = np.round(cols).astype(np.int64)
+        row_idx = np.round(rows).astype(np.int64)
+        inside = (col_idx >= 0) & (col_idx < self.width) & (row_idx >= 0) & (row_idx < self.height)
+
+        depth = np.full(len(cols), np.nan)
+        depth[inside] = self.depth[row_idx[inside], col_idx[inside]]
+        depth[depth <= 0] = np.nan
+
+        points = self.position + self.pixels_to_rays(cols, rows) * depth[:, None]
+
+        if srs.upper() != "EPSG:3857":
+            x, y = _transformer(srs.upper()).transform(points[:, 0], points[:, 1])
+            points[:, 0] = x
+            points[:, 1] = y
+
+        return points
+
+    def uv_to_pixels(self, u: np.ndarray, v: np.ndarray) -> (np.ndarray, np.ndarray):
+        """
+        :param u: Horizontal image coordinate, -1 is the left edge of the image and 1 the right edge
+        :param v: Vertical image coordinate, -1 is the top edge and 1 the bottom edge
+        :return: Fractional (cols, rows)
+        """
+        cols = (np.asarray(u, dtype=np.float64) + 1) / 2 * self.width - 0.5
+        rows = (np.asarray(v, dtype=np.float64) + 1) / 2 * self.height - 0.5
+
+        return cols, rows
+
+    def uv_to_world(self, u: np.ndarray, v: np.ndarray, srs: str = "EPSG:3857") -> np.ndarray:
+        """
+        Find the terrain point seen at every (u, v), see uv_to_pixels and pixels_to_world
+        """
+        return self.pixels_to_world(*self.uv_to_pixels(u, v), srs=srs)
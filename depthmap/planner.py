@@ -0,0 +1,116 @@
+"""
+Plan which images share a terrain build, and the order to render them in.
+
+Every image's ground footprint is found from its camera frustum, and the footprints are indexed on a grid of terrain
+tiles. The images whose footprints centre on the same tile form a cluster: the DTM and BVH are built once for the
+union of their footprints, and every image of the cluster is rendered against it. Clusters are ordered along a Hilbert
+curve over the tiles, and images within a cluster along a Hilbert curve over their positions, so consecutive jobs see
+neighbouring terrain. Incremental rendering keeps the images of a cluster in capture order instead, see plan_clusters.
+"""
+
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from dtm.camera import DTCamera
+from dtm.image import Image
+
+
+@dataclass
+class Cluster:
+    """
+    Images rendered against one terrain build
+    """
+    tile: (int, int)
+    bbox: (float, float, float, float)
+    images: [int] = field(default_factory=list)
+
+
+def hilbert_index(x: np.ndarray, y: np.ndarray, order: int = 16) -> np.ndarray:
+    """
+    Position of grid cells along a Hilbert curve, nearby cells get nearby indexes
+
+    :param x: Integer column of every cell, in [0, 2 ** order)
+    :param y: Integer row of every cell
+    :param order: Number of bits of the coordinates
+    :return: Index of every cell along the curve
+    """
+    x = np.array(x, dtype=np.int64)
+    y = np.array(y, dtype=np.int64)
+    d = np.zeros_like(x)
+
+    s = 1 << (order - 1)
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+
+        # Rotate the quadrant, so the curve stays continuous
+        flip = ~ry & rx
+        x = np.where(flip, s - 1 - x, x)
+        y = np.where(flip, s - 1 - y, y)
+        swap = ~ry
+        x, y = np.where(swap, y, x), np.where(swap, x, y)
+
+        s >>= 1
+
+    return d
+
+
+def image_footprint(img: Image, coords: (float, float), radius: float, ground_z: float = 0) -> \
+        (float, float, float, float):
+    """
+    Find the terrain an image can see, before any terrain is loaded
+
+    :param img: Image to render
+    :param coords: Camera position in EPSG:3857, see depthmap.image_coords
+    :param radius: Furthest distance a ray is followed, the footprint never leaves the square of this radius around the
+     camera that generate_bbox gives
+    :param ground_z: Lowest elevation of the terrain, rays are followed down to this plane
+    :return: BBOX of the footprint in the format: (minx,miny,maxx,maxy)
+    """
+    return DTCamera(image=img, coords=coords).ground_footprint(ground_z, max_distance=radius)
+
+
+def plan_clusters(footprints: [(float, float, float, float)], cluster_size: float = 6000,
+                  capture_order: bool = False) -> [Cluster]:
+    """
+    Cluster images on a grid of terrain tiles, see the module docstring
+
+    :param footprints: Footprint of every image, see image_footprint
+    :param cluster_size: Width and height of the terrain tiles, in metres
+    :param capture_order: Keep the images of each cluster in the order they are given, e.g. the capture order of the
+     CSV, rather than sweeping them along a curve. Consecutive images of a flight line then stay consecutive, which
+     depthmap.incremental needs to reuse the previous frame
+    :return: The clusters in render order, each with its images in render order
+    """
+    footprints = np.asarray(footprints, dtype=np.float64).reshape([-1, 4])
+    if not len(footprints):
+        return []
+
+    centres = (footprints[:, :2] + footprints[:, 2:]) / 2
+    tiles = np.floor(centres / cluster_size).astype(np.int64)
+
+    # Grid index of the footprints
+    members = {}
+    for i, tile in enumerate(map(tuple, tiles)):
+        members.setdefault(tile, []).append(i)
+
+    clusters = []
+    for tile, images in members.items():
+        images = np.array(images)
+        bbox = (*footprints[images, :2].min(axis=0), *footprints[images, 2:].max(axis=0))
+
+        if capture_order:
+            order = np.arange(len(images))
+        else:
+            # Sweep the cluster along a curve, so consecutive images look at neighbouring terrain
+            cells = np.clip((centres[images] - bbox[:2]) / cluster_size * 2 ** 16, 0, 2 ** 16 - 1).astype(np.int64)
+            order = np.argsort(hilbert_index(cells[:, 0], cells[:, 1]), kind="stable")
+
+        clusters.append(Cluster(tile, tuple(float(v) for v in bbox), images[order].tolist()))
+
+    corner = tiles.min(axis=0)
+    keys = hilbert_index([c.tile[0] - corner[0] for c in clusters], [c.tile[1] - corner[1] for c in clusters])
+
+    return [clusters[i] for i in np.argsort(keys, kind="stable")]
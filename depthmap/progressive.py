@@ -0,0 +1,170 @@
+"""
+Render depth maps coarse to fine, only casting rays where the terrain isn't smooth.
+
+A sparse grid of rays is cast first, one every `block` pixels. Where the four corners of a block hit faces whose
+normals agree, and the hits lie on one plane, the pixels inside are filled by intersecting their rays with that plane.
+Blocks that straddle a depth edge, a crease or a miss are split into four, and their new corners traced, down to
+single pixels, so edges and silhouettes are always traced at full rate.
+
+Interpolated pixels are approximate: terrain detail smaller than a block that leaves its corners on one plane is lost.
+"""
+
+import numpy as np
+
+import instrument
+from depthmap.depthmap import camera_rays
+from dtm.camera import DTCamera
+
+
+def block_corners(rows: np.ndarray, cols: np.ndarray, step: int, width: int, height: int) -> np.ndarray:
+    """
+    :param rows: Top row of every block
+    :param cols: Left column of every block
+    :return: (n, 4) pixel index of the top left, top right, bottom left and bottom right corner of every block,
+     blocks at the image edges are cut short
+    """
+    bottom = np.minimum(rows + step, height - 1)
+    right = np.minimum(cols + step, width - 1)
+
+    return np.column_stack((rows * width + cols, rows * width + right, bottom * width + cols, bottom * width + right))
+
+
+def block_pixels(rows: np.ndarray, cols: np.ndarray, step: int, width: int, height: int) -> (np.ndarray, np.ndarray):
+    """
+    :return: Pixel index of every pixel inside or on the edge of the blocks, and the block it belongs to
+    """
+    dr, dc = (v.ravel() for v in np.mgrid[0:step + 1, 0:step + 1])
+
+    r = rows[:, None] + dr
+    c = cols[:, None] + dc
+    inside = (r <= np.minimum(rows + step, height - 1)[:, None]) & (c <= np.minimum(cols + step, width - 1)[:, None])
+
+    block = np.broadcast_to(np.arange(len(rows))[:, None], r.shape)
+    return (r * width + c)[inside], block[inside]
+
+
+def render_progressive(m_cam: DTCamera, intersector, block: int = 16, max_angle: float = 5.0,
+                       tolerance: float = 0.002, preview: bool = False, return_triangles: bool = False,
+                       return_hits: bool = False) -> (np.ndarray, np.ndarray):
+    """
+    Ray trace a depth map coarse to fine, see the module docstring
+
+    :param m_cam: Camera to render from
+    :param intersector: Ray intersector for the terrain with a `mesh`, e.g. RayMeshIntersector
+    :param block: Spacing of the first grid of rays in pixels, a power of 2
+    :param max_angle: Largest angle in degrees between the face normals of a block's corners for it to be filled
+    :param tolerance: Largest distance of a block's corner hits from their common plane for it to be filled, as a
+     fraction of their depth
+    :param preview: Stop after the first grid, filling every pixel from its nearest grid ray
+    :param return_triangles: Also return the (n,) faces hit, interpolated pixels get a face of their block's corners
+    :param return_hits: Also return the (height, width) bool mask of the pixels that hit, last
+    :return: (height, width) float32 depth, 0 where rays missed, and the (n, 3) hit locations, as render_depthmap
+    """
+    if block < 1 or block & (block - 1):
+        raise ValueError(f"Block size must be a power of 2, not {block}")
+
+    width, height = (int(v) for v in m_cam.resolution)
+
+    with instrument.span(instrument.RAY_GENERATION):
+        vectors = camera_rays(m_cam) @ m_cam.image.rs_matrix()[:3, :3].T
+        origin = np.asarray(m_cam.cam_pt, dtype=np.float64)
+
+    # Hits relative to the camera, which keeps the plane fits precise
+    offsets = np.full((len(vectors), 3), np.nan)
+    distances = np.full(len(vectors), np.inf)
+    triangles = np.full(len(vectors), -2, dtype=np.int64)  # -2 not traced yet, -1 missed
+    cos_angle = np.cos(np.radians(max_angle))
+
+    def trace(pixels):
+        pixels = pixels[triangles[pixels] == -2]
+        with instrument.span(instrument.TRACE):
+            _, dist, tri = intersector.intersects_first_location(np.broadcast_to(origin, (len(pixels), 3)),
+                                                                  vectors[pixels])
+        offsets[pixels] = vectors[pixels] * dist[:, None]
+        distances[pixels] = dist
+        triangles[pixels] = tri
+
+        instrument.count("rays", len(pixels))
+        instrument.count("hits", int((tri >= 0).sum()))
+
+    step = block
+    rows, cols = (v.ravel() for v in np.mgrid[0:max(height - 1, 1):step, 0:max(width - 1, 1):step])
+
+    while len(rows):
+        corners = block_corners(rows, cols, step, width, height)
+        trace(np.unique(corners))
+
+        if preview:
+            rr, cc = np.mgrid[0:height, 0:width]
+            nearest = (np.minimum(np.round(rr / step) * step, height - 1) * width +
+                       np.minimum(np.round(cc / step) * step, width - 1)).astype(np.int64).ravel()
+            distances = distances[nearest]
+            triangles = triangles[nearest]
+            offsets = vectors * distances[:, None]
+            break
+
+        if step == 1:
+            # Blocks of single pixels are all corners
+            break
+
+        with instrument.span("interpolate"), np.errstate(invalid="ignore", divide="ignore"):
+            # Corners that missed are NaN, and rule their blocks out
+            tri = triangles[corners]
+            smooth = (tri >= 0).all(axis=1)
+
+            normals = intersector.mesh.face_normals[np.where(tri >= 0, tri, 0)]
+            smooth &= (np.einsum("nij,nj->ni", normals, normals[:, 0]) >= cos_angle).all(axis=1)
+
+            # Plane through the corners' centroid, facing their mean normal
+            points = offsets[corners]
+            centroid = points.mean(axis=1)
+            normal = normals.sum(axis=1)
+            normal /= np.linalg.norm(normal, axis=1)[:, None]
+
+            residual = np.abs(np.einsum("nij,nj->ni", points - centroid[:, None], normal)).max(axis=1)
+            smooth &= residual <= tolerance * distances[corners].min(axis=1)
+
+            # Intersect the rays inside smooth blocks with their plane
+            pixels, owner = block_pixels(rows[smooth], cols[smooth], step, width, height)
+            # Edges shared by neighbouring blocks are filled once
+            pixels, first = np.unique(pixels, return_index=True)
+            fill = triangles[pixels] == -2
+            pixels = pixels[fill]
+            owner = np.nonzero(smooth)[0][owner[first][fill]]
+
+            t = np.einsum("ij,ij->i", centroid[owner], normal[owner]) / \
+                np.einsum("ij,ij->i", vectors[pixels], normal[owner])
+            offsets[pixels] = vectors[pixels] * t[:, None]
+            distances[pixels] = t
+            triangles[pixels] = tri[owner, 0]
+
+            # Rays (nearly) parallel to the plane are traced instead
+            grazing = ~(t > 0) | ~np.isfinite(t)
+            triangles[pixels[grazing]] = -2
+
+        instrument.count("interpolated_pixels", int((~grazing).sum()))
+        trace(pixels[grazing])
+
+        # Split the rest into four, skipping children past the edges of their parent
+        half = step // 2
+        rows, cols = rows[~smooth], cols[~smooth]
+        bottom = np.minimum(rows + step, height - 1)
+        right = np.minimum(cols + step, width - 1)
+
+        dr = np.repeat([0, 0, half, half], len(rows))
+        dc = np.repeat([0, half, 0, half], len(rows))
+        rows, cols = np.tile(rows, 4) + dr, np.tile(cols, 4) + dc
+        keep = ((dr == 0) | (rows < np.tile(bottom, 4))) & ((dc == 0) | (cols < np.tile(right, 4)))
+        rows, cols = rows[keep], cols[keep]
+        step = half
+
+    hit = triangles >= 0
+    depth = np.where(hit, np.round(distances), 0).astype(np.float32).reshape([height, width])
+
+    result = (depth, origin + offsets[hit])
+    if return_triangles:
+        result += (triangles[hit],)
+    if return_hits:
+        result += (hit.reshape([height, width]),)
+
+    return result
@@ -0,0 +1,156 @@
+"""
+Camera frame ray directions, computed once per camera model and shared by every image taken with it.
+
+A fleet of cameras only has a handful of distinct resolutions, fields of view and lenses, so the unit ray through every
+pixel is kept in a process wide cache, keyed by those intrinsics. Lens distortion is undone once, when a bundle is
+built, so distorted cameras cost no more per image than pinhole ones. Each image then only needs its rotation applied:
+
+    vectors = ray_bundle(m_cam).directions @ m_cam.image.rs_matrix()[:3, :3].T
+
+The arrays are float32 and read only, as they are shared. The cache evicts the least recently used bundles once they
+take more than max_bytes.
+"""
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from dtm.distortion import undistort
+
+
+def image_rays(width: int, height: int, fov: (float, float), window: (int, int, int, int) = None,
+               distortion: (float, float, float, float, float) = None) -> np.ndarray:
+    """
+    :param width: Width of the image in pixels
+    :param height: Height of the image in pixels
+    :param fov: Horizontal and vertical field of view in degrees
+    :param window: Only generate rays for this part of the image, as (col,row,width,height) in pixels
+    :param distortion: Brown-Conrady coefficients of the lens, see dtm.distortion, None for a pinhole lens
+    :return: (height * width, 3) float32 unit rays through the pixel centres, row major with the top row first
+    """
+    col, row, w, h = window if window is not None else (0, 0, width, height)
+
+    # Move half a pixel in from the edge of the field of view
+    right, top = np.tan(np.radians(fov) / 2.0) * (1 - 1.0 / np.array([width, height]))
+
+    rays = np.empty((h, w, 3))
+    rays[:, :, 0] = np.linspace(-right, right, width)[col:col + w]
+    rays[:, :, 1] = np.linspace(top, -top, height)[row:row + h, None]
+    rays[:, :, 2] = -1
+
+    if distortion is not None:
+        # Pixel centres are where the lens moved points to, their rays look along the undistorted positions.
+        # dtm.distortion has y down
+        x, y = undistort(rays[:, :, 0], -rays[:, :, 1], distortion)
+        rays[:, :, 0] = x
+        rays[:, :, 1] = -y
+
+    rays /= np.linalg.norm(rays, axis=2)[:, :, None]
+
+    return rays.reshape([-1, 3]).astype(np.float32)
+
+
+class RayBundle:
+    """
+    The unit ray through the centre of every pixel of one camera model, in the camera frame (looking down -z)
+    """
+
+    def __init__(self, width: int, height: int, fov: (float, float),
+                 distortion: (float, float, float, float, float) = None):
+        """
+        :param width: Width of the image in pixels
+        :param height: Height of the image in pixels
+        :param fov: Horizontal and vertical field of view in degrees
+        :param distortion: Brown-Conrady coefficients of the lens, None for a pinhole lens
+        """
+        self.width = width
+        self.height = height
+        self.fov = fov
+        self.distortion = distortion
+
+        rows, cols = np.mgrid[0:height, 0:width].astype(np.int32)
+
+        # (height * width, 3), see image_rays
+        self.directions = image_rays(width, height, fov, distortion=distortion)
+        # (height * width, 2) (col, row) of every ray
+        self.pixels = np.column_stack((cols.ravel(), rows.ravel()))
+
+        self.directions.flags.writeable = False
+        self.pixels.flags.writeable = False
+
+    @property
+    def nbytes(self) -> int:
+        return self.directions.nbytes + self.pixels.nbytes
+
+
+class RayBundleCache:
+    """
+    Least recently used RayBundles, bounded by memory
+    """
+
+    def __init__(self, max_bytes: int = 512 * 1024 * 1024):
+        """
+        :param max_bytes: Most memory the bundles may take, the most recent bundle is always kept
+        """
+        self.max_bytes = max_bytes
+
+        self._bundles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._bundles)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(b.nbytes for b in self._bundles.values())
+
+    @staticmethod
+    def key(m_cam) -> tuple:
+        """
+        :return: The intrinsics that determine a camera's rays, (width, height, fov, distortion)
+        """
+        width, height = (int(v) for v in m_cam.resolution)
+        distortion = getattr(m_cam, "distortion", None)
+
+        return width, height, tuple(float(v) for v in np.broadcast_to(m_cam.fov, 2)), \
+            tuple(float(v) for v in distortion) if distortion is not None else None
+
+    def get(self, m_cam) -> RayBundle:
+        """
+        :param m_cam: DTCamera, or anything else with a resolution, fov and optionally distortion
+        :return: The ray bundle of its camera model, built on a miss
+        """
+        key = self.key(m_cam)
+
+        with self._lock:
+            bundle = self._bundles.get(key)
+            if bundle is not None:
+                self._bundles.move_to_end(key)
+                return bundle
+
+        # Built outside the lock, another thread may build the same bundle, which is harmless
+        bundle = RayBundle(*key)
+
+        with self._lock:
+            bundle = self._bundles.setdefault(key, bundle)
+            self._bundles.move_to_end(key)
+
+            while len(self._bundles) > 1 and self.nbytes > self.max_bytes:
+                self._bundles.popitem(last=False)
+
+        return bundle
+
+    def clear(self):
+        with self._lock:
+            self._bundles.clear()
+
+
+_bundles = RayBundleCache()
+
+
+def ray_bundle(m_cam) -> RayBundle:
+    """
+    :return: The shared ray bundle of a camera's model, see RayBundleCache
+    """
+    return _bundles.get(m_cam)
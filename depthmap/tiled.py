@@ -0,0 +1,123 @@
+"""
+Render depth maps in fixed size screen tiles, so memory use does not depend on the image resolution.
+
+Rays are generated and cast one tile at a time, and every finished tile is streamed to disk, either into a tiled
+(Big)TIFF or into a .npy memory map.
+"""
+
+import numpy as np
+from osgeo import gdal
+
+import instrument
+from depthmap.depthmap import trace_window
+from dtm.camera import DTCamera
+
+
+class NpyDepthWriter:
+    """
+    Writes depth tiles into a float32 .npy file through a memory map
+    """
+
+    def __init__(self, path: str, width: int, height: int):
+        self.path = path
+        self.array = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(height, width))
+
+    def write(self, tile: np.ndarray, col: int, row: int):
+        h, w = tile.shape
+        self.array[row:row + h, col:col + w] = tile
+
+    def close(self):
+        if self.array is not None:
+            self.array.flush()
+            self.array = None
+
+
+class GeoTiffDepthWriter:
+    """
+    Writes depth tiles into a tiled float32 GeoTIFF, switching to BigTIFF when the image needs it
+    """
+
+    def __init__(self, path: str, width: int, height: int, block_size: int = 512):
+        self.path = path
+
+        # GeoTIFF blocks have to be a multiple of 16 pixels
+        block_size = max(16, block_size // 16 * 16)
+
+        driver: gdal.Driver = gdal.GetDriverByName("GTiff")
+        self.ds: gdal.Dataset = driver.Create(path, width, height, 1, gdal.GDT_Float32,
+                                              options=["TILED=YES", f"BLOCKXSIZE={block_size}",
+                                                       f"BLOCKYSIZE={block_size}", "BIGTIFF=IF_SAFER",
+                                                       "COMPRESS=DEFLATE", "PREDICTOR=3"])
+        self.band: gdal.Band = self.ds.GetRasterBand(1)
+
+    def write(self, tile: np.ndarray, col: int, row: int):
+        self.band.WriteArray(tile, col, row)
+
+    def close(self):
+        if self.ds is not None:
+            self.band.FlushCache()
+            self.band = None
+            self.ds = None
+
+
+def open_depth_writer(path: str, width: int, height: int, block_size: int = 512):
+    """
+    :param path: Output file, .npy files are written as a memory map, everything else as a tiled GeoTIFF
+    :param width: Width of the depth map in pixels
+    :param height: Height of the depth map in pixels
+    :param block_size: Internal tile size of GeoTIFFs
+    :return: A NpyDepthWriter or GeoTiffDepthWriter
+    """
+    if path.lower().endswith(".npy"):
+        return NpyDepthWriter(path, width, height)
+
+    return GeoTiffDepthWriter(path, width, height, block_size)
+
+
+def screen_tiles(width: int, height: int, tile_size: int) -> [(int, int, int, int)]:
+    """
+    Split an image into tiles
+
+    :return: (col,row,width,height) of every tile, row by row
+    """
+    return [(col, row, min(tile_size, width - col), min(tile_size, height - row))
+            for row in range(0, height, tile_size)
+            for col in range(0, width, tile_size)]
+
+
+def render_tiled(m_cam: DTCamera, intersector, path: str, tile_size: int = 512, on_tile=None,
+                 return_triangles: bool = False, return_hits: bool = False) -> int:
+    """
+    Ray trace a depth map one screen tile at a time, streaming each tile to disk
+
+    Only one tile of rays, hits and depths is ever held in memory, so this can render at native image resolution. A
+    distorted lens is the exception, its tiles are cut from the cached rays of the whole image, see camera_rays.
+
+    :param m_cam: Camera to render from
+    :param intersector: Ray intersector for the terrain, e.g. RayMeshIntersector
+    :param path: Output file, see open_depth_writer
+    :param tile_size: Width and height of the screen tiles, in pixels
+    :param on_tile: Optional callable, given (window, depth, locations) of every finished tile, then the faces hit
+     with return_triangles and the hit mask with return_hits
+    :param return_triangles: Pass the faces hit to on_tile, e.g. for a depthmap.export point writer
+    :param return_hits: Pass the mask of the pixels that hit to on_tile, e.g. for the pixel field of a point writer
+    :return: Total number of hits
+    """
+    width, height = (int(v) for v in m_cam.resolution)
+    writer = open_depth_writer(path, width, height, tile_size)
+
+    hits = 0
+    try:
+        for window in screen_tiles(width, height, tile_size):
+            depth, locs, *extra = trace_window(m_cam, intersector, window, return_triangles, return_hits)
+            with instrument.span(instrument.WRITE):
+                writer.write(depth, window[0], window[1])
+
+            if on_tile is not None:
+                on_tile(window, depth, locs, *extra)
+
+            hits += len(locs)
+    finally:
+        writer.close()
+
+    return hits
@@ -1,40 +1,60 @@
-import uuid
-from time import sleep
-
 import requests
-from osgeo import gdal
 
+import instrument
+from dtm.cache import RasterCache
 from dtm.dtm import DtmType
+from dtm.fetch import Tile, default_session, fetch_tiles, split_bbox
+from dtm.mosaic import mosaic
 
 
 class DefraDtmType(DtmType):
     srs = "3857"
+    url = "https://environment.data.gov.uk/image/rest/services/SURVEY/LIDAR_Composite_1m_DTM_2020_Elevation/" \
+          "ImageServer/exportImage"
 
-    def __init__(self, bbox: (int, int, int, int), resolution: (int, int) = (2000, 2000), scale: float = 1):
-        super().__init__(bbox, resolution, scale)
+    # Largest export the ImageServer is asked for in one request, bigger rasters are downloaded as tiles
+    max_tile_size = 2000
+    fetch_workers = 8
 
-    def get_raster(self, bbox: (int, int, int, int)):
-        # bbox fmt: (minx, miny, maxx, maxy)
-        resp = requests.get(
-            "https://environment.data.gov.uk/image/rest/services/SURVEY/LIDAR_Composite_1m_DTM_2020_Elevation/"
-            "ImageServer/exportImage",
+    def __init__(self, bbox: (int, int, int, int), resolution: (int, int) = (2000, 2000), scale: float = 1,
+                 cache: RasterCache = None, max_error: float = None, session: requests.Session = None):
+        self.session = session if session is not None else default_session()
+        super().__init__(bbox, resolution, scale, cache, max_error)
+
+    def download(self, bbox: (int, int, int, int), size: str) -> bytes:
+        resp = self.session.get(
+            self.url,
             params={
                 "bbox": ",".join(str(x) for x in bbox),
                 "bboxSR": self.srs,
                 "imageSR": self.srs,
-                "size": ",".join((str(x * self.scale) for x in self.resolution)),
+                "size": size,
                 "format": "tiff",
                 "transparent": "true",
                 "f": "image"
             }
         )
+        resp.raise_for_status()
+        instrument.count("bytes_downloaded", len(resp.content))
+
+        return self.check_tiff(resp.content)
+
+    def get_tile(self, tile: Tile) -> bytes:
+        size = ",".join(str(x) for x in tile.size)
+
+        key = self.cache.key(self.url, tile.bbox, self.srs, size)
+        return self.cache.fetch(key, lambda: self.download(tile.bbox, size))
+
+    def get_raster(self, bbox: (int, int, int, int)):
+        # bbox fmt: (minx, miny, maxx, maxy)
+        pixels = [int(round(x * self.scale)) for x in self.resolution]
 
-        with open("hm.tiff", "wb") as f:
-            f.write(resp.content)
+        if max(pixels) <= self.max_tile_size:
+            # Small enough for a single request
+            size = ",".join((str(x * self.scale) for x in self.resolution))
 
-        # Load the TIFF into a memory map, that GDAL can then read
-        mmap_name = f"/vsimem/{uuid.uuid4().hex}"
-        gdal.FileFromMemBuffer(mmap_name, resp.content)
+            key = self.cache.key(self.url, bbox, self.srs, size)
+            return mosaic([self.cache.fetch(key, lambda: self.download(bbox, size))])
 
-        ds = gdal.Open(mmap_name, gdal.GA_ReadOnly)
-        return ds
+        tiles = split_bbox(bbox, pixels, self.max_tile_size)
+        return mosaic(fetch_tiles(tiles, self.get_tile, workers=self.fetch_workers))
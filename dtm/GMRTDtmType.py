@@ -1,11 +1,13 @@
-import uuid
-from typing import Any
-
-from dtm.dtm import DtmType, GeoTransform
+import instrument
+from dtm.dtm import DtmType
+from dtm.fetch import ExpiringCache, Tile, fetch_tiles, split_bbox
+from dtm.mosaic import mosaic
 from owslib.wms import WebMapService
 
 from osgeo import gdal
-import numpy as np
+
+# Parsed GetCapabilities documents, per service URL and version
+_capabilities = ExpiringCache(ttl=60 * 60)
 
 
 class GMRTDtmType(DtmType):
@@ -18,27 +20,22 @@ class GMRTDtmType(DtmType):
 
     """
     wms_url = "https://www.gmrt.org/services/mapserver/wms_merc"
+    wms_version = "1.3.0"
     srs = "EPSG:3857"
     fmt = "image/tiff"
 
-    def get_wms(self) -> WebMapService:
-        wms = WebMapService(self.wms_url, version='1.3.0')
-
-        return wms
+    # Largest GetMap the server is asked for in one request, bigger rasters are downloaded as tiles
+    max_tile_size = 2000
+    fetch_workers = 4
 
-    def get_raster(self, bbox: (int, int, int, int)) -> gdal.Dataset | None:
+    def get_wms(self) -> WebMapService:
         """
-
-        :param bbox: Bounding box to get the map tile from, in the format (minx,miny,maxx,maxy)
-        :return:
+        :return: The service, only fetching and parsing its capabilities once an hour
         """
-        width = np.abs(bbox[2] - bbox[0])
-        height = np.abs(bbox[3] - bbox[1])
-
-        if width > self.resolution[0] or height > self.resolution[1]:
-            print("Bounds too big")
-            return None
+        return _capabilities.get((self.wms_url, self.wms_version),
+                                 lambda: WebMapService(self.wms_url, version=self.wms_version))
 
+    def download(self, bbox: (int, int, int, int), size: [int, int]) -> bytes:
         img = self.get_wms().getmap(
             layers=["topo"],
             styles='',
@@ -46,15 +43,28 @@ class GMRTDtmType(DtmType):
             format=self.fmt,
             bbox=bbox,
             transparent=False,
-            size=[r * self.scale for r in self.resolution]
+            size=size
         )
 
-        with open("hm.tiff", "wb") as f:
-            f.write(img.read())
+        # Read the response exactly once, into the buffer GDAL opens
+        data = img.read()
+        instrument.count("bytes_downloaded", len(data))
 
-        # Load the TIFF into a memory map, that GDAL can then read
-        mmap_name = f"/vsimem/{uuid.uuid4().hex}"
-        gdal.FileFromMemBuffer(mmap_name, img.read())
+        return self.check_tiff(data)
+
+    def get_tile(self, tile: Tile) -> bytes:
+        size = list(tile.size)
+
+        key = self.cache.key(self.wms_url, tile.bbox, self.srs, size)
+        return self.cache.fetch(key, lambda: self.download(tile.bbox, size))
+
+    def get_raster(self, bbox: (int, int, int, int)) -> gdal.Dataset:
+        """
+
+        :param bbox: Bounding box to get the map tile from, in the format (minx,miny,maxx,maxy)
+        :return: The raster, mosaicked from several GetMap requests if it is bigger than max_tile_size
+        """
+        pixels = [int(round(r * self.scale)) for r in self.resolution]
+        tiles = split_bbox(bbox, pixels, self.max_tile_size)
 
-        ds = gdal.Open(mmap_name)
-        return ds
+        return mosaic(fetch_tiles(tiles, self.get_tile, workers=self.fetch_workers))
@@ -0,0 +1,208 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+
+class RasterCacheMiss(LookupError):
+    """
+    Raised when a raster is not cached and the cache is not allowed to download it
+    """
+
+
+class RasterCache:
+    """
+    A content addressed on-disk cache of downloaded DTM rasters.
+
+    Entries are keyed on everything that identifies a request (source, bbox, bboxSR and size), so
+    reprocessing the same area never hits the network twice. The cache is shared between processes:
+    entries are written to a temporary file and atomically renamed into place, and the least recently
+    used entries are evicted once the total size goes over `max_bytes`.
+
+    The defaults can be set through the environment:
+
+    - DTM_CACHE_DIR: Cache location, defaults to ~/.cache/depthmap-generator/dtm
+    - DTM_CACHE_MAX_BYTES: Size cap, defaults to 4 GiB
+    - DTM_CACHE_OFFLINE: Set to 1 to never download, raising RasterCacheMiss instead
+    """
+    suffix = ".tiff"
+
+    # Temporary files older than this were left behind by a crashed writer
+    stale_seconds = 60 * 60
+
+    def __init__(self, directory: str = None, max_bytes: int = None, offline: bool = None):
+        if directory is None:
+            directory = os.environ.get("DTM_CACHE_DIR",
+                                       os.path.join(os.path.expanduser("~"), ".cache", "depthmap-generator", "dtm"))
+        if max_bytes is None:
+            max_bytes = int(os.environ.get("DTM_CACHE_MAX_BYTES", 4 * 1024 ** 3))
+        if offline is None:
+            offline = os.environ.get("DTM_CACHE_OFFLINE", "0") == "1"
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.offline = offline
+
+    @staticmethod
+    def key(source: str, bbox: (float, float, float, float), bbox_sr: str, size) -> str:
+        """
+        Generate the cache key of a raster request
+
+        :param source: URL (or other identifier) of the service the raster comes from
+        :param bbox: Requested bounds, in the format (minx,miny,maxx,maxy)
+        :param bbox_sr: SRS of the bounds
+        :param size: Requested raster size, or scale
+        :return: Hex digest identifying the request
+        """
+        ident = json.dumps([source, [float(v) for v in bbox], str(bbox_sr), str(size)])
+        return hashlib.sha256(ident.encode("utf-8")).hexdigest()
+
+    def path(self, key: str) -> str:
+        # Shard on the first two characters, to keep directories small
+        return os.path.join(self.directory, key[:2], key + self.suffix)
+
+    def get(self, key: str) -> bytes | None:
+        """
+        Read a raster from the cache, marking it as recently used
+
+        :param key: Key from RasterCache.key
+        :return: The raster, or None if it is not cached
+        """
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+
+        try:
+            # The modification time doubles as the last access time for LRU eviction, atime is often disabled
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+        return data
+
+    def put(self, key: str, data: bytes):
+        """
+        Atomically store a raster in the cache, then evict old entries if the cache is over its size cap
+
+        :param key: Key from RasterCache.key
+        :param data: Raster file contents
+        """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".", suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+            # Readers either see the complete old file, or the complete new one
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except FileNotFoundError:
+                pass
+            raise
+
+        self.evict()
+
+    def fetch(self, key: str, download) -> bytes:
+        """
+        Read a raster from the cache, downloading and storing it on a miss
+
+        :param key: Key from RasterCache.key
+        :param download: Callable returning the raster contents, only called on a miss
+        :return: The raster
+        """
+        data = self.get(key)
+        if data is not None:
+            return data
+
+        if self.offline:
+            raise RasterCacheMiss(f"Raster {key} is not cached, and the cache is offline")
+
+        data = download()
+        self.put(key, data)
+        return data
+
+    def entries(self) -> [(str, int, float)]:
+        """
+        :return: (path, size, mtime) of every cached raster
+        """
+        found = []
+        now = time.time()
+
+        if not os.path.isdir(self.directory):
+            return found
+
+        for shard in os.scandir(self.directory):
+            if not shard.is_dir():
+                continue
+
+            for entry in os.scandir(shard.path):
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+
+                if entry.name.endswith(".part"):
+                    # Clean up after writers that died half way through
+                    if now - st.st_mtime > self.stale_seconds:
+                        self._remove(entry.path)
+                    continue
+
+                if entry.name.endswith(self.suffix):
+                    found.append((entry.path, st.st_size, st.st_mtime))
+
+        return found
+
+    @property
+    def size(self) -> int:
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """
+        Remove the least recently used rasters until the cache fits in max_bytes
+        """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+
+        for path, size, _ in sorted(entries, key=lambda e: e[2]):
+            if total <= self.max_bytes:
+                break
+
+            self._remove(path)
+            total -= size
+
+    def clear(self):
+        for path, _, _ in self.entries():
+            self._remove(path)
+
+    @staticmethod
+    def _remove(path: str):
+        # Another process may be evicting the same file
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+_default_cache: RasterCache = None
+
+
+def default_cache() -> RasterCache:
+    """
+    :return: The process wide cache, configured from the environment
+    """
+    global _default_cache
+
+    if _default_cache is None:
+        _default_cache = RasterCache()
+
+    return _default_cache
@@ -1,8 +1,11 @@
 import numpy as np
 import trimesh
+from trimesh import util
 from trimesh.creation import camera_marker
 from trimesh.scene import Camera
 
+from dtm.distortion import distort, undistort
+from dtm.helpers import get_cam_corners
 from dtm.image import Image
 
 
@@ -28,6 +31,13 @@ class DTCamera(Camera):
     def cam_pt(self):
         return *self.coords, self.image.campos[2] + self.z_offset
 
+    @property
+    def distortion(self) -> (float, float, float, float, float):
+        """
+        :return: Brown-Conrady coefficients of the lens, None for a pinhole lens, see dtm.distortion
+        """
+        return self.image.distortion
+
     @property
     def marker(self) -> [trimesh.Trimesh]:
         ma = np.zeros((4, 4))
@@ -41,3 +51,125 @@ class DTCamera(Camera):
             m.apply_translation(self.cam_pt)
 
         return meshes
+
+    def corner_rays(self) -> np.ndarray:
+        """
+        :return: (4, 3) unit direction of the rays through the four corner pixels, in world space
+        """
+        corners = get_cam_corners(self)
+
+        if self.distortion is not None:
+            # Image plane y is up here, and down in dtm.distortion
+            x, y = undistort(corners[:, 0] / -corners[:, 2], corners[:, 1] / corners[:, 2], self.distortion)
+            corners = util.unitize(np.column_stack((x, -y, -np.ones_like(x))))
+
+        return corners @ self.image.rs_matrix()[:3, :3].T
+
+    def _half_size(self) -> np.ndarray:
+        """
+        :return: (2,) normalised image x and y of the centre of the right, top pixel, as in get_cam_corners
+        """
+        return np.tan(np.radians(self.fov) / 2.0) * (1 - 1.0 / np.asarray(self.resolution, dtype=np.float64))
+
+    def border_rays(self, samples: int = 64) -> np.ndarray:
+        """
+        :param samples: Rays along each edge of the image, corners included
+        :return: (4 * samples, 3) unit direction of the rays through the pixels around the edge of the image, in
+         world space
+        """
+        right, top = self._half_size()
+        x = np.linspace(-right, right, samples)
+        y = np.linspace(-top, top, samples)
+
+        # Image plane y is up here
+        xy = np.vstack((np.column_stack((x, np.full(samples, top))), np.column_stack((x, np.full(samples, -top))),
+                        np.column_stack((np.full(samples, -right), y)), np.column_stack((np.full(samples, right), y))))
+
+        if self.distortion is not None:
+            # The edge pixels are where the lens moved points to, and dtm.distortion has y down
+            ux, uy = undistort(xy[:, 0], -xy[:, 1], self.distortion)
+            xy = np.column_stack((ux, -uy))
+
+        rays = util.unitize(np.column_stack((xy, -np.ones(len(xy)))))
+        return rays @ self.image.rs_matrix()[:3, :3].T
+
+    def sees(self, rays: np.ndarray) -> np.ndarray:
+        """
+        :param rays: (n, 3) directions in world space
+        :return: (n,) bool, whether each ray passes through the image
+        """
+        cam = np.asarray(rays, dtype=np.float64) @ self.image.rs_matrix()[:3, :3]
+        ahead = cam[:, 2] < 0
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            x = cam[:, 0] / -cam[:, 2]
+            y = cam[:, 1] / -cam[:, 2]
+
+        if self.distortion is not None:
+            x, y = distort(x, -y, self.distortion)
+            y = -y
+
+        right, top = self._half_size()
+        return ahead & (np.abs(x) <= right) & (np.abs(y) <= top)
+
+    def ground_footprint(self, ground_z: float, max_distance: float = None,
+                         samples: int = 64) -> (float, float, float, float):
+        """
+        Find the area of the ground plane that the camera frustum can see, by following its rays down to the plane
+        z = ground_z. Rays that don't reach the plane within max_distance are cut off there.
+
+        Use the lowest elevation of the terrain for ground_z, every ray that hits the terrain will then hit it
+        between the camera and the plane, so inside the footprint.
+
+        The frustum, cut off by the plane and by the sphere of max_distance, is furthest out along x or y either on
+        its edge, which is sampled with the rays around the edge of the image, or where the sphere, or its circle on
+        the plane, is furthest out along that axis. Between the edge rays the arcs cut off at max_distance can be
+        short by max_distance * (1 - cos(step / 2)) for an angular step between them, centimetres at 2 km.
+
+        :param ground_z: Elevation of the ground plane
+        :param max_distance: Furthest distance a ray can travel, defaults to z_far
+        :param samples: Rays along each edge of the image
+        :return: BBOX of the footprint in the format: (minx,miny,maxx,maxy)
+        """
+        if max_distance is None:
+            max_distance = self.z_far
+
+        origin = np.array(self.cam_pt, dtype=np.float64)
+        height = origin[2] - ground_z
+
+        # Furthest along +-x and +-y on the sphere, level and where it meets the plane
+        axes = np.array([[1.0, 0.0], [-1.0, 0.0], [0.0, 1.0], [0.0, -1.0]])
+        extremes = [np.column_stack((axes, np.zeros(4)))]
+        if 0 < height < max_distance:
+            extremes.append(np.column_stack((axes * np.sqrt(max_distance ** 2 - height ** 2), np.full(4, -height))) /
+                            max_distance)
+        extremes = np.vstack(extremes)
+
+        rays = [self.border_rays(samples), extremes[self.sees(extremes)]]
+
+        if 0 < height < max_distance:
+            # The edge of the footprint has a corner where the edge rays go from reaching the plane to being cut off,
+            # find it between the samples either side of it
+            edges = rays[0].reshape([4, samples, 3])
+            reach = edges[:, :, 2] * max_distance <= -height
+            edge, i = np.nonzero(reach[:, 1:] != reach[:, :-1])
+
+            a, b = edges[edge, i], edges[edge, i + 1]
+            flip = reach[edge, i]
+            a[flip], b[flip] = b[flip], a[flip].copy()
+            for _ in range(40):
+                mid = util.unitize(a + b)
+                down = mid[:, 2] * max_distance <= -height
+                a[~down] = mid[~down]
+                b[down] = mid[down]
+            rays.append(a)
+
+        rays = np.vstack(rays)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = (ground_z - origin[2]) / rays[:, 2]
+        t = np.where(np.isfinite(t) & (t > 0), np.minimum(t, max_distance), max_distance)
+
+        pts = np.vstack((origin[:2] + rays[:, :2] * t[:, None], origin[:2]))
+
+        return *pts.min(axis=0), *pts.max(axis=0)
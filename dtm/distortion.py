@@ -0,0 +1,49 @@
+"""
+Brown-Conrady lens distortion, with coefficients in the OpenCV order (k1, k2, p1, p2, k3).
+
+Coordinates are normalised image coordinates, i.e. positions on the image plane at unit distance from the camera, with
+x to the right and y down as in OpenCV.
+"""
+
+import numpy as np
+
+
+def distort(x: np.ndarray, y: np.ndarray, coefficients: (float, float, float, float, float)) -> \
+        (np.ndarray, np.ndarray):
+    """
+    :param x: Undistorted normalised x, where a pinhole camera would image the point
+    :param y: Undistorted normalised y
+    :param coefficients: (k1, k2, p1, p2, k3)
+    :return: Distorted (x, y), where the lens images the point
+    """
+    k1, k2, p1, p2, k3 = coefficients
+
+    r2 = x * x + y * y
+    radial = 1 + r2 * (k1 + r2 * (k2 + r2 * k3))
+
+    return x * radial + 2 * p1 * x * y + p2 * (r2 + 2 * x * x), \
+        y * radial + p1 * (r2 + 2 * y * y) + 2 * p2 * x * y
+
+
+def undistort(x: np.ndarray, y: np.ndarray, coefficients: (float, float, float, float, float),
+              iterations: int = 20) -> (np.ndarray, np.ndarray):
+    """
+    Invert distort by fixed point iteration, as OpenCV's undistortPoints does
+
+    :param x: Distorted normalised x, e.g. of a pixel centre
+    :param y: Distorted normalised y
+    :param coefficients: (k1, k2, p1, p2, k3)
+    :param iterations: Number of refinements, plenty for the distortion of photogrammetry lenses
+    :return: Undistorted (x, y), the direction the pixel looks in
+    """
+    k1, k2, p1, p2, k3 = coefficients
+    xd, yd = x, y
+
+    for _ in range(iterations):
+        r2 = x * x + y * y
+        radial = 1 + r2 * (k1 + r2 * (k2 + r2 * k3))
+
+        x, y = (xd - 2 * p1 * x * y - p2 * (r2 + 2 * x * x)) / radial, \
+            (yd - p1 * (r2 + 2 * y * y) - 2 * p2 * x * y) / radial
+
+    return x, y
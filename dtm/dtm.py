@@ -7,6 +7,11 @@ import trimesh
 from osgeo import gdal
 from trimesh.visual import TextureVisuals
 
+import instrument
+from dtm import rtin
+from dtm.cache import RasterCache, default_cache
+from dtm.mosaic import unlink_memory_files
+
 
 @dataclass(kw_only=False)
 class GeoTransform:
@@ -33,25 +38,48 @@ class DtmType:
     """
     resolution = (2000, 2000)
     scale = 1
+    cache: RasterCache = None
+    max_error: float = None  # Maximum vertical error of an adaptive mesh, None for two triangles per cell
 
     _raster: gdal.Dataset = None
     _trimesh: trimesh.Trimesh = None
+    _vertices: np.ndarray = None
+    _faces: np.ndarray = None
     bbox: (int, int, int, int) = (0, 0, 0, 0)  # (minx,miny,maxx,maxy)
+    window: (int, int, int, int) = None  # (xoff,yoff,xsize,ysize) in pixels, None for the whole raster
 
-    def __init__(self, bbox: (int, int, int, int), resolution: (int, int) = (2000, 2000), scale: float = 1):
+    def __init__(self, bbox: (int, int, int, int), resolution: (int, int) = (2000, 2000), scale: float = 1,
+                 cache: RasterCache = None, max_error: float = None):
         self.bbox = bbox
         self.resolution = resolution
         self.scale = scale
+        self.cache = cache if cache is not None else default_cache()
+        self.max_error = max_error
 
-        self._raster = self.get_raster(bbox)
+        with instrument.span(instrument.FETCH):
+            self._raster = self.get_raster(bbox)
 
     def get_raster(self, bbox: (int, int, int, int)):
         raise NotImplementedError("This method must be implemented")
 
+    @staticmethod
+    def check_tiff(data: bytes) -> bytes:
+        """
+        Make sure a download is actually a TIFF, and not an error page, before it is cached
+
+        :param data: Downloaded raster
+        :return: The same data
+        """
+        if data[:4] not in (b"II*\x00", b"MM\x00*", b"II+\x00", b"MM\x00+"):
+            raise ValueError(f"Expected a TIFF raster, got: {data[:100]!r}")
+
+        return data
+
     @property
     def raster(self):
         if self._raster is None:
-            self._raster = self.get_raster(bbox=self.bbox)
+            with instrument.span(instrument.FETCH):
+                self._raster = self.get_raster(bbox=self.bbox)
 
         return self._raster
 
@@ -60,44 +88,231 @@ class DtmType:
         t: (int, float, float, int, float, float) = self.raster.GetGeoTransform()
         return GeoTransform(*t)
 
+    @property
+    def tile_id(self) -> tuple:
+        """
+        Identifies the terrain that gets meshed, e.g. to share an Embree scene between everything rendering it
+        """
+        return type(self).__name__, tuple(float(v) for v in self.bbox), tuple(self.resolution), self.scale, \
+            self.window, self.max_error
+
+    @property
+    def raster_window(self) -> (int, int, int, int):
+        """
+        The part of the raster that gets meshed and traced, as (xoff,yoff,xsize,ysize) in pixels
+        """
+        if self.window is None:
+            return 0, 0, self.raster.RasterXSize, self.raster.RasterYSize
+
+        return self.window
+
+    @property
+    def window_transform(self) -> GeoTransform:
+        """
+        Geo-transform of the raster window, its top left is the top left of the window
+        """
+        t = self.geo_transform
+        xoff, yoff, _, _ = self.raster_window
+
+        return GeoTransform(t.x_top_left + xoff * t.x_pixel_size + yoff * t.row_rot, t.x_pixel_size, t.row_rot,
+                            t.y_top_left + xoff * t.col_rot + yoff * t.y_pixel_size, t.col_rot, t.y_pixel_size)
+
+    @property
+    def origin(self) -> np.ndarray:
+        """
+        Top left of the raster window, at zero elevation. The float32 mesh arrays are stored relative to it, as
+        projected coordinates are millions of metres and float32 would round them to about half a metre.
+        """
+        transform = self.window_transform
+        return np.array([transform.x_top_left, transform.y_top_left, 0.0])
+
+    @property
+    def nodata(self) -> float | None:
+        return self.raster.GetRasterBand(1).GetNoDataValue()
+
+    def read_heights(self) -> np.ndarray:
+        """
+        :return: (ysize, xsize) elevations inside the raster window
+        """
+        return self.raster.GetRasterBand(1).ReadAsArray(*self.raster_window)
+
+    def set_window(self, bbox: (float, float, float, float), margin: float = 0):
+        """
+        Restrict meshing and tracing to the part of the raster that covers a bbox, for example the ground
+        footprint of a camera (see DTCamera.ground_footprint)
+
+        :param bbox: Area to keep, in the format (minx,miny,maxx,maxy)
+        :param margin: Distance, in SRS units, to grow the bbox by on every side
+        """
+        t = self.geo_transform
+        minx, miny, maxx, maxy = bbox
+
+        cols = (np.array([minx - margin, maxx + margin]) - t.x_top_left) / t.x_pixel_size
+        rows = (np.array([miny - margin, maxy + margin]) - t.y_top_left) / t.y_pixel_size
+
+        # Round outwards, so the window always covers the whole bbox
+        x0 = max(int(np.floor(cols.min())), 0)
+        x1 = min(int(np.ceil(cols.max())) + 1, self.raster.RasterXSize)
+        y0 = max(int(np.floor(rows.min())), 0)
+        y1 = min(int(np.ceil(rows.max())) + 1, self.raster.RasterYSize)
+
+        if x1 - x0 < 2 or y1 - y0 < 2:
+            raise ValueError(f"{bbox} does not overlap the raster bounds")
+
+        self.window = (x0, y0, x1 - x0, y1 - y0)
+        self.clear_mesh()
+
+    def clear_window(self):
+        self.window = None
+        self.clear_mesh()
+
+    def clear_mesh(self):
+        self._trimesh = None
+        self._vertices = None
+        self._faces = None
+
+    def close(self):
+        """
+        Close the raster and free the GDAL memory files it was loaded into (see dtm.mosaic), along with the mesh
+        """
+        if self._raster is not None:
+            names = self._raster.GetFileList() or []
+            # Drop the dataset before its files are unlinked
+            self._raster = None
+            unlink_memory_files(names)
+
+        self.clear_mesh()
+
+    def elevation_range(self) -> (float, float):
+        """
+        :return: (min, max) elevation over the whole raster, ignoring nodata
+        """
+        band = self.raster.GetRasterBand(1)
+        zz = band.ReadAsArray().astype(np.float64)
+
+        if self.nodata is not None:
+            zz[zz == self.nodata] = np.nan
+
+        return float(np.nanmin(zz)), float(np.nanmax(zz))
+
+    def height_at(self, x: float, y: float) -> float:
+        """
+        Sample the terrain surface at a point, interpolating on the same two triangles per cell that the
+        mesh uses, so this is the height a vertical ray would hit
+
+        :param x: X coordinate, in the raster SRS
+        :param y: Y coordinate, in the raster SRS
+        :return: Elevation, or NaN outside of the raster
+        """
+        t = self.geo_transform
+        col = (x - t.x_top_left) / t.x_pixel_size
+        row = (y - t.y_top_left) / t.y_pixel_size
+
+        c = int(np.clip(np.floor(col), 0, self.raster.RasterXSize - 2))
+        r = int(np.clip(np.floor(row), 0, self.raster.RasterYSize - 2))
+        u = col - c
+        v = row - r
+
+        if not (0 <= u <= 1 and 0 <= v <= 1):
+            return np.nan
+
+        (z00, z10), (z01, z11) = self.raster.GetRasterBand(1).ReadAsArray(c, r, 2, 2).astype(np.float64)
+
+        if u <= v:
+            # Triangle (a, a + width, a + width + 1)
+            return z00 + v * (z01 - z00) + u * (z11 - z01)
+
+        # Triangle (a, a + width + 1, a + 1)
+        return z00 + u * (z10 - z00) + v * (z11 - z10)
+
     def get_vertices(self) -> np.ndarray:
-        transform = self.geo_transform
-        width = self.raster.RasterXSize
-        height = self.raster.RasterYSize
+        """
+        Build one vertex per raster pixel, in row major order.
 
-        x = np.arange(0, width) * transform.x_pixel_size + transform.x_top_left
-        y = np.arange(0, height) * transform.y_pixel_size + transform.y_top_left
-        xx, yy = np.meshgrid(x, y)
+        X and Y are broadcast from a single row and column rather than a full meshgrid, and the
+        result is written straight into a contiguous float32 buffer, the format Embree consumes.
 
-        zz = self.raster.GetRasterBand(1).ReadAsArray()
+        :return: (width * height, 3) float32 array of (x, y, z) relative to `origin`, covering the raster window
+        """
+        transform = self.window_transform
+        _, _, width, height = self.raster_window
 
-        vertices = np.vstack((xx, yy, zz))
-        vertices = vertices.reshape([3, -1])
-        vertices = vertices.transpose()
+        vertices = np.empty((height, width, 3), dtype=np.float32)
+        vertices[:, :, 0] = np.arange(0, width) * transform.x_pixel_size
+        vertices[:, :, 1] = (np.arange(0, height) * transform.y_pixel_size)[:, None]
+        vertices[:, :, 2] = self.read_heights()
 
-        return vertices
+        return vertices.reshape([-1, 3])
 
     def get_indices(self) -> np.ndarray:
-        width = self.raster.RasterXSize
-        height = self.raster.RasterYSize
+        """
+        Build two triangles per raster cell, see dtm.rtin.grid_faces
+
+        :return: (2 * (width - 1) * (height - 1), 3) uint32 array of vertex indices, covering the raster window
+        """
+        _, _, width, height = self.raster_window
+
+        return rtin.grid_faces(width, height)
+
+    def get_simplified_mesh(self, max_error: float) -> (np.ndarray, np.ndarray):
+        """
+        Build an adaptive, crack free mesh of the raster window, using a right-triangulated irregular network. Flat
+        areas such as fields, water and sea are covered by a few large triangles instead of two per cell.
+
+        :param max_error: Maximum vertical error of the mesh, in metres (see dtm.rtin.triangulate)
+        :return: (n, 3) float32 vertices relative to `origin`, and (m, 3) uint32 faces
+        """
+        transform = self.window_transform
+        zz = self.read_heights()
+
+        heights = zz.astype(np.float64)
+        if self.nodata is not None:
+            # Keep full resolution around missing data
+            heights[zz == self.nodata] = np.nan
+
+        pixels, faces = rtin.triangulate(heights, max_error)
+
+        vertices = np.empty((len(pixels), 3), dtype=np.float32)
+        vertices[:, 0] = pixels[:, 0] * transform.x_pixel_size
+        vertices[:, 1] = pixels[:, 1] * transform.y_pixel_size
+        vertices[:, 2] = zz[pixels[:, 1], pixels[:, 0]]
+
+        return vertices, faces
+
+    def simplify(self, max_error: float | None):
+        """
+        Switch between the adaptive mesh (see get_simplified_mesh) and the full grid (None)
+        """
+        self.max_error = max_error
+        self.clear_mesh()
+
+    @property
+    def mesh_arrays(self) -> (np.ndarray, np.ndarray):
+        """
+        Cached (vertices, faces) of the terrain as contiguous float32 / uint32 arrays, which the Embree backend builds
+        its scene from without converting them, see RayMeshIntersector.from_dtm. Vertices are relative to `origin`.
+        """
+        if self._vertices is None or self._faces is None:
+            with instrument.span(instrument.MESH_BUILD):
+                if self.max_error is None:
+                    self._vertices = self.get_vertices()
+                    self._faces = self.get_indices()
+                else:
+                    self._vertices, self._faces = self.get_simplified_mesh(self.max_error)
 
-        ai = np.arange(0, width - 1)
-        aj = np.arange(0, height - 1)
-        aii, ajj = np.meshgrid(ai, aj)
-        a = aii + ajj * width
-        a = a.flatten()
+            instrument.count("triangles", len(self._faces))
 
-        tria = np.vstack((a, a + width, a + width + 1, a, a + width + 1, a + 1))
-        tria = np.transpose(tria).reshape([-1, 3])
-        return tria
+        return self._vertices, self._faces
 
     @property
     def trimesh(self):
         if self._trimesh is None:
-            verts = self.get_vertices()
-            faces = self.get_indices()
+            verts, faces = self.mesh_arrays
 
-            return trimesh.Trimesh(vertices=verts.tolist(), faces=faces.tolist())
+            with instrument.span(instrument.MESH_BUILD):
+                # Trimesh keeps float64 vertices anyway, so they go back to absolute coordinates without losing
+                # precision. Skip processing, the grid has no duplicate vertices, and merging would reorder the faces
+                self._trimesh = trimesh.Trimesh(vertices=verts + self.origin, faces=faces, process=False)
 
         return self._trimesh
 
@@ -0,0 +1,138 @@
+"""
+Download large rasters as a grid of tiles, concurrently over a pooled HTTP session.
+
+Image services cap the size of a single export, so a large bbox is split into tiles the server accepts. Tiles are
+aligned to the pixel grid of the full request, so they mosaic back together without gaps or resampling, see
+dtm.mosaic.
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+@dataclass(frozen=True)
+class Tile:
+    bbox: (float, float, float, float)  # (minx,miny,maxx,maxy)
+    size: (int, int)  # (width,height) in pixels
+    offset: (int, int)  # (col,row) of the top left pixel in the full raster
+
+
+def split_bbox(bbox: (float, float, float, float), size: (int, int), max_tile_size: int) -> [Tile]:
+    """
+    Split a raster request into tiles of at most max_tile_size pixels a side
+
+    :param bbox: Bounds of the full raster, in the format (minx,miny,maxx,maxy)
+    :param size: (width,height) of the full raster in pixels
+    :param max_tile_size: Largest width or height a tile may have
+    :return: Tiles row by row, starting from the top left
+    """
+    minx, miny, maxx, maxy = bbox
+    width, height = (int(v) for v in size)
+    px = (maxx - minx) / width
+    py = (maxy - miny) / height
+
+    tiles = []
+    for row in range(0, height, max_tile_size):
+        h = min(max_tile_size, height - row)
+        for col in range(0, width, max_tile_size):
+            w = min(max_tile_size, width - col)
+
+            # Rows count down from the top of the bbox
+            tiles.append(Tile(bbox=(minx + col * px, maxy - (row + h) * py, minx + (col + w) * px, maxy - row * py),
+                              size=(w, h), offset=(col, row)))
+
+    return tiles
+
+
+def make_session(pool_size: int = 8, retries: int = 5, backoff: float = 0.5) -> requests.Session:
+    """
+    Create an HTTP session that keeps connections alive between tiles, and retries failed requests
+
+    :param pool_size: Connections to keep open per host, at least the number of concurrent downloads
+    :param retries: Attempts per request on connection errors, and on 429 and 5xx responses
+    :param backoff: Wait backoff * 2^n seconds before the nth retry
+    """
+    retry = Retry(total=retries, connect=retries, read=retries, backoff_factor=backoff,
+                  status_forcelist=(429, 500, 502, 503, 504), allowed_methods=["GET"],
+                  respect_retry_after_header=True)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
+
+def fetch_tiles(tiles: [Tile], download, workers: int = 8) -> [bytes]:
+    """
+    Download tiles concurrently
+
+    :param tiles: Tiles to download, see split_bbox
+    :param download: Callable given a Tile, returning its raster contents
+    :param workers: Most downloads in flight at once
+    :return: The contents of every tile, in the same order as tiles
+    """
+    if workers <= 1 or len(tiles) <= 1:
+        return [download(t) for t in tiles]
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(tiles)), thread_name_prefix="dtm-fetch") as pool:
+        return list(pool.map(download, tiles))
+
+
+class ExpiringCache:
+    """
+    Values built on demand, and rebuilt once they are older than a time to live, e.g. parsed service capabilities
+    """
+
+    def __init__(self, ttl: float, clock=time.monotonic):
+        """
+        :param ttl: Seconds a value is reused for
+        :param clock: Returns the current time in seconds
+        """
+        self.ttl = ttl
+        self.clock = clock
+
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, factory):
+        """
+        :param key: Identity of the value, e.g. a service URL
+        :param factory: Builds the value, only called when it is missing or expired
+        """
+        with self._lock:
+            if key in self._values:
+                built, value = self._values[key]
+                if self.clock() - built < self.ttl:
+                    return value
+
+            # Hold the lock while building, so concurrent callers share one request
+            value = factory()
+            self._values[key] = (self.clock(), value)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+_default_session: requests.Session = None
+
+
+def default_session() -> requests.Session:
+    """
+    The session shared by every DTM download in the process
+    """
+    global _default_session
+
+    if _default_session is None:
+        _default_session = make_session()
+
+    return _default_session
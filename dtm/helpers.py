@@ -74,14 +74,18 @@ def coord_string(x, y, z):
 
 
 def distmat(a, index, size):
-    # For each item in a
-    # Find the difference on each axis and square it
+    """
+    Euclidean distance of every point in a from index
 
-    distances = np.zeros((size, 1))
-    for i, point in enumerate(a):
-        x, y, z = point
+    :param a: (n, 3) points
+    :param index: The point to measure from
+    :param size: Length of the output, at least n
+    :return: (size, 1) distances, zero past the end of a
+    """
+    a = np.asarray(a, dtype=np.float64).reshape([-1, 3])
 
-        distances[i] = np.sqrt((x - index[0]) ** 2 + (y - index[1]) ** 2 + (z - index[2]) ** 2)
+    distances = np.zeros((int(size), 1))
+    distances[:len(a), 0] = np.linalg.norm(a - np.asarray(index, dtype=np.float64), axis=1)
 
     return distances
 
@@ -7,7 +7,7 @@ class Image:
     campos: (float, float, float)  # [x,y,z]
     camrpy: (float, float, float)  # [r,p,y]
     fov: float
-    # distortion: float  # This comes later
+    distortion: (float, float, float, float, float)  # Brown-Conrady (k1, k2, p1, p2, k3), None for a pinhole lens
 
     height: int
     width: int
@@ -25,6 +25,10 @@ class Image:
         self.height = int(config.get("y_pixels"))
         self.fov = float(config.get("fov"))
 
+        # Optional columns, see dtm.distortion
+        coefficients = tuple(float(config.get(k) or 0) for k in ["k1", "k2", "p1", "p2", "k3"])
+        self.distortion = coefficients if any(coefficients) else None
+
     def rs_matrix(self):
         roll, pitch, yaw = self.camrpy
         fe = lambda a, x: Rotation.from_euler(a, x, degrees=True).as_matrix()
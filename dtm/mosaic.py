@@ -0,0 +1,64 @@
+import uuid
+
+from osgeo import gdal
+
+
+def open_memory_raster(data: bytes, suffix: str = ".tiff") -> gdal.Dataset:
+    """
+    Load a raster file into a GDAL memory file, and open it
+
+    :param data: Raster file contents, e.g. a downloaded TIFF
+    :param suffix: Extension of the memory file
+    """
+    mmap_name = f"/vsimem/{uuid.uuid4().hex}{suffix}"
+    gdal.FileFromMemBuffer(mmap_name, data)
+
+    ds = gdal.Open(mmap_name, gdal.GA_ReadOnly)
+    if ds is None:
+        unlink_memory_files([mmap_name])
+
+    return ds
+
+
+def unlink_memory_files(names: [str]):
+    """
+    Free the GDAL memory files behind a raster, once it is closed, e.g. the names from its GetFileList()
+
+    :param names: File names, any outside of /vsimem are left alone
+    """
+    for name in names:
+        if name.startswith("/vsimem/"):
+            gdal.Unlink(name)
+
+
+def mosaic(tiles: [bytes]) -> gdal.Dataset:
+    """
+    Stitch georeferenced raster tiles into a single dataset
+
+    The tiles are loaded into /vsimem and referenced by a VRT, so nothing is copied or resampled as long as they share
+    a pixel grid, as the tiles from dtm.fetch.split_bbox do. The VRT and the tiles stay in memory until they are
+    unlinked, see DtmType.close.
+
+    :param tiles: Raster file contents of every tile
+    :return: A VRT dataset covering every tile
+    """
+    if len(tiles) == 1:
+        return open_memory_raster(tiles[0])
+
+    names = []
+    for data in tiles:
+        name = f"/vsimem/{uuid.uuid4().hex}.tiff"
+        gdal.FileFromMemBuffer(name, data)
+        names.append(name)
+
+    vrt_name = f"/vsimem/{uuid.uuid4().hex}.vrt"
+    vrt: gdal.Dataset = gdal.BuildVRT(vrt_name, names)
+    if vrt is None:
+        unlink_memory_files(names + [vrt_name])
+        raise ValueError("Could not mosaic the DTM tiles")
+
+    # Write the VRT out, so it can be reopened read only like any other raster
+    vrt.FlushCache()
+    vrt = None
+
+    return gdal.Open(vrt_name, gdal.GA_ReadOnly)
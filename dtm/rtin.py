@@ -0,0 +1,232 @@
+"""
+Adaptive triangulation of height grids, to a maximum vertical error.
+
+This builds a right-triangulated irregular network (RTIN), as described in "Right-Triangulated Irregular Networks"
+(Evans, Kirkpatrick and Townsend) and popularised by the Martini library. Every triangle is split through the midpoint
+of its hypotenuse until linear interpolation across it is within a maximum vertical error of the raster. Errors are
+stored per midpoint and propagated up to coarser levels, so two triangles sharing a hypotenuse always split together
+and the mesh never has cracks.
+
+RTIN needs a square grid of 2^k + 1 pixels. Other rasters are padded, and triangles crossing the edge of the real
+raster are always split, so the mesh covers exactly the raster and nothing else.
+"""
+
+import numpy as np
+
+
+def grid_size(width: int, height: int) -> int:
+    """
+    :return: The smallest RTIN grid size, 2^k + 1, covering a width x height raster
+    """
+    tile = 1
+    while tile < max(width, height) - 1:
+        tile *= 2
+
+    return tile + 1
+
+
+def grid_faces(width: int, height: int) -> np.ndarray:
+    """
+    Build two triangles per cell of a full width x height grid, (a, a + width, a + width + 1) and
+    (a, a + width + 1, a + 1), the mesh DtmType uses when it does not simplify
+
+    :return: (2 * (width - 1) * (height - 1), 3) uint32 array of row major vertex indices
+    """
+    ai = np.arange(0, width - 1, dtype=np.uint32)
+    aj = np.arange(0, height - 1, dtype=np.uint32)
+    a = (ai[None, :] + aj[:, None] * np.uint32(width)).reshape(-1)
+
+    tria = np.empty((a.shape[0], 2, 3), dtype=np.uint32)
+    tria[:, 0, 0] = a
+    tria[:, 0, 1] = a + width
+    tria[:, 0, 2] = a + width + 1
+    tria[:, 1, 0] = a
+    tria[:, 1, 1] = a + width + 1
+    tria[:, 1, 2] = a + 1
+
+    return tria.reshape([-1, 3])
+
+
+def _outside(xs: np.ndarray, ys: np.ndarray, width: int, height: int) -> (np.ndarray, np.ndarray):
+    """
+    Classify triangles against the real raster, [0, width - 1] x [0, height - 1]
+
+    :param xs: (n, 3) column of every corner
+    :param ys: (n, 3) row of every corner
+    :return: Whether each triangle lies fully inside the raster, and whether it crosses the raster edge
+    """
+    inside = (xs.max(axis=1) <= width - 1) & (ys.max(axis=1) <= height - 1)
+    straddles = ~inside & (xs.min(axis=1) < width - 1) & (ys.min(axis=1) < height - 1)
+
+    return inside, straddles
+
+
+def compute_errors(heights: np.ndarray, width: int = None, height: int = None) -> np.ndarray:
+    """
+    Compute the RTIN error of every midpoint of a square height grid
+
+    :param heights: (n, n) heights, where n = 2^k + 1
+    :param width: Width of the real raster inside the grid, triangles crossing it are forced to split
+    :param height: Height of the real raster inside the grid
+    :return: (n, n) error of linearly interpolating across the hypotenuse each pixel is the midpoint of, including
+     the errors of every finer level below it
+    """
+    size = heights.shape[0]
+    tile = size - 1
+    width = size if width is None else width
+    height = size if height is None else height
+
+    h = heights.astype(np.float64)
+    errors = np.zeros((size, size), dtype=np.float64)
+
+    def own_error(mx, my, ax, ay, bx, by, corners):
+        # Interpolation error at the midpoint, forced to inf where any of its triangles crosses the raster edge
+        err = np.abs((h[ay, ax] + h[by, bx]) / 2 - h[my, mx])
+        err[np.isnan(err)] = np.inf
+
+        for cx, cy, exists in corners:
+            xs = np.column_stack((ax, bx, cx))
+            ys = np.column_stack((ay, by, cy))
+            _, straddles = _outside(xs, ys, width, height)
+            err[exists & straddles] = np.inf
+
+        return err
+
+    s = 2
+    while s <= tile:
+        half = s // 2
+        quarter = s // 4
+
+        # Axis aligned hypotenuses of length s, the midpoints of the edges of the s-grid
+        for horizontal in (True, False):
+            if horizontal:
+                my, mx = np.meshgrid(np.arange(0, size, s), np.arange(half, size, s), indexing="ij")
+            else:
+                my, mx = np.meshgrid(np.arange(half, size, s), np.arange(0, size, s), indexing="ij")
+            mx = mx.ravel()
+            my = my.ravel()
+
+            dx, dy = (half, 0) if horizontal else (0, half)
+            ax, ay, bx, by = mx - dx, my - dy, mx + dx, my + dy
+
+            # The right angle corner lies on either side of the hypotenuse
+            corners = []
+            for sign in (-1, 1):
+                cx, cy = mx + sign * dy, my + sign * dx
+                exists = (cx >= 0) & (cx <= tile) & (cy >= 0) & (cy <= tile)
+                corners.append((np.clip(cx, 0, tile), np.clip(cy, 0, tile), exists))
+
+            err = own_error(mx, my, ax, ay, bx, by, corners)
+
+            if quarter > 0:
+                # Children split at the centres of the (s/2)-squares either side
+                for ox in (-quarter, quarter):
+                    for oy in (-quarter, quarter):
+                        cx, cy = mx + ox, my + oy
+                        exists = (cx >= 0) & (cx <= tile) & (cy >= 0) & (cy <= tile)
+                        child = errors[np.clip(cy, 0, tile), np.clip(cx, 0, tile)]
+                        err = np.where(exists, np.maximum(err, child), err)
+
+            errors[my, mx] = err
+
+        # Diagonal hypotenuses of the s-squares, whose direction alternates in a checkerboard
+        j, i = np.meshgrid(np.arange(tile // s), np.arange(tile // s), indexing="ij")
+        i = i.ravel()
+        j = j.ravel()
+        x0 = i * s
+        y0 = j * s
+        mx = x0 + half
+        my = y0 + half
+
+        main = (i + j) % 2 == 0
+        ax = np.where(main, x0, x0 + s)
+        bx = np.where(main, x0 + s, x0)
+        ay = y0
+        by = y0 + s
+
+        always = np.ones(len(mx), dtype=bool)
+        corners = [(np.where(main, x0 + s, x0), y0, always),
+                   (np.where(main, x0, x0 + s), y0 + s, always)]
+
+        err = own_error(mx, my, ax, ay, bx, by, corners)
+
+        # Children split at the midpoints of the square's edges
+        for ox, oy in ((-half, 0), (half, 0), (0, -half), (0, half)):
+            err = np.maximum(err, errors[my + oy, mx + ox])
+
+        errors[my, mx] = err
+
+        s *= 2
+
+    return errors
+
+
+def triangulate(heights: np.ndarray, max_error: float) -> (np.ndarray, np.ndarray):
+    """
+    Triangulate a height raster, splitting triangles until the interpolation error at every hypotenuse midpoint, and
+    every midpoint below it, is within max_error
+
+    As in RTIN, the error is measured at hypotenuse midpoints against the triangle being split, so the error at other
+    pixels can exceed max_error by a fraction of it.
+
+    :param heights: (height, width) raster
+    :param max_error: Maximum vertical error, in the units of heights
+    :return: (n, 2) int (col, row) of every vertex used, and (m, 3) uint32 faces indexing them, wound the same way as
+     DtmType.get_indices
+    """
+    height, width = heights.shape
+    if width < 2 or height < 2:
+        raise ValueError("Heights must be a 2D grid of at least 2x2 pixels")
+
+    size = grid_size(width, height)
+    tile = size - 1
+
+    # Padding only affects triangles that are discarded, or forced to split at the raster edge anyway
+    padded = np.pad(np.asarray(heights, dtype=np.float64), ((0, size - height), (0, size - width)), mode="edge")
+    errors = compute_errors(padded, width, height)
+
+    # The two triangles of the whole tile, as (a, b, c) with the hypotenuse a-b and the right angle at c
+    ax = np.array([0, tile])
+    ay = np.array([0, tile])
+    bx = np.array([tile, 0])
+    by = np.array([tile, 0])
+    cx = np.array([tile, 0])
+    cy = np.array([0, tile])
+
+    faces = []
+    while len(ax) > 0:
+        mx = (ax + bx) // 2
+        my = (ay + by) // 2
+
+        split = (np.abs(ax - cx) + np.abs(ay - cy) > 1) & (errors[my, mx] > max_error)
+
+        done = ~split
+        faces.append(np.column_stack((ax[done], ay[done], bx[done], by[done], cx[done], cy[done])))
+
+        # Split into (c, a, m) and (b, c, m)
+        ax, ay, bx, by, cx, cy = (np.concatenate((cx[split], bx[split])),
+                                  np.concatenate((cy[split], by[split])),
+                                  np.concatenate((ax[split], cx[split])),
+                                  np.concatenate((ay[split], cy[split])),
+                                  np.concatenate((mx[split], mx[split])),
+                                  np.concatenate((my[split], my[split])))
+
+    faces = np.concatenate(faces)
+    xs = faces[:, 0::2]
+    ys = faces[:, 1::2]
+
+    inside, _ = _outside(xs, ys, width, height)
+    xs = xs[inside]
+    ys = ys[inside]
+
+    # Match the winding of DtmType.get_indices, which is clockwise in (col, row)
+    cross = (xs[:, 1] - xs[:, 0]) * (ys[:, 2] - ys[:, 0]) - (ys[:, 1] - ys[:, 0]) * (xs[:, 2] - xs[:, 0])
+    flip = cross > 0
+    xs[flip] = xs[flip][:, [0, 2, 1]]
+    ys[flip] = ys[flip][:, [0, 2, 1]]
+
+    # Only keep the pixels that are used as vertices
+    ids, inverse = np.unique(ys * width + xs, return_inverse=True)
+    pixels = np.column_stack((ids % width, ids // width))
+
+    return pixels, inverse.reshape([-1, 3]).astype(np.uint32)
@@ -0,0 +1,195 @@
+"""
+Per stage timings and counters, exported as JSON lines.
+
+Library code marks its stages with `span` and its work with `count`, which do nothing unless a Recorder is active:
+
+    recorder = Recorder("IMG_0001", profile={"trace"})
+    with recording(recorder):
+        depth, locs = render_depthmap(m_cam, intersector)
+    recorder.write("metrics.jsonl")
+
+The active recorder is process wide rather than per thread, so downloads and traces running on worker threads are
+counted against it too.
+"""
+
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+# Stages of the pipeline, as named in spans
+FETCH = "fetch"
+MESH_BUILD = "mesh_build"
+BVH_BUILD = "bvh_build"
+RAY_GENERATION = "ray_generation"
+TRACE = "trace"
+WRITE = "write"
+
+_active = []
+_lock = threading.RLock()
+_profiling = False
+
+
+def peak_rss() -> int | None:
+    """
+    :return: Peak resident set size of the process in bytes, or None where it can't be measured
+    """
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Recorder:
+    """
+    Collects the span timings and counters of one unit of work, e.g. rendering one image
+    """
+
+    def __init__(self, name: str = None, profile: {str} = (), trace_memory: {str} = (), profile_dir: str = "."):
+        """
+        :param name: Identifies the record, e.g. the image name
+        :param profile: Spans to run under cProfile, the stats are dumped to <profile_dir>/<name>-<span>.prof
+        :param trace_memory: Spans to record the peak Python allocations of, with tracemalloc
+        :param profile_dir: Where to write the cProfile stats
+        """
+        self.name = name
+        self.profile = set(profile)
+        self.trace_memory = set(trace_memory)
+        self.profile_dir = profile_dir
+
+        self.spans = {}
+        self.counters = {}
+        self.fields = {}
+
+    @contextmanager
+    def span(self, name: str):
+        """
+        Time a stage, adding to its total if it runs more than once
+        """
+        global _profiling
+
+        profiler = None
+        with _lock:
+            # Only one cProfile can run at a time
+            if name in self.profile and not _profiling:
+                profiler = cProfile.Profile()
+                _profiling = True
+
+        started_tracing = False
+        if name in self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            tracemalloc.reset_peak()
+
+        if profiler is not None:
+            profiler.enable()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+
+            if profiler is not None:
+                profiler.disable()
+                os.makedirs(self.profile_dir, exist_ok=True)
+                profiler.dump_stats(os.path.join(self.profile_dir, f"{self.name or 'run'}-{name}.prof"))
+                with _lock:
+                    _profiling = False
+
+            if name in self.trace_memory:
+                _, peak = tracemalloc.get_traced_memory()
+                self.count(f"{name}_traced_peak_bytes", peak)
+                if started_tracing:
+                    tracemalloc.stop()
+
+            with _lock:
+                span = self.spans.setdefault(name, {"seconds": 0.0, "calls": 0})
+                span["seconds"] += seconds
+                span["calls"] += 1
+
+    def count(self, name: str, value: int | float = 1):
+        with _lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, **fields):
+        """
+        Attach extra fields to the record, e.g. the image size
+        """
+        self.fields.update(fields)
+
+    def seconds(self, name: str) -> float:
+        return self.spans.get(name, {}).get("seconds", 0.0)
+
+    def to_dict(self) -> dict:
+        """
+        :return: The record, with hit rate and rays/sec derived from the counters, and the peak RSS so far
+        """
+        rays = self.counters.get("rays", 0)
+        hits = self.counters.get("hits", 0)
+        trace = self.seconds(TRACE)
+
+        return {
+            "name": self.name,
+            **self.fields,
+            "spans": self.spans,
+            "counters": self.counters,
+            "hit_rate": hits / rays if rays else None,
+            "rays_per_sec": rays / trace if trace > 0 else None,
+            "peak_rss_bytes": peak_rss(),
+        }
+
+    def write(self, path: str):
+        """
+        Append the record to a JSON lines file
+        """
+        with open(path, "a") as f:
+            f.write(json.dumps(self.to_dict()) + "\n")
+
+
+@contextmanager
+def recording(recorder: Recorder):
+    """
+    Make a recorder the target of span and count until the context exits
+    """
+    with _lock:
+        _active.append(recorder)
+    try:
+        yield recorder
+    finally:
+        with _lock:
+            _active.remove(recorder)
+
+
+def active() -> Recorder | None:
+    with _lock:
+        return _active[-1] if _active else None
+
+
+def span(name: str):
+    """
+    Time a stage against the active recorder, if there is one
+    """
+    recorder = active()
+    return recorder.span(name) if recorder is not None else nullcontext()
+
+
+def count(name: str, value: int | float = 1):
+    """
+    Add to a counter of the active recorder, if there is one
+    """
+    recorder = active()
+    if recorder is not None:
+        recorder.count(name, value)
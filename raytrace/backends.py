@@ -0,0 +1,114 @@
+"""
+Pick a ray/mesh intersector backend at runtime.
+
+Every backend implements the RayMeshIntersector API (intersects_location, intersects_id, intersects_first,
+intersects_first_location and intersects_any), so the pipeline can use whichever is fastest on the machine. The mesh
+backends trace any trimesh, the heightfield backend only the raster grid of a DtmType, see make_dtm_intersector.
+Backends are registered with an importer, so one whose dependencies are missing (e.g. the embree wrapper) is skipped
+rather than failing at import time.
+
+The DEPTHMAP_RAY_BACKEND environment variable forces a backend by name.
+"""
+
+import importlib
+import os
+
+_backends = {}
+
+
+def register_backend(name: str, module: str, priority: int, attr: str = "RayMeshIntersector", meshes: bool = True):
+    """
+    Register an intersector backend
+
+    :param name: Name to select the backend by
+    :param module: Module holding the intersector class, only imported when the backend is first used
+    :param priority: Higher priority backends are preferred, when available
+    :param attr: Name of the intersector class in the module
+    :param meshes: Whether the backend traces any trimesh, rather than only DtmTypes through a from_dtm factory
+    """
+    _backends[name] = {"module": module, "attr": attr, "priority": priority, "meshes": meshes}
+
+
+def _load(name: str):
+    backend = _backends[name]
+    if "cls" not in backend:
+        try:
+            backend["cls"] = getattr(importlib.import_module(backend["module"]), backend["attr"])
+        except ImportError as e:
+            backend["cls"] = None
+            backend["error"] = e
+
+    return backend["cls"]
+
+
+def available_backends(meshes: bool = False) -> [str]:
+    """
+    :param meshes: Only list the backends that trace any trimesh
+    :return: Names of every backend that can be imported, fastest first
+    """
+    names = sorted(_backends, key=lambda n: _backends[n]["priority"], reverse=True)
+    return [n for n in names if _load(n) is not None and (_backends[n]["meshes"] or not meshes)]
+
+
+def get_backend(name: str = None, meshes: bool = False):
+    """
+    :param name: Backend to use, defaults to DEPTHMAP_RAY_BACKEND or else the fastest available
+    :param meshes: The backend has to trace any trimesh
+    :return: The intersector class of the backend
+    """
+    name = name or os.environ.get("DEPTHMAP_RAY_BACKEND")
+
+    if name is None:
+        available = available_backends(meshes)
+        if not available:
+            raise ImportError("No ray intersector backend is available")
+        return _load(available[0])
+
+    if name not in _backends:
+        raise ValueError(f"Unknown ray intersector backend {name}, expected one of {sorted(_backends)}")
+
+    if meshes and not _backends[name]["meshes"]:
+        raise ValueError(f"Ray intersector backend {name} only traces DtmTypes, see make_dtm_intersector")
+
+    cls = _load(name)
+    if cls is None:
+        raise ImportError(f"Ray intersector backend {name} is not available: {_backends[name]['error']}")
+
+    return cls
+
+
+def make_intersector(mesh, backend: str = None, **kwargs):
+    """
+    Build an intersector over a mesh
+
+    :param mesh: Trimesh to trace against
+    :param backend: Backend name, see get_backend
+    :param kwargs: Passed on to the intersector, e.g. scene_key and workers
+    """
+    return get_backend(backend, meshes=True)(mesh, **kwargs)
+
+
+def make_dtm_intersector(dtm, backend: str = None, **kwargs):
+    """
+    Build an intersector over the terrain of a DtmType
+
+    Backends with a from_dtm factory build straight from the DTM, e.g. Embree from its float32 mesh_arrays and the
+    heightfield from its raster, the rest get its trimesh, keyed by the DTM's tile_id unless a scene_key is given.
+
+    :param dtm: DtmType to trace against
+    :param backend: Backend name, see get_backend
+    :param kwargs: Passed on to the intersector, e.g. workers
+    """
+    cls = get_backend(backend)
+
+    if hasattr(cls, "from_dtm"):
+        return cls.from_dtm(dtm, **kwargs)
+
+    kwargs.setdefault("scene_key", dtm.tile_id)
+    return cls(dtm.trimesh, **kwargs)
+
+
+register_backend("embree", "raytrace.embreeintersector", priority=100)
+register_backend("numpy", "raytrace.numpyintersector", priority=10)
+register_backend("heightfield", "raytrace.heightfieldintersector", priority=5, attr="HeightfieldIntersector",
+                 meshes=False)
@@ -0,0 +1,260 @@
+"""
+Cull rays that can't hit the terrain before they are traced.
+
+Oblique images have many pixels above the horizon, or looking out
+past the edge of the DTM, and every one of them would otherwise
+go all the way through the scene just to come back as a miss.
+TerrainBounds keeps the bounding box of the terrain and the
+highest point of the terrain in each cell of a coarse grid over
+it. Rays are clipped to the box, then walked through the grid
+(a 2D DDA) until they reach a cell where they dip below its
+highest point. Rays that never do provably miss, and the rest
+only need to be traced from that cell to where they leave the
+box, which Embree takes as each ray's tnear and tfar.
+"""
+
+import numpy as np
+
+import instrument
+
+# cells of the coarse grid along the longer side of the terrain
+_grid_cells = 32
+# faces binned into the grid at once, to bound the temporaries
+_face_chunk_size = 1 << 20
+# slack on the clipped distances, so float32 scenes never lose a hit
+_t_slack = 1e-3
+
+# columns of the per ray state of the DDA in TerrainBounds.clip
+_RAY, _Z, _DZ, _T, _T_END = range(5)
+_T_NEXT = np.array([5, 6])
+_T_DELTA = np.array([7, 8])
+_CELL = np.array([9, 10])
+_STEP = np.array([11, 12])
+_STATE_COLUMNS = 13
+
+
+class TerrainBounds(object):
+
+    def __init__(self, lower, upper, cell_max):
+        """
+        Conservative bounds of a terrain mesh.
+
+        Parameters
+        -------------
+        lower : (3,) float
+          Lowest corner of the terrain's bounding box
+        upper : (3,) float
+          Highest corner of the terrain's bounding box
+        cell_max : (rows, cols) float
+          Highest point of every face touching each cell of a
+          grid over the box, row 0 at lower y, -inf for cells
+          with no faces
+        """
+        self.lower = np.asarray(lower, dtype=np.float64)
+        self.upper = np.asarray(upper, dtype=np.float64)
+        self.cell_max = np.asarray(cell_max, dtype=np.float64)
+
+        rows, cols = self.cell_max.shape
+        self.cell_size = np.maximum((self.upper[:2] - self.lower[:2]) / [cols, rows], 1e-9)
+
+    @classmethod
+    def from_mesh(cls, vertices, faces, cells=_grid_cells):
+        """
+        Bound a mesh, e.g. the mesh of a DtmType.
+
+        Parameters
+        -------------
+        vertices : (n, 3) float
+          Vertices of the mesh
+        faces : (m, 3) int
+          Triangles of the mesh
+        cells : int
+          Cells of the grid along the longer side of the mesh
+
+        Returns
+        -------------
+        bounds : TerrainBounds
+        """
+        vertices = np.asanyarray(vertices, dtype=np.float64)
+        faces = np.asanyarray(faces, dtype=np.int64)
+
+        if len(faces) == 0:
+            return cls(np.zeros(3), np.zeros(3), np.full((1, 1), -np.inf))
+
+        used = vertices[np.unique(faces)]
+        lower = used.min(axis=0)
+        upper = used.max(axis=0)
+
+        extent = upper[:2] - lower[:2]
+        shape = np.maximum(np.ceil(cells * extent / max(extent.max(), 1e-9)), 1).astype(np.int64)
+        cols, rows = shape
+        cell_size = np.maximum(extent / shape, 1e-9)
+
+        cell_max = np.full(rows * cols, -np.inf)
+        for start in range(0, len(faces), _face_chunk_size):
+            tri = vertices[faces[start:start + _face_chunk_size]]
+
+            # every cell the xy bounds of a face overlap, boundaries included
+            first = np.clip(np.floor((tri[:, :, :2].min(axis=1) - lower[:2]) / cell_size), 0, shape - 1)
+            last = np.clip(np.floor((tri[:, :, :2].max(axis=1) - lower[:2]) / cell_size), 0, shape - 1)
+            first = first.astype(np.int64)
+            span = last.astype(np.int64) - first + 1
+
+            count = span[:, 0] * span[:, 1]
+            face = np.repeat(np.arange(len(tri)), count)
+            k = np.arange(len(face)) - np.repeat(np.cumsum(count) - count, count)
+            col = first[face, 0] + k % span[face, 0]
+            row = first[face, 1] + k // span[face, 0]
+
+            np.maximum.at(cell_max, row * cols + col, tri[face, :, 2].max(axis=1))
+
+        return cls(lower, upper, cell_max.reshape([rows, cols]))
+
+    @property
+    def nbytes(self):
+        return self.cell_max.nbytes
+
+    def clip(self, origins, directions):
+        """
+        Find the part of every ray that could hit the terrain.
+
+        Parameters
+        ----------
+        origins : (n, 3) float
+          Origins of rays
+        directions : (n, 3) float
+          Unit direction of rays
+
+        Returns
+        ---------
+        t_near : (n,) float
+          Distance along each ray the terrain could first be hit at
+        t_far : (n,) float
+          Distance at which each ray leaves the terrain's box,
+          less than t_near for rays that provably miss
+        """
+        origins = np.asanyarray(origins, dtype=np.float64)
+        directions = np.asanyarray(directions, dtype=np.float64)
+
+        t_near = np.full(len(origins), np.inf)
+        t_far = np.full(len(origins), -np.inf)
+
+        t_enter, t_exit = clip_to_box(origins, directions, self.lower, self.upper)
+        ray = np.nonzero(t_enter <= t_exit)[0]
+
+        rows, cols = self.cell_max.shape
+        t = t_enter[ray]
+
+        # one row per ray, so each step compacts a single array. In grid space
+        # cell (col, row) spans [col, col + 1) x [row, row + 1)
+        state = np.empty((len(ray), _STATE_COLUMNS))
+        state[:, _RAY] = ray
+        state[:, _Z] = origins[ray, 2]
+        state[:, _DZ] = directions[ray, 2]
+        state[:, _T] = t
+        state[:, _T_END] = t_exit[ray]
+
+        o = (origins[ray, :2] - self.lower[:2]) / self.cell_size
+        d = directions[ray, :2] / self.cell_size
+        cell = np.clip(np.floor(o + d * t[:, None]), 0, [cols - 1, rows - 1])
+        step = np.sign(d)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t_next = np.where(step > 0, (cell + 1 - o) / d, (cell - o) / d)
+            state[:, _T_DELTA] = np.abs(1.0 / d)
+        t_next[step == 0] = np.inf
+        state[:, _T_NEXT] = t_next
+        state[:, _CELL] = cell
+        state[:, _STEP] = step
+
+        while len(state):
+            t_leave = np.minimum(state[:, _T_NEXT].min(axis=1), state[:, _T_END])
+
+            # the ray is lowest at one end of its span in the cell
+            dz = state[:, _DZ]
+            z_low = state[:, _Z] + dz * np.where(dz < 0, t_leave, state[:, _T])
+            cell = state[:, _CELL].astype(np.int64)
+            reached = z_low <= self.cell_max[cell[:, 1], cell[:, 0]]
+
+            done = state[reached, _RAY].astype(np.int64)
+            t_near[done] = state[reached, _T]
+            t_far[done] = state[reached, _T_END]
+
+            # step into the neighbouring cell across the nearer boundary
+            state[:, _T] = t_leave
+            axis = np.argmin(state[:, _T_NEXT], axis=1)
+            moved = np.arange(len(state))
+            state[moved, _CELL[axis]] += state[moved, _STEP[axis]]
+            state[moved, _T_NEXT[axis]] += state[moved, _T_DELTA[axis]]
+
+            cell = state[:, _CELL]
+            going = ~reached & (t_leave < state[:, _T_END]) & \
+                (cell >= 0).all(axis=1) & (cell < [cols, rows]).all(axis=1)
+            state = state[going]
+
+        live = t_near <= t_far
+        t_near[live] = np.maximum(t_near[live] - _t_slack * (1 + t_near[live]), 0)
+        t_far[live] += _t_slack * (1 + t_far[live])
+
+        return t_near, t_far
+
+
+def clip_to_box(origins, directions, lower, upper):
+    """
+    Clip rays against an axis aligned box.
+
+    Returns
+    ---------
+    t_enter : (n,) float
+      Distance at which each ray enters the box
+    t_exit : (n,) float
+      Distance at which each ray leaves the box, less than
+      t_enter when the ray misses, NaN bounds never hit
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        inverse = 1.0 / directions
+        t_a = (lower - origins) * inverse
+        t_b = (upper - origins) * inverse
+
+    t_near = np.fmin(t_a, t_b)
+    t_far = np.fmax(t_a, t_b)
+
+    # an axis the ray is parallel to either always or never contains it
+    parallel = directions == 0
+    inside = (origins >= lower) & (origins <= upper)
+    t_near[parallel] = np.where(inside[parallel], -np.inf, np.inf)
+    t_far[parallel] = np.where(inside[parallel], np.inf, -np.inf)
+
+    t_enter = np.maximum(t_near.max(axis=1), 0.0)
+    t_exit = t_far.min(axis=1)
+    return t_enter, t_exit
+
+
+def cull_rays(bounds, origins, directions):
+    """
+    Drop the rays that provably miss a terrain, counting them
+    as `culled_rays` in the active instrument recorder.
+
+    Parameters
+    ----------
+    bounds : TerrainBounds
+      Bounds of the terrain
+    origins : (n, 3) float
+      Origins of rays
+    directions : (n, 3) float
+      Direction (vector) of rays
+
+    Returns
+    ---------
+    live : (m,) int
+      Ascending indexes of the rays left to trace
+    tnear : (m,) float
+      Distance along each live ray to start tracing from
+    tfar : (m,) float
+      Distance along each live ray to stop tracing at
+    """
+    t_near, t_far = bounds.clip(origins, directions)
+    live = np.nonzero(t_near <= t_far)[0]
+
+    instrument.count("culled_rays", len(origins) - len(live))
+
+    return live, t_near[live], t_far[live]
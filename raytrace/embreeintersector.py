@@ -3,16 +3,20 @@ Ray queries using the pyembree package with the
 API wrapped to match our native raytracer.
 """
 
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 
 import embree
 import numpy as np
-from trimesh import caching
 from trimesh import intersections
 from trimesh import util
-from trimesh.constants import log_time
 from trimesh.ray.ray_util import contains_points
 
+import instrument
+from raytrace.culling import TerrainBounds, cull_rays
+from raytrace.scenecache import default_registry
+
 # the factor of geometry.scale to offset a ray from a triangle
 # to reliably not hit its origin triangle
 _ray_offset_factor = 1e-4
@@ -24,12 +28,54 @@ _embree_new = True
 # both old and new versions require exact but different type
 _embree_dtype = [np.float64, np.float32][int(_embree_new)]
 
+# approximate size of the BVH Embree builds, per triangle
+_bvh_bytes_per_face = 64
+
+# rays per intersect1M call when tracing on several threads
+_ray_chunk_size = 1 << 16
+
+# thread pools shared by every scene, keyed by worker count
+_pools = {}
+_pools_lock = threading.Lock()
+
+# the Embree device every scene is built on, Embree recommends
+# one per application, and tiled terrain makes many scenes
+_device = None
+_device_lock = threading.Lock()
+
+
+def _thread_pool(workers):
+    """
+    Get the shared thread pool with a number of workers.
+    """
+    with _pools_lock:
+        if workers not in _pools:
+            _pools[workers] = ThreadPoolExecutor(
+                max_workers=workers,
+                thread_name_prefix=f"embree-{workers}")
+        return _pools[workers]
+
+
+def _shared_device():
+    """
+    Get the Embree device shared by every scene.
+    """
+    global _device
+    with _device_lock:
+        if _device is None:
+            _device = embree.Device()
+        return _device
+
 
 class RayMeshIntersector(object):
 
     def __init__(self,
                  geometry,
-                 scale_to_box=True):
+                 scale_to_box=True,
+                 scene_key=None,
+                 registry=None,
+                 workers=1,
+                 cull=True):
         """
         Do ray- mesh queries.
 
@@ -41,10 +87,63 @@ class RayMeshIntersector(object):
           If true, will scale mesh to approximate
           unit cube to avoid problems with extreme
           large or small meshes.
+        scene_key : hashable or None
+          Identity of the mesh in the scene registry,
+          e.g. DtmType.tile_id, defaults to a hash of the mesh
+        registry : SceneRegistry or None
+          Where committed scenes are shared, defaults
+          to the process wide registry
+        workers : int
+          Threads to trace each batch of rays on. This only
+          helps if the embree wrapper releases the GIL inside
+          intersect1M, check with benchmarks/trace_scaling.py
+        cull : bool
+          Don't trace first hit queries of rays that provably
+          miss the terrain, and clip the rest to where they
+          could hit it, see `raytrace.culling`
         """
-        self.mesh = geometry
+        self._mesh = geometry
+        self._dtm = None
         self._scale_to_box = scale_to_box
-        self._cache = caching.Cache(id_function=self.mesh.crc)
+        self._scene_key = scene_key
+        self._registry = registry if registry is not None else default_registry()
+        self.workers = workers
+        self.cull = cull
+
+    @classmethod
+    def from_dtm(cls, dtm, **kwargs):
+        """
+        Create an intersector over the mesh of a DtmType.
+
+        The scene is built straight from the float32 / uint32
+        `mesh_arrays`, relative to the DTM's origin, and rays
+        are moved into that frame before they are traced. The
+        float64 trimesh is only built if a query needs it.
+
+        Parameters
+        -------------
+        dtm : DtmType
+          Terrain to do ray tests on
+        kwargs
+          Passed on to the constructor, e.g. workers
+
+        Returns
+        -------------
+        intersector : RayMeshIntersector
+        """
+        kwargs.setdefault("scene_key", dtm.tile_id)
+        intersector = cls(None, **kwargs)
+        intersector._dtm = dtm
+        return intersector
+
+    @property
+    def mesh(self):
+        """
+        The trimesh traced against, absolute coordinates.
+        """
+        if self._mesh is None and self._dtm is not None:
+            self._mesh = self._dtm.trimesh
+        return self._mesh
 
     @property
     def _scale(self):
@@ -59,14 +158,72 @@ class RayMeshIntersector(object):
             scale = 1.0
         return scale
 
-    @caching.cache_decorator
+    @property
+    def scene_key(self):
+        """
+        Key of this mesh's scene in the registry.
+        """
+        if self._scene_key is not None:
+            return self._scene_key
+        return "hash", hash(self.mesh)
+
+    def _build_scene(self):
+        if self._dtm is not None:
+            # meshed outside of the BVH span, which it is timed apart from
+            vertices, faces = self._dtm.mesh_arrays
+            origin = self._dtm.origin
+        else:
+            vertices, faces = self.mesh.vertices, self.mesh.faces
+            origin = None
+
+        with instrument.span(instrument.BVH_BUILD):
+            return _EmbreeWrap(vertices=vertices,
+                               faces=faces,
+                               scale=self._scale,
+                               origin=origin)
+
     def _scene(self):
         """
-        A cached version of the pyembree scene.
+        Borrow the committed pyembree scene from the registry,
+        building it if no intersector on this mesh has yet.
         """
-        return _EmbreeWrap(vertices=self.mesh.vertices,
-                           faces=self.mesh.faces,
-                           scale=self._scale)
+        return self._registry.scene(self.scene_key, self._build_scene)
+
+    def build_scene(self):
+        """
+        Build the pyembree scene now rather than on the first query,
+        so its build is timed apart from the rays. Does nothing
+        if it is already in the registry.
+        """
+        with self._scene():
+            pass
+
+    def _run_first(self, scene, ray_origins, ray_directions):
+        """
+        Find the first hit of every ray, only sending embree
+        the rays the scene's bounds don't cull.
+
+        Returns
+        ---------
+        prim_id : (n,) int
+          Triangle hit by each ray, INVALID_GEOMETRY_ID on a miss
+        tfar : (n,) float
+          Distance along each ray to the hit
+        """
+        if not self.cull:
+            return scene.run(ray_origins, ray_directions, workers=self.workers)
+
+        live, tnear, tfar = cull_rays(scene.bounds, ray_origins, ray_directions)
+
+        prim_id = np.full(len(ray_origins), embree.INVALID_GEOMETRY_ID, dtype=np.uint32)
+        distances = np.full(len(ray_origins), np.inf, dtype=np.float32)
+        if len(live):
+            prim_id[live], distances[live] = scene.run(ray_origins[live],
+                                                       ray_directions[live],
+                                                       workers=self.workers,
+                                                       tnear=tnear,
+                                                       tfar=tfar)
+        return prim_id, distances
 
     def intersects_location(self,
                             ray_origins,
@@ -104,7 +261,6 @@ class RayMeshIntersector(object):
 
         return locations, distances, index_ray, index_tri
 
-    @log_time
     def intersects_id(self,
                       ray_origins,
                       ray_directions,
@@ -139,6 +295,19 @@ class RayMeshIntersector(object):
         locations : (m) sequence of (p, 3) float
           Intersection points, only returned if return_locations
         """
+        if not multiple_hits:
+            # embree already gives the distance to the first hit,
+            # so skip re-intersecting the planes of the hit faces
+            locations, distances, first = self.intersects_first_location(
+                ray_origins, ray_directions)
+            index_ray = np.nonzero(first != -1)[0]
+            index_tri = first[index_ray]
+            distances = distances.astype(np.float64)
+
+            if return_locations:
+                return index_tri, index_ray, locations[index_ray], distances
+            return index_tri, index_ray, distances
+
         # make sure input is _dtype for embree
         ray_origins = np.asanyarray(
             deepcopy(ray_origins),
@@ -168,68 +337,70 @@ class RayMeshIntersector(object):
             plane_origins = self.mesh.triangles[:, 0, :]
             plane_normals = self.mesh.face_normals
 
-        # use a for loop rather than a while to ensure this exits
-        # if a ray is offset from a triangle and then is reported
-        # hitting itself this could get stuck on that one triangle
-        for query_depth in range(max_hits):
-            # run the pyembree query
-            # if you set output=1 it will calculate distance along
-            # ray, which is bizzarely slower than our calculation
-
-            query, distances = self._scene.run(
-                ray_origins[current],
-                ray_directions[current])  # type: np.ndarray
-
-            # basically we need to reduce the rays to the ones that hit
-            # something
-            hit = query < len(self.mesh.faces)
-            # which triangle indexes were hit
-            hit_triangle = query[hit]
-            # eliminate rays that didn't hit anything from future queries
-            current_index = np.nonzero(current)[0]
-            current_index_no_hit = current_index[np.logical_not(hit)]
-            current_index_hit = current_index[hit]
-            current[current_index_no_hit] = False
-
-            # append the triangle and ray index to the results
-            result_triangle.append(hit_triangle)
-            result_ray_idx.append(current_index_hit)
-            result_distances.append(distances)
-
-            # if we don't need all of the hits, return the first one
-            if ((not multiple_hits and
-                 not return_locations) or
-                    not hit.any()):
-                break
-
-            # find the location of where the ray hit the triangle plane
-            new_origins, valid = intersections.planes_lines(
-                plane_origins=plane_origins[hit_triangle],
-                plane_normals=plane_normals[hit_triangle],
-                line_origins=ray_origins[current],
-                line_directions=ray_directions[current])
-
-            if not valid.all():
-                # since a plane intersection was invalid we have to go back and
-                # fix some stuff, we pop the ray index and triangle index,
-                # apply the valid mask then append it right back to keep our
-                # indexes intact
-                result_ray_idx.append(result_ray_idx.pop()[valid])
-                result_triangle.append(result_triangle.pop()[valid])
-
-                # update the current rays to reflect that we couldn't find a
-                # new origin
-                current[current_index_hit[np.logical_not(valid)]] = False
-
-            # since we had to find the intersection point anyway we save it
-            # even if we're not going to return it
-            result_locations.extend(new_origins)
-
-            if multiple_hits:
-                # move the ray origin to the other side of the triangle
-                ray_origins[current] = new_origins + ray_offsets[current]
-            else:
-                break
+        with self._scene() as scene:
+            # use a for loop rather than a while to ensure this exits
+            # if a ray is offset from a triangle and then is reported
+            # hitting itself this could get stuck on that one triangle
+            for query_depth in range(max_hits):
+                # run the pyembree query
+                # if you set output=1 it will calculate distance along
+                # ray, which is bizzarely slower than our calculation
+
+                query, distances = scene.run(
+                    ray_origins[current],
+                    ray_directions[current],
+                    workers=self.workers)  # type: np.ndarray
+
+                # basically we need to reduce the rays to the ones that hit
+                # something
+                hit = query < len(self.mesh.faces)
+                # which triangle indexes were hit
+                hit_triangle = query[hit]
+                # eliminate rays that didn't hit anything from future queries
+                current_index = np.nonzero(current)[0]
+                current_index_no_hit = current_index[np.logical_not(hit)]
+                current_index_hit = current_index[hit]
+                current[current_index_no_hit] = False
+
+                # append the triangle and ray index to the results
+                result_triangle.append(hit_triangle)
+                result_ray_idx.append(current_index_hit)
+                result_distances.append(distances)
+
+                # if we don't need all of the hits, return the first one
+                if ((not multiple_hits and
+                     not return_locations) or
+                        not hit.any()):
+                    break
+
+                # find the location of where the ray hit the triangle plane
+                new_origins, valid = intersections.planes_lines(
+                    plane_origins=plane_origins[hit_triangle],
+                    plane_normals=plane_normals[hit_triangle],
+                    line_origins=ray_origins[current],
+                    line_directions=ray_directions[current])
+
+                if not valid.all():
+                    # since a plane intersection was invalid we have to go back and
+                    # fix some stuff, we pop the ray index and triangle index,
+                    # apply the valid mask then append it right back to keep our
+                    # indexes intact
+                    result_ray_idx.append(result_ray_idx.pop()[valid])
+                    result_triangle.append(result_triangle.pop()[valid])
+
+                    # update the current rays to reflect that we couldn't find a
+                    # new origin
+                    current[current_index_hit[np.logical_not(valid)]] = False
+
+                # since we had to find the intersection point anyway we save it
+                # even if we're not going to return it
+                result_locations.extend(new_origins)
+
+                if multiple_hits:
+                    # move the ray origin to the other side of the triangle
+                    ray_origins[current] = new_origins + ray_offsets[current]
+                else:
+                    break
 
         # stack the deques into nice 1D numpy arrays
         index_tri = np.hstack(result_triangle)
@@ -244,7 +415,53 @@ class RayMeshIntersector(object):
             return index_tri, index_ray, locations, distances
         return index_tri, index_ray, distances
 
-    @log_time
+    def intersects_first_location(self,
+                                  ray_origins,
+                                  ray_directions):
+        """
+        Find the first hit of every ray, aligned to the rays.
+
+        Locations are origin + direction * tfar, straight from
+        the embree hit, and misses are left in place rather than
+        compacted away, so per ray results reshape into an image.
+
+        Parameters
+        ----------
+        ray_origins : (n, 3) float
+          Origins of rays
+        ray_directions : (n, 3) float
+          Direction (vector) of rays
+
+        Returns
+        ---------
+        locations : (n, 3) float
+          First hit of each ray, NaN on a miss
+        distances : (n,) float32
+          Distance along each ray to its hit, inf on a miss
+        triangle_index : (n,) int
+          Index of triangle ray hit, or -1 if not hit
+        """
+        ray_origins = np.asanyarray(ray_origins, dtype=np.float64)
+        ray_directions = util.unitize(np.asanyarray(ray_directions,
+                                                    dtype=np.float64))
+
+        with self._scene() as scene:
+            prim_id, tfar = self._run_first(scene, ray_origins, ray_directions)
+
+        miss = prim_id == embree.INVALID_GEOMETRY_ID
+
+        triangle_index = np.asarray(prim_id, dtype=np.int64)
+        triangle_index[miss] = -1
+
+        distances = np.asarray(tfar, dtype=np.float32)
+        distances[miss] = np.inf
+
+        locations = np.multiply(ray_directions, distances[:, None])
+        locations += ray_origins
+        locations[miss] = np.nan
+
+        return locations, distances, triangle_index
+
     def intersects_first(self,
                          ray_origins,
                          ray_directions):
@@ -267,8 +484,12 @@ class RayMeshIntersector(object):
         ray_origins = np.asanyarray(deepcopy(ray_origins))
         ray_directions = np.asanyarray(ray_directions)
 
-        triangle_index = self._scene.run(ray_origins,
-                                         ray_directions)
+        with self._scene() as scene:
+            triangle_index, _ = self._run_first(scene, ray_origins, ray_directions)
+
+        # embree marks misses with an unsigned sentinel
+        triangle_index = np.asarray(triangle_index, dtype=np.int64)
+        triangle_index[triangle_index == embree.INVALID_GEOMETRY_ID] = -1
         return triangle_index
 
     def intersects_any(self,
@@ -319,18 +540,22 @@ class _EmbreeWrap(object):
     A light wrapper for PyEmbree scene objects which
     allows queries to be scaled to help with precision
     issues, as well as selecting the correct dtypes.
+
+    Vertices may be relative to an origin, e.g. DtmType.origin,
+    so that float32 keeps their precision far from zero. Rays
+    are moved by -origin before they are traced, distances
+    don't change.
     """
 
-    def __init__(self, vertices: np.ndarray, faces: np.ndarray, scale):
+    def __init__(self, vertices: np.ndarray, faces: np.ndarray, scale, origin=None):
         self.verts = vertices
         self.faces = faces
-        scaled = np.array(vertices,
-                          dtype=np.float64)
+        self.origin = np.zeros(3) if origin is None else np.asarray(origin, dtype=np.float64)
         # self.origin = np.amin(scaled)
         # self.scale = float(scale)
         # scaled = (scaled - self.origin) * self.scale
 
-        self.device = embree.Device()
+        self.device = _shared_device()
 
         self.scene = self.device.make_scene()  # type: embree.Scene
         # assign the geometry to the scene
@@ -354,15 +579,71 @@ class _EmbreeWrap(object):
 
         self.scene.commit()
 
-    def run(self, origins, normals):
+        # coarse bounds to cull rays with before they are traced,
+        # in the same frame as the rays
+        self.bounds = TerrainBounds.from_mesh(np.asarray(vertices, dtype=np.float64) + self.origin, faces)
+
+    def run(self, origins, normals, workers=1, chunk_size=_ray_chunk_size, tnear=None, tfar=None):
+        """
+        Intersect rays with the scene.
+
+        Parameters
+        ----------
+        origins : (n, 3) float
+          Origins of rays, in the same frame as the mesh
+          before it was moved to the origin
+        normals : (n, 3) float
+          Unit direction of rays
+        workers : int
+          Threads to traverse the scene with, the rays are
+          split into chunks of chunk_size that are traced
+          concurrently against the shared committed scene
+        chunk_size : int
+          Rays per chunk when tracing on several threads
+        tnear : (n,) float or None
+          Only report hits from this distance along each ray
+        tfar : (n,) float or None
+          Only report hits up to this distance along each ray,
+          it is left as it is on a miss
+
+        Returns
+        ---------
+        prim_id : (n,) int
+          Triangle hit by each ray, INVALID_GEOMETRY_ID on a miss
+        tfar : (n,) float
+          Distance along each ray to the hit, the given tfar
+          (inf by default) on a miss
+        """
+        origins = np.subtract(origins, self.origin)
+        ray_count = origins.shape[0]
+        if tnear is None:
+            tnear = np.zeros(ray_count)
+        if tfar is None:
+            tfar = np.full(ray_count, np.inf)
+
+        if workers <= 1 or ray_count <= chunk_size:
+            return self._run_chunk(origins, normals, tnear, tfar)
+
+        chunks = [(start, min(start + chunk_size, ray_count))
+                  for start in range(0, ray_count, chunk_size)]
+        results = list(_thread_pool(workers).map(
+            lambda c: self._run_chunk(origins[c[0]:c[1]], normals[c[0]:c[1]],
+                                      tnear[c[0]:c[1]], tfar[c[0]:c[1]]),
+            chunks))
+
+        # chunks come back in order, so the result matches a serial run
+        return (np.concatenate([r[0] for r in results]),
+                np.concatenate([r[1] for r in results]))
+
+    def _run_chunk(self, origins, normals, tnear, tfar):
         # scaled = (np.array(origins,
         #                    dtype=np.float64) - self.origin) * self.scale
         ray_count = origins.shape[0]
 
         rh = embree.RayHit1M(ray_count)
 
-        rh.tnear[:] = 0
-        rh.tfar[:] = np.inf
+        rh.tnear[:] = tnear
+        rh.tfar[:] = tfar
         rh.time[:] = 0
         rh.prim_id[:] = embree.INVALID_GEOMETRY_ID
         rh.geom_id[:] = embree.INVALID_GEOMETRY_ID
@@ -377,9 +658,23 @@ class _EmbreeWrap(object):
 
         return rh.prim_id, rh.tfar
 
-    def close(self):
-        self.scene.release()
-        self.device.release()
+    @property
+    def nbytes(self):
+        """
+        Rough memory use of the committed scene, the vertex
+        and index buffers plus the BVH built over them.
+        """
+        return (len(self.verts) * 3 * np.dtype('float32').itemsize +
+                len(self.faces) * (3 * np.dtype('uint32').itemsize + _bvh_bytes_per_face) +
+                self.bounds.nbytes)
 
-    def __del__(self):
-        self.close()
+    def close(self):
+        """
+        Release the Embree scene, the shared device is kept.
+        Scenes are closed by the SceneRegistry when they are
+        evicted.
+        """
+        if self.scene is not None:
+            self.scene.release()
+            self.scene = None
+        self.device = None
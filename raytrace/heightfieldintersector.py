@@ -0,0 +1,508 @@
+"""
+Ray queries directly against a regular height grid.
+
+Rays are marched cell by cell over the raster with a 2D DDA and
+tested against the same two triangles per cell that
+`DtmType.get_indices` emits, so no triangle list or BVH has to be
+built before casting rays.
+"""
+
+from dataclasses import astuple
+
+import numpy as np
+from trimesh import util
+
+from raytrace.triangles import ray_triangle
+
+
+class HeightfieldIntersector(object):
+
+    def __init__(self,
+                 heights,
+                 geo_transform,
+                 nodata=None):
+        """
+        Do ray- heightfield queries.
+
+        Parameters
+        -------------
+        heights : (h, w) float
+          Elevation of every raster pixel
+        geo_transform : (6,) float
+          GDAL geo-transform of the raster, as returned
+          by `gdal.Dataset.GetGeoTransform`
+        nodata : float or None
+          Value marking missing elevations, these cells
+          will never be hit
+        """
+        x_top_left, x_pixel_size, row_rot, y_top_left, col_rot, y_pixel_size = geo_transform
+        if row_rot != 0 or col_rot != 0:
+            raise ValueError("Rotated rasters are not supported")
+
+        heights = np.array(heights, dtype=np.float64)
+        if nodata is not None:
+            heights[heights == nodata] = np.nan
+
+        if heights.ndim != 2 or min(heights.shape) < 2:
+            raise ValueError("Heights must be a 2D grid of at least 2x2 pixels")
+
+        self.heights = heights
+        self.origin = np.array([x_top_left, y_top_left], dtype=np.float64)
+        self.pixel_size = np.array([x_pixel_size, y_pixel_size], dtype=np.float64)
+
+        # maximum elevation of each cell, used to skip triangle
+        # tests while a ray is still above the terrain
+        self._cell_max = np.fmax(np.fmax(heights[:-1, :-1], heights[1:, :-1]),
+                                 np.fmax(heights[:-1, 1:], heights[1:, 1:]))
+
+        self._dtm = None
+        self._mesh = None
+
+        self.z_min = np.nanmin(heights) if not np.isnan(heights).all() else np.nan
+        self.z_max = np.nanmax(heights) if not np.isnan(heights).all() else np.nan
+
+    @classmethod
+    def from_dtm(cls, dtm, **kwargs):
+        """
+        Create an intersector from the first band of a DtmType raster,
+        limited to its raster window.
+
+        Parameters
+        -------------
+        dtm : DtmType
+          Terrain to do ray tests on, with the full resolution
+          mesh, as the grid is traced as it is
+        kwargs
+          Options of the mesh backends, e.g. scene_key, registry
+          and workers, see `raytrace.backends.make_dtm_intersector`.
+          There is no scene to share, and rays are marched on the
+          calling thread, so they are ignored
+
+        Returns
+        -------------
+        intersector : HeightfieldIntersector
+        """
+        if dtm.max_error is not None:
+            raise ValueError("The heightfield intersector traces the full resolution grid, not a simplified mesh")
+
+        intersector = cls(dtm.read_heights(),
+                          astuple(dtm.window_transform),
+                          nodata=dtm.nodata)
+        intersector._dtm = dtm
+        return intersector
+
+    @property
+    def mesh(self):
+        """
+        The trimesh of the DtmType the intersector was created from,
+        only built when asked for, e.g. for the face normals of
+        `depthmap.progressive`. None for a bare height grid.
+        """
+        if self._mesh is None and self._dtm is not None:
+            self._mesh = self._dtm.trimesh
+        return self._mesh
+
+    def build_scene(self):
+        """
+        Nothing to build, the grid is traced as it is. Here so the
+        heightfield can stand in for the mesh backends.
+        """
+
+    @property
+    def shape(self):
+        """
+        (height, width) of the grid in pixels.
+        """
+        return self.heights.shape
+
+    @property
+    def face_count(self):
+        """
+        Number of faces the equivalent DtmType mesh would have.
+        """
+        height, width = self.shape
+        return 2 * (width - 1) * (height - 1)
+
+    def intersects_location(self,
+                            ray_origins,
+                            ray_directions,
+                            multiple_hits=True):
+        """
+        Return the location of where a ray hits the terrain.
+
+        Parameters
+        ----------
+        ray_origins : (n, 3) float
+          Origins of rays
+        ray_directions : (n, 3) float
+          Direction (vector) of rays
+        multiple_hits : bool
+          If True will return every hit along the ray
+          If False will only return first hit
+
+        Returns
+        ---------
+        locations : (m, 3) float
+          Intersection points
+        distances : (n,) or (m,) float
+          Distance along each ray when multiple_hits is False,
+          with inf for misses, otherwise distance of every hit
+        index_ray : (m,) int
+          Indexes of ray
+        index_tri : (m,) int
+          Indexes of the faces `DtmType.get_indices` would produce
+        """
+        (index_tri,
+         index_ray,
+         locations, distances) = self.intersects_id(
+            ray_origins=ray_origins,
+            ray_directions=ray_directions,
+            multiple_hits=multiple_hits,
+            return_locations=True)
+
+        return locations, distances, index_ray, index_tri
+
+    def intersects_id(self,
+                      ray_origins,
+                      ray_directions,
+                      multiple_hits=True,
+                      max_hits=20,
+                      return_locations=False):
+        """
+        Find the triangles hit by a list of rays, including
+        optionally multiple hits along a single ray.
+
+        Parameters
+        ----------
+        ray_origins : (n, 3) float
+          Origins of rays
+        ray_directions : (n, 3) float
+          Direction (vector) of rays
+        multiple_hits : bool
+          If True will return every hit along the ray
+          If False will only return first hit
+        max_hits : int
+          Maximum number of hits per ray
+        return_locations : bool
+          Should we return hit locations or not
+
+        Returns
+        ---------
+        index_tri : (m,) int
+          Indexes of mesh faces
+        index_ray : (m,) int
+          Indexes of ray
+        locations : (m, 3) float
+          Intersection points, only returned if return_locations
+        distances : (n,) or (m,) float
+          See `intersects_location`
+        """
+        ray_origins = np.asanyarray(ray_origins, dtype=np.float64)
+        ray_directions = util.unitize(np.asanyarray(ray_directions, dtype=np.float64))
+
+        index_ray, index_tri, hit_t = self._march(ray_origins,
+                                                  ray_directions,
+                                                  max_hits=max_hits if multiple_hits else 1)
+
+        if multiple_hits:
+            distances = hit_t
+        else:
+            distances = np.full(len(ray_origins), np.inf)
+            distances[index_ray] = hit_t
+
+        if return_locations:
+            locations = ray_origins[index_ray] + ray_directions[index_ray] * hit_t[:, None]
+            return index_tri, index_ray, locations, distances
+        return index_tri, index_ray, distances
+
+    def intersects_first_location(self,
+                                  ray_origins,
+                                  ray_directions):
+        """
+        Find the first hit of every ray, aligned to the rays.
+
+        Misses are left in place rather than compacted away,
+        so per ray results reshape into an image.
+
+        Parameters
+        ----------
+        ray_origins : (n, 3) float
+          Origins of rays
+        ray_directions : (n, 3) float
+          Direction (vector) of rays
+
+        Returns
+        ---------
+        locations : (n, 3) float
+          First hit of each ray, NaN on a miss
+        distances : (n,) float32
+          Distance along each ray to its hit, inf on a miss
+        triangle_index : (n,) int
+          Index of triangle ray hit, or -1 if not hit
+        """
+        ray_origins = np.asanyarray(ray_origins, dtype=np.float64)
+        ray_directions = util.unitize(np.asanyarray(ray_directions, dtype=np.float64))
+
+        index_ray, index_tri, hit_t = self._march(ray_origins, ray_directions, max_hits=1)
+
+        triangle_index = np.full(len(ray_origins), -1, dtype=np.int64)
+        triangle_index[index_ray] = index_tri
+
+        distances = np.full(len(ray_origins), np.inf, dtype=np.float32)
+        distances[index_ray] = hit_t
+
+        locations = np.full((len(ray_origins), 3), np.nan)
+        locations[index_ray] = ray_origins[index_ray] + ray_directions[index_ray] * hit_t[:, None]
+
+        return locations, distances, triangle_index
+
+    def intersects_first(self,
+                         ray_origins,
+                         ray_directions):
+        """
+        Find the index of the first triangle a ray hits.
+
+        Parameters
+        ----------
+        ray_origins : (n, 3) float
+          Origins of rays
+        ray_directions : (n, 3) float
+          Direction (vector) of rays
+
+        Returns
+        ----------
+        triangle_index : (n,) int
+          Index of triangle ray hit, or -1 if not hit
+        """
+        index_tri, index_ray, _ = self.intersects_id(ray_origins,
+                                                     ray_directions,
+                                                     multiple_hits=False)
+
+        triangle_index = np.full(len(ray_origins), -1, dtype=np.int64)
+        triangle_index[index_ray] = index_tri
+        return triangle_index
+
+    def intersects_any(self,
+                       ray_origins,
+                       ray_directions):
+        """
+        Check if a list of rays hits the surface.
+
+        Parameters
+        -----------
+        ray_origins : (n, 3) float
+          Origins of rays
+        ray_directions : (n, 3) float
+          Direction (vector) of rays
+
+        Returns
+        ----------
+        hit : (n,) bool
+          Did each ray hit the surface
+        """
+        first = self.intersects_first(ray_origins=ray_origins,
+                                      ray_directions=ray_directions)
+        return first != -1
+
+    def _to_grid(self, origins, directions):
+        """
+        Move rays into grid space, where pixel (col, row) sits at
+        (x, y) == (col, row). The mapping is affine so ray
+        distances are unchanged.
+        """
+        o = origins.copy()
+        d = directions.copy()
+        o[:, :2] = (o[:, :2] - self.origin) / self.pixel_size
+        d[:, :2] = d[:, :2] / self.pixel_size
+        return o, d
+
+    def _clip(self, o, d):
+        """
+        Clip grid space rays against the bounding box of the grid.
+
+        Returns
+        ---------
+        t_enter : (n,) float
+          Distance at which each ray enters the box
+        t_exit : (n,) float
+          Distance at which each ray leaves the box
+        """
+        height, width = self.shape
+        lower = np.array([0.0, 0.0, self.z_min])
+        upper = np.array([width - 1.0, height - 1.0, self.z_max])
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            inv = 1.0 / d
+            t_a = (lower - o) * inv
+            t_b = (upper - o) * inv
+
+        t_near = np.fmin(t_a, t_b)
+        t_far = np.fmax(t_a, t_b)
+
+        # an axis the ray is parallel to either always or never contains it
+        parallel = d == 0
+        inside = (o >= lower) & (o <= upper)
+        t_near[parallel] = np.where(inside[parallel], -np.inf, np.inf)
+        t_far[parallel] = np.where(inside[parallel], np.inf, -np.inf)
+
+        t_enter = np.maximum(t_near.max(axis=1), 0.0)
+        t_exit = t_far.min(axis=1)
+        return t_enter, t_exit
+
+    def _march(self, ray_origins, ray_directions, max_hits):
+        """
+        Walk every ray through the grid cells it crosses and
+        test the two triangles of each cell.
+
+        Returns
+        ---------
+        index_ray : (m,) int
+          Ray of every hit, ordered by ray then distance
+        index_tri : (m,) int
+          Face of every hit
+        distances : (m,) float
+          Distance along the ray of every hit
+        """
+        height, width = self.shape
+        n = len(ray_origins)
+
+        empty = (np.zeros(0, dtype=np.int64),
+                 np.zeros(0, dtype=np.int64),
+                 np.zeros(0, dtype=np.float64))
+        if n == 0 or np.isnan(self.z_max):
+            return empty
+
+        o, d = self._to_grid(ray_origins, ray_directions)
+        t_enter, t_exit = self._clip(o, d)
+
+        active = np.nonzero(t_enter <= t_exit)[0]
+        if len(active) == 0:
+            return empty
+
+        o = o[active]
+        d = d[active]
+        t_cur = t_enter[active]
+        t_end = t_exit[active]
+
+        # starting cell of each ray
+        start = o[:, :2] + d[:, :2] * t_cur[:, None]
+        col = np.clip(np.floor(start[:, 0]), 0, width - 2).astype(np.int64)
+        row = np.clip(np.floor(start[:, 1]), 0, height - 2).astype(np.int64)
+
+        # DDA stepping state along both grid axes
+        step = np.sign(d[:, :2]).astype(np.int64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t_delta = np.abs(1.0 / d[:, :2])
+            boundary = np.column_stack((col, row)) + (step > 0)
+            t_max = (boundary - o[:, :2]) / d[:, :2]
+        t_max[step == 0] = np.inf
+        t_delta[step == 0] = np.inf
+
+        hit_count = np.zeros(len(active), dtype=np.int64)
+        result_ray = []
+        result_tri = []
+        result_t = []
+
+        # every iteration advances each live ray by exactly one cell
+        live = np.arange(len(active))
+        for _ in range(width + height):
+            if len(live) == 0:
+                break
+
+            c = col[live]
+            r = row[live]
+            t_in = t_cur[live]
+            t_out = np.minimum(t_max[live].min(axis=1), t_end[live])
+
+            # only test cells the ray actually descends into
+            oz = o[live, 2]
+            dz = d[live, 2]
+            z_low = np.minimum(oz + dz * t_in, oz + dz * t_out)
+            below = ~(z_low > self._cell_max[r, c])
+
+            test = live[below]
+            if len(test) > 0:
+                self._test_cell(test, o, d, col, row, hit_count,
+                                result_ray, result_tri, result_t)
+
+            # rays that have hit enough, left the grid or passed their
+            # exit distance stop marching
+            t_next = t_max[live]
+            x_first = t_next[:, 0] < t_next[:, 1]
+            t_cur[live] = np.where(x_first, t_next[:, 0], t_next[:, 1])
+
+            col[live] += np.where(x_first, step[live, 0], 0)
+            row[live] += np.where(x_first, 0, step[live, 1])
+            t_max[live, 0] += np.where(x_first, t_delta[live, 0], 0)
+            t_max[live, 1] += np.where(x_first, 0, t_delta[live, 1])
+
+            keep = ((hit_count[live] < max_hits) &
+                    (t_cur[live] <= t_end[live]) &
+                    (col[live] >= 0) & (col[live] <= width - 2) &
+                    (row[live] >= 0) & (row[live] <= height - 2))
+            live = live[keep]
+
+        if len(result_ray) == 0:
+            return empty
+
+        index_ray = np.concatenate(result_ray)
+        index_tri = np.concatenate(result_tri)
+        distances = np.concatenate(result_t)
+
+        # cells are visited in distance order so a stable sort by ray
+        # keeps every ray's hits nearest first
+        order = np.argsort(index_ray, kind="stable")
+        index_ray = index_ray[order]
+        index_tri = index_tri[order]
+        distances = distances[order]
+
+        # a cell may add two hits to a ray that only wanted one more
+        rank = np.arange(len(index_ray)) - np.searchsorted(index_ray, index_ray)
+        keep = rank < max_hits
+        index_ray = index_ray[keep]
+        index_tri = index_tri[keep]
+        distances = distances[keep]
+
+        return active[index_ray], index_tri, distances
+
+    def _test_cell(self, test, o, d, col, row, hit_count,
+                   result_ray, result_tri, result_t):
+        """
+        Intersect rays with both triangles of their current cell
+        and append any hits to the result lists.
+        """
+        width = self.shape[1]
+        h = self.heights
+
+        c = col[test]
+        r = row[test]
+        cf = c.astype(np.float64)
+        rf = r.astype(np.float64)
+
+        # corners, named after their offset in (col, row)
+        p00 = np.column_stack((cf, rf, h[r, c]))
+        p01 = np.column_stack((cf, rf + 1, h[r + 1, c]))
+        p11 = np.column_stack((cf + 1, rf + 1, h[r + 1, c + 1]))
+        p10 = np.column_stack((cf + 1, rf, h[r, c + 1]))
+
+        ray_o = o[test]
+        ray_d = d[test]
+
+        # same winding as DtmType.get_indices:
+        # (a, a + width, a + width + 1) and (a, a + width + 1, a + 1)
+        t_a = ray_triangle(ray_o, ray_d, p00, p01, p11)
+        t_b = ray_triangle(ray_o, ray_d, p00, p11, p10)
+
+        face = 2 * (c + r * (width - 1))
+
+        # emit the nearer triangle of the cell first
+        b_first = t_b < t_a
+        for t, offset in ((np.where(b_first, t_b, t_a), np.where(b_first, 1, 0)),
+                          (np.where(b_first, t_a, t_b), np.where(b_first, 0, 1))):
+            hit = ~np.isnan(t)
+            if not hit.any():
+                continue
+            result_ray.append(test[hit])
+            result_tri.append(face[hit] + offset[hit])
+            result_t.append(t[hit])
+            np.add.at(hit_count, test[hit], 1)
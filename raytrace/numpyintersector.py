@@ -0,0 +1,600 @@
+"""
+Ray queries against a flattened BVH, in pure NumPy.
+
+A drop in for the Embree backed RayMeshIntersector on machines
+where the embree wrapper can't be built. Triangles are sorted
+along a Morton curve and packed into fixed size leaves, and the
+BVH over them is a complete binary tree stored as flat arrays
+(the children of node k are 2k + 1 and 2k + 2). Rays are traced
+in batches, descending the tree one level at a time for the whole
+batch, then visiting candidate leaves nearest first.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from trimesh import util
+
+import instrument
+from raytrace.culling import TerrainBounds, cull_rays
+from raytrace.scenecache import default_registry
+from raytrace.triangles import ray_triangle_edges
+
+# triangles per BVH leaf
+_leaf_size = 4
+# rays traced together through the tree
+_ray_batch_size = 4096
+
+
+class RayMeshIntersector(object):
+
+    def __init__(self,
+                 geometry,
+                 scene_key=None,
+                 registry=None,
+                 workers=1,
+                 cull=True):
+        """
+        Do ray- mesh queries.
+
+        Parameters
+        -------------
+        geometry : Trimesh object
+          Mesh to do ray tests on
+        scene_key : hashable or None
+          Identity of the mesh in the scene registry,
+          e.g. DtmType.tile_id, defaults to a hash of the mesh
+        registry : SceneRegistry or None
+          Where built BVHs are shared, defaults to the
+          process wide registry
+        workers : int
+          Threads to trace ray batches on
+        cull : bool
+          Skip rays that provably miss the terrain, and only
+          trace the rest where they could hit it, see
+          `raytrace.culling`
+        """
+        self.mesh = geometry
+        self._scene_key = scene_key
+        self._registry = registry if registry is not None else default_registry()
+        self.workers = workers
+        self.cull = cull
+
+    @property
+    def scene_key(self):
+        """
+        Key of this mesh's BVH in the registry.
+        """
+        if self._scene_key is not None:
+            return "bvh", self._scene_key
+        return "bvh", hash(self.mesh)
+
+    def _build_scene(self):
+        with instrument.span(instrument.BVH_BUILD):
+            return _NumpyBVH(vertices=self.mesh.vertices,
+                             faces=self.mesh.faces)
+
+    def _scene(self):
+        """
+        Borrow the BVH from the registry, building it if no
+        intersector on this mesh has yet.
+        """
+        return self._registry.scene(self.scene_key, self._build_scene)
+
+    def build_scene(self):
+        """
+        Build the BVH now rather than on the first query,
+        so its build is timed apart from the rays. Does nothing
+        if it is already in the registry.
+        """
+        with self._scene():
+            pass
+
+    def _run(self, scene, ray_origins, ray_directions, max_hits):
+        """
+        Trace rays through the BVH, leaving out the rays its
+        bounds cull.
+        """
+        if not self.cull:
+            return scene.run(ray_origins, ray_directions, max_hits=max_hits, workers=self.workers)
+
+        live, tnear, tfar = cull_rays(scene.bounds, ray_origins, ray_directions)
+        index_ray, index_tri, hit_t = scene.run(ray_origins[live],
+                                                ray_directions[live],
+                                                max_hits=max_hits,
+                                                workers=self.workers,
+                                                tnear=tnear,
+                                                tfar=tfar)
+
+        # live is ascending, so hits stay ordered by ray
+        return live[index_ray], index_tri, hit_t
+
+    def intersects_location(self,
+                            ray_origins,
+                            ray_directions,
+                            multiple_hits=True):
+        """
+        Return the location of where a ray hits a surface.
+
+        Parameters
+        ----------
+        ray_origins : (n, 3) float
+          Origins of rays
+        ray_directions : (n, 3) float
+          Direction (vector) of rays
+        multiple_hits : bool
+          If True will return every hit along the ray
+          If False will only return first hit
+
+        Returns
+        ---------
+        locations : (m, 3) float
+          Intersection points
+        distances : (n,) or (m,) float
+          Distance along each ray when multiple_hits is False,
+          with inf for misses, otherwise distance of every hit
+        index_ray : (m,) int
+          Indexes of ray
+        index_tri : (m,) int
+          Indexes of mesh.faces
+        """
+        (index_tri,
+         index_ray,
+         locations, distances) = self.intersects_id(
+            ray_origins=ray_origins,
+            ray_directions=ray_directions,
+            multiple_hits=multiple_hits,
+            return_locations=True)
+
+        return locations, distances, index_ray, index_tri
+
+    def intersects_id(self,
+                      ray_origins,
+                      ray_directions,
+                      multiple_hits=True,
+                      max_hits=20,
+                      return_locations=False):
+        """
+        Find the triangles hit by a list of rays, including
+        optionally multiple hits along a single ray.
+
+        Parameters
+        ----------
+        ray_origins : (n, 3) float
+          Origins of rays
+        ray_directions : (n, 3) float
+          Direction (vector) of rays
+        multiple_hits : bool
+          If True will return every hit along the ray
+          If False will only return first hit
+        max_hits : int
+          Maximum number of hits per ray
+        return_locations : bool
+          Should we return hit locations or not
+
+        Returns
+        ---------
+        index_tri : (m,) int
+          Indexes of mesh.faces
+        index_ray : (m,) int
+          Indexes of ray
+        locations : (m, 3) float
+          Intersection points, only returned if return_locations
+        distances : (n,) or (m,) float
+          See `intersects_location`
+        """
+        ray_origins = np.asanyarray(ray_origins, dtype=np.float64)
+        ray_directions = util.unitize(np.asanyarray(ray_directions, dtype=np.float64))
+
+        with self._scene() as scene:
+            index_ray, index_tri, hit_t = self._run(
+                scene,
+                ray_origins,
+                ray_directions,
+                max_hits=max_hits if multiple_hits else 1)
+
+        if multiple_hits:
+            distances = hit_t
+        else:
+            distances = np.full(len(ray_origins), np.inf)
+            distances[index_ray] = hit_t
+
+        if return_locations:
+            locations = ray_origins[index_ray] + ray_directions[index_ray] * hit_t[:, None]
+            return index_tri, index_ray, locations, distances
+        return index_tri, index_ray, distances
+
+    def intersects_first_location(self,
+                                  ray_origins,
+                                  ray_directions):
+        """
+        Find the first hit of every ray, aligned to the rays.
+
+        Misses are left in place rather than compacted away,
+        so per ray results reshape into an image.
+
+        Parameters
+        ----------
+        ray_origins : (n, 3) float
+          Origins of rays
+        ray_directions : (n, 3) float
+          Direction (vector) of rays
+
+        Returns
+        ---------
+        locations : (n, 3) float
+          First hit of each ray, NaN on a miss
+        distances : (n,) float32
+          Distance along each ray to its hit, inf on a miss
+        triangle_index : (n,) int
+          Index of triangle ray hit, or -1 if not hit
+        """
+        ray_origins = np.asanyarray(ray_origins, dtype=np.float64)
+        ray_directions = util.unitize(np.asanyarray(ray_directions, dtype=np.float64))
+
+        with self._scene() as scene:
+            index_ray, index_tri, hit_t = self._run(scene,
+                                                    ray_origins,
+                                                    ray_directions,
+                                                    max_hits=1)
+
+        triangle_index = np.full(len(ray_origins), -1, dtype=np.int64)
+        triangle_index[index_ray] = index_tri
+
+        distances = np.full(len(ray_origins), np.inf, dtype=np.float32)
+        distances[index_ray] = hit_t
+
+        locations = np.full((len(ray_origins), 3), np.nan)
+        locations[index_ray] = ray_origins[index_ray] + ray_directions[index_ray] * hit_t[:, None]
+
+        return locations, distances, triangle_index
+
+    def intersects_first(self,
+                         ray_origins,
+                         ray_directions):
+        """
+        Find the index of the first triangle a ray hits.
+
+        Parameters
+        ----------
+        ray_origins : (n, 3) float
+          Origins of rays
+        ray_directions : (n, 3) float
+          Direction (vector) of rays
+
+        Returns
+        ----------
+        triangle_index : (n,) int
+          Index of triangle ray hit, or -1 if not hit
+        """
+        index_tri, index_ray, _ = self.intersects_id(ray_origins,
+                                                     ray_directions,
+                                                     multiple_hits=False)
+
+        triangle_index = np.full(len(ray_origins), -1, dtype=np.int64)
+        triangle_index[index_ray] = index_tri
+        return triangle_index
+
+    def intersects_any(self,
+                       ray_origins,
+                       ray_directions):
+        """
+        Check if a list of rays hits the surface.
+
+        Parameters
+        -----------
+        ray_origins : (n, 3) float
+          Origins of rays
+        ray_directions : (n, 3) float
+          Direction (vector) of rays
+
+        Returns
+        ----------
+        hit : (n,) bool
+          Did each ray hit the surface
+        """
+        first = self.intersects_first(ray_origins=ray_origins,
+                                      ray_directions=ray_directions)
+        return first != -1
+
+
+class _NumpyBVH(object):
+    """
+    A BVH over a triangle mesh, flattened into arrays.
+    """
+
+    def __init__(self, vertices, faces, leaf_size=_leaf_size):
+        vertices = np.asanyarray(vertices, dtype=np.float64)
+        faces = np.asanyarray(faces, dtype=np.int64)
+
+        # store triangles relative to the mesh corner, so float32
+        # keeps its precision with large projected coordinates
+        self.origin = vertices.min(axis=0) if len(vertices) else np.zeros(3)
+        local = (vertices - self.origin).astype(np.float32)
+
+        self.face_count = len(faces)
+        self.leaf_size = leaf_size
+
+        # order the triangles along a Morton curve of their centroids
+        centroids = local[faces].mean(axis=1)
+        order = np.argsort(_morton_codes(centroids), kind="stable")
+
+        # pad to a power of two leaves, so the tree is complete
+        leaves = max(int(np.ceil(self.face_count / leaf_size)), 1)
+        self.depth = int(np.ceil(np.log2(leaves)))
+        self.leaf_count = 1 << self.depth
+        padded = self.leaf_count * leaf_size
+
+        self.tri_index = np.full(padded, -1, dtype=np.int64)
+        self.tri_index[:self.face_count] = order
+
+        # padding triangles are NaN, which never hit anything
+        tri = np.full((padded, 3, 3), np.nan, dtype=np.float32)
+        tri[:self.face_count] = local[faces[order]]
+
+        self.v0 = tri[:, 0]
+        self.e1 = tri[:, 1] - tri[:, 0]
+        self.e2 = tri[:, 2] - tri[:, 0]
+
+        # leaf bounds, then every level above them
+        per_leaf = tri.reshape([self.leaf_count, leaf_size * 3, 3])
+        lower = [np.fmin.reduce(per_leaf, axis=1)]
+        upper = [np.fmax.reduce(per_leaf, axis=1)]
+        while len(lower[0]) > 1:
+            lower.insert(0, np.fmin(lower[0][0::2], lower[0][1::2]))
+            upper.insert(0, np.fmax(upper[0][0::2], upper[0][1::2]))
+
+        # heap layout, level d holds nodes [2^d - 1, 2^(d + 1) - 1)
+        self.node_lower = np.concatenate(lower)
+        self.node_upper = np.concatenate(upper)
+
+        # the same bounds one axis per row, so the slab test gathers contiguous values
+        self._lower_axes = np.ascontiguousarray(self.node_lower.T, dtype=np.float64)
+        self._upper_axes = np.ascontiguousarray(self.node_upper.T, dtype=np.float64)
+
+        # coarse bounds to cull rays with before they are traced
+        self.bounds = TerrainBounds.from_mesh(vertices, faces)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.tri_index, self.v0, self.e1, self.e2,
+                                      self.node_lower, self.node_upper,
+                                      self._lower_axes, self._upper_axes)) + self.bounds.nbytes
+
+    def close(self):
+        """
+        Nothing to release, here to match _EmbreeWrap.
+        """
+
+    def run(self, origins, directions, max_hits=1, workers=1, tnear=None, tfar=None):
+        """
+        Intersect rays with the mesh.
+
+        Parameters
+        ----------
+        origins : (n, 3) float
+          Origins of rays
+        directions : (n, 3) float
+          Unit direction of rays
+        max_hits : int
+          Hits to report per ray, nearest first
+        workers : int
+          Threads to trace ray batches on
+        tnear : (n,) float or None
+          Only report hits from this distance along each ray
+        tfar : (n,) float or None
+          Only report hits up to this distance along each ray
+
+        Returns
+        ---------
+        index_ray : (m,) int
+          Ray of every hit, ordered by ray then distance
+        index_tri : (m,) int
+          Face of every hit
+        distances : (m,) float
+          Distance along the ray of every hit
+        """
+        tnear = np.zeros(len(origins)) if tnear is None else np.asanyarray(tnear, dtype=np.float64)
+        tfar = np.full(len(origins), np.inf) if tfar is None else np.asanyarray(tfar, dtype=np.float64)
+
+        batches = [(start, min(start + _ray_batch_size, len(origins)))
+                   for start in range(0, len(origins), _ray_batch_size)]
+
+        def trace(batch):
+            start, end = batch
+            ray, tri, t = self._trace(origins[start:end] - self.origin,
+                                      directions[start:end],
+                                      max_hits,
+                                      tnear[start:end],
+                                      tfar[start:end])
+            return ray + start, tri, t
+
+        if workers > 1 and len(batches) > 1:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(trace, batches))
+        else:
+            results = [trace(b) for b in batches]
+
+        if len(results) == 0:
+            return (np.zeros(0, dtype=np.int64),
+                    np.zeros(0, dtype=np.int64),
+                    np.zeros(0, dtype=np.float64))
+
+        return tuple(np.concatenate([r[i] for r in results]) for i in range(3))
+
+    def _trace(self, origins, directions, max_hits, tnear, tfar):
+        """
+        Trace one batch of rays, in mesh local coordinates,
+        between tnear and tfar along each.
+        """
+        with np.errstate(divide="ignore"):
+            inverse = np.ascontiguousarray((1.0 / directions).T)
+        origin_axes = np.ascontiguousarray(origins.T)
+        # rays along a box face would give 0 * inf = NaN in the slab test
+        parallel = np.ascontiguousarray((directions == 0).T)
+        parallel = parallel if parallel.any() else None
+
+        # descend the tree, keeping every (ray, node) pair whose box the ray crosses
+        ray = np.arange(len(origins))
+        node = np.zeros(len(origins), dtype=np.int64)
+        for _ in range(self.depth):
+            hit, _ = self._boxes(origin_axes, inverse, ray, node, tnear, tfar, parallel)
+            ray = np.repeat(ray[hit], 2)
+            node = np.column_stack((2 * node[hit] + 1, 2 * node[hit] + 2)).ravel()
+
+        hit, t_enter = self._boxes(origin_axes, inverse, ray, node, tnear, tfar, parallel)
+        ray = ray[hit]
+        leaf = node[hit] - (self.leaf_count - 1)
+        t_enter = t_enter[hit]
+
+        limits = (tnear, tfar)
+        if max_hits == 1:
+            return self._first_hits(origins, directions, ray, leaf, t_enter, limits)
+        return self._all_hits(origins, directions, ray, leaf, max_hits, limits)
+
+    def _boxes(self, origins, inverse, ray, node, tnear, tfar, parallel=None):
+        """
+        Slab test rays against node bounds.
+
+        Parameters
+        ----------
+        origins, inverse : (3, b) float
+          Origins and inverse directions of the batch, one axis per row
+        ray, node : (n,) int
+          Pairs of ray and node to test
+        tnear, tfar : (b,) float
+          Part of each ray of the batch to test
+        parallel : (3, b) bool or None
+          Which axes each ray of the batch is parallel to, None
+          if there are none
+
+        Returns
+        ---------
+        hit : (n,) bool
+          Does each ray cross its node's box
+        t_enter : (n,) float
+          Distance at which each ray enters the box
+        """
+        t_near = tnear[ray]
+        t_far = tfar[ray]
+
+        # NaN bounds of empty leaves propagate, so they never hit
+        with np.errstate(invalid="ignore"):
+            for axis in range(3):
+                o = origins[axis][ray]
+                inv = inverse[axis][ray]
+                lower = self._lower_axes[axis][node]
+                upper = self._upper_axes[axis][node]
+                t_a = (lower - o) * inv
+                t_b = (upper - o) * inv
+                if parallel is not None:
+                    # a ray parallel to the axis is always or never between the slab's planes, NaN never hits
+                    flat = parallel[axis][ray]
+                    inside = (lower[flat] <= o[flat]) & (o[flat] <= upper[flat])
+                    t_a[flat] = np.where(inside, -np.inf, np.nan)
+                    t_b[flat] = np.where(inside, np.inf, np.nan)
+                np.maximum(t_near, np.minimum(t_a, t_b), out=t_near)
+                np.minimum(t_far, np.maximum(t_a, t_b), out=t_far)
+            hit = t_far >= t_near
+
+        return hit, t_near
+
+    def _leaf_hits(self, origins, directions, ray, leaf, limits):
+        """
+        Intersect each ray with every triangle of its leaf,
+        between the (tnear, tfar) limits of the ray.
+
+        Returns
+        ---------
+        t : (m, leaf_size) float
+          Distance to each triangle, NaN on a miss
+        slot : (m, leaf_size) int
+          Index into the padded triangle arrays
+        """
+        slot = leaf[:, None] * self.leaf_size + np.arange(self.leaf_size)
+        t = ray_triangle_edges(origins[ray][:, None, :],
+                               directions[ray][:, None, :],
+                               self.v0[slot], self.e1[slot], self.e2[slot])
+
+        tnear, tfar = limits
+        with np.errstate(invalid="ignore"):
+            outside = (t < tnear[ray][:, None]) | (t > tfar[ray][:, None])
+        t[outside] = np.nan
+        return t, slot
+
+    def _first_hits(self, origins, directions, ray, leaf, t_enter, limits):
+        """
+        Visit each ray's candidate leaves nearest first, stopping
+        once a hit is closer than the next leaf.
+        """
+        best_t = np.full(len(origins), np.inf)
+        best_slot = np.full(len(origins), -1, dtype=np.int64)
+
+        # rank every leaf by entry distance along its ray
+        order = np.lexsort((t_enter, ray))
+        ray = ray[order]
+        leaf = leaf[order]
+        t_enter = t_enter[order]
+        rank = np.arange(len(ray)) - np.searchsorted(ray, ray)
+
+        by_rank = np.argsort(rank, kind="stable")
+        bounds = np.searchsorted(rank[by_rank], np.arange(rank.max() + 2)) if len(rank) else [0]
+
+        for r in range(len(bounds) - 1):
+            pick = by_rank[bounds[r]:bounds[r + 1]]
+            pick = pick[t_enter[pick] < best_t[ray[pick]]]
+            if len(pick) == 0:
+                continue
+
+            t, slot = self._leaf_hits(origins, directions, ray[pick], leaf[pick], limits)
+            t = np.where(np.isnan(t), np.inf, t)
+            nearest = np.argmin(t, axis=1)
+            t = t[np.arange(len(pick)), nearest]
+
+            # every ray appears at most once per rank
+            closer = t < best_t[ray[pick]]
+            best_t[ray[pick][closer]] = t[closer]
+            best_slot[ray[pick][closer]] = slot[np.arange(len(pick)), nearest][closer]
+
+        hit = np.nonzero(best_slot >= 0)[0]
+        return hit, self.tri_index[best_slot[hit]], best_t[hit]
+
+    def _all_hits(self, origins, directions, ray, leaf, max_hits, limits):
+        """
+        Test every candidate leaf, keeping up to max_hits per ray.
+        """
+        t, slot = self._leaf_hits(origins, directions, ray, leaf, limits)
+        valid = ~np.isnan(t)
+
+        hit_ray = np.broadcast_to(ray[:, None], t.shape)[valid]
+        hit_slot = slot[valid]
+        hit_t = t[valid]
+
+        order = np.lexsort((hit_t, hit_ray))
+        hit_ray = hit_ray[order]
+        hit_slot = hit_slot[order]
+        hit_t = hit_t[order]
+
+        rank = np.arange(len(hit_ray)) - np.searchsorted(hit_ray, hit_ray)
+        keep = rank < max_hits
+
+        return hit_ray[keep], self.tri_index[hit_slot[keep]], hit_t[keep]
+
+
+def _morton_codes(points):
+    """
+    30 bit Morton codes of points, quantized over their bounds.
+    """
+    lower = points.min(axis=0)
+    extent = np.maximum(points.max(axis=0) - lower, 1e-12)
+    q = np.clip((points - lower) / extent * 1023, 0, 1023).astype(np.uint32)
+
+    def spread(x):
+        # insert two zero bits between each of the 10 low bits
+        x = (x | (x << 16)) & 0x030000FF
+        x = (x | (x << 8)) & 0x0300F00F
+        x = (x | (x << 4)) & 0x030C30C3
+        x = (x | (x << 2)) & 0x09249249
+        return x
+
+    return (spread(q[:, 0]) << 2) | (spread(q[:, 1]) << 1) | spread(q[:, 2])
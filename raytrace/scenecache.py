@@ -0,0 +1,167 @@
+"""
+A process wide registry of committed Embree scenes.
+
+Building the BVH is the most expensive part of setting up a RayMeshIntersector, so scenes are shared between every
+intersector built on the same mesh (or the same DTM tile), and kept around for repeated renders. The registry holds a
+bounded number of scenes, evicting the least recently used ones, and releases their scene explicitly when they are
+evicted, rather than leaving it to garbage collection. Every scene is built on one shared Embree device.
+"""
+
+import atexit
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class SceneRegistry(object):
+
+    def __init__(self, max_scenes=4, max_bytes=None):
+        """
+        Parameters
+        ------------
+        max_scenes : int
+          Most committed scenes to hold at once
+        max_bytes : int or None
+          Most memory, as estimated by each scene's
+          `nbytes`, to hold at once
+        """
+        self.max_scenes = max_scenes
+        self.max_bytes = max_bytes
+
+        self._scenes = OrderedDict()
+        self._pins = {}
+        # keys whose scene is being built, set once it's in _scenes
+        self._building = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._scenes)
+
+    def __contains__(self, key):
+        return key in self._scenes
+
+    @property
+    def nbytes(self):
+        return sum(getattr(s, "nbytes", 0) for s in self._scenes.values())
+
+    @contextmanager
+    def scene(self, key, factory):
+        """
+        Borrow the scene for a key, building it on a miss.
+
+        The scene is pinned while the context is open, so it
+        will not be closed under a running query.
+
+        Parameters
+        ------------
+        key : hashable
+          Identity of the geometry, e.g. a mesh hash or DTM tile id
+        factory : callable
+          Builds the scene, only called on a miss
+
+        Yields
+        ------------
+        scene : _EmbreeWrap
+          Committed scene
+        """
+        while True:
+            with self._lock:
+                if key in self._scenes:
+                    self._scenes.move_to_end(key)
+                    scene = self._scenes[key]
+                    self._pins[key] = self._pins.get(key, 0) + 1
+                    break
+
+                building = self._building.get(key)
+                if building is None:
+                    building = self._building[key] = threading.Event()
+                    owner = True
+                else:
+                    owner = False
+
+            if not owner:
+                # another thread is building this scene, wait
+                # for it rather than building it twice
+                building.wait()
+                continue
+
+            # build outside the lock, so lookups of other
+            # scenes don't wait for the BVH build
+            try:
+                scene = factory()
+            except BaseException:
+                with self._lock:
+                    del self._building[key]
+                building.set()
+                raise
+
+            with self._lock:
+                self._scenes[key] = scene
+                self._pins[key] = self._pins.get(key, 0) + 1
+                del self._building[key]
+            building.set()
+            break
+
+        try:
+            yield scene
+        finally:
+            with self._lock:
+                self._pins[key] -= 1
+                if self._pins[key] == 0:
+                    del self._pins[key]
+                self.evict()
+
+    def evict(self):
+        """
+        Close least recently used scenes until the registry is
+        within its limits. Pinned scenes are never closed.
+        """
+        with self._lock:
+            for key in list(self._scenes.keys()):
+                if not self._over_limit():
+                    break
+                if key in self._pins:
+                    continue
+                self.release(key)
+
+    def release(self, key):
+        """
+        Close and forget the scene for a key, if it is not in use.
+        """
+        with self._lock:
+            if key in self._pins:
+                raise ValueError(f"Scene {key} is in use")
+
+            scene = self._scenes.pop(key, None)
+            if scene is not None:
+                scene.close()
+
+    def clear(self):
+        """
+        Close every scene that is not in use.
+        """
+        with self._lock:
+            for key in list(self._scenes.keys()):
+                if key not in self._pins:
+                    self.release(key)
+
+    def _over_limit(self):
+        if len(self._scenes) > self.max_scenes:
+            return True
+        return self.max_bytes is not None and self.nbytes > self.max_bytes
+
+
+_default_registry = None
+
+
+def default_registry():
+    """
+    The registry shared by every intersector in the process.
+    """
+    global _default_registry
+
+    if _default_registry is None:
+        _default_registry = SceneRegistry()
+        atexit.register(_default_registry.clear)
+
+    return _default_registry
@@ -0,0 +1,716 @@
+"""
+Ray queries against a terrain split into fixed size tiles.
+
+A single RayMeshIntersector holds one mesh and one BVH over the whole terrain, so covering more ground means rebuilding
+an ever larger scene and keeping every triangle in memory. Here the height raster is cut into square tiles of
+`tile_size` cells, and each tile is meshed and given its own intersector (and so its own Embree scene, on the device all
+scenes share) only once a ray actually crosses its bounding box. Heights are only read for the tiles rays get to: until
+a tile is read its bounds are unlimited in height, so rays are first matched to tiles in plan, and tiles behind every
+ray's closest hit so far are never read at all. Built tiles live in a SceneRegistry, which detaches the least recently
+used ones once they take more than `max_bytes`, so one long running process can serve terrain far larger than it could
+ever hold.
+
+Neighbouring tiles share their edge pixels, so full resolution tiles meet exactly. Simplified tiles (see `dtm.rtin`) are
+triangulated on their own and their edges don't line up, so every edge shared with another tile hangs a skirt, a
+vertical strip of triangles `skirt` metres deep, which closes the cracks in between.
+
+Faces are reported by the index `DtmType.get_indices` gives the grid face under their centre, the same as
+HeightfieldIntersector, so full resolution results match a monolithic mesh of the same raster, and face ids stay stable
+whatever the tiling.
+
+Pixels with no data are left out of the mesh.
+"""
+
+import itertools
+from dataclasses import astuple
+
+import numpy as np
+import trimesh
+from trimesh import util
+
+import instrument
+from dtm import rtin
+from raytrace.backends import make_intersector
+from raytrace.culling import clip_to_box
+from raytrace.scenecache import SceneRegistry
+
+# distinguishes the tiles of every intersector sharing a registry
+_instances = itertools.count()
+
+
+class ShardedIntersector(object):
+
+    def __init__(self,
+                 read_heights,
+                 shape,
+                 geo_transform,
+                 nodata=None,
+                 tile_size=256,
+                 max_error=None,
+                 skirt=None,
+                 backend=None,
+                 scene_key=None,
+                 registry=None,
+                 max_bytes=1 << 30,
+                 workers=1):
+        """
+        Do ray- terrain queries, one tile at a time.
+
+        Parameters
+        -------------
+        read_heights : callable
+          Reads the elevations of a block of the raster,
+          called as read_heights(col, row, width, height)
+          like `gdal.Band.ReadAsArray`
+        shape : (2,) int
+          (height, width) of the raster in pixels
+        geo_transform : (6,) float
+          GDAL geo-transform of the raster
+        nodata : float or None
+          Value marking missing elevations
+        tile_size : int
+          Cells along each side of a tile, a power of two
+          keeps simplified tiles free of padding
+        max_error : float or None
+          Simplify every tile to this vertical error, see
+          `dtm.rtin.triangulate`, None for two triangles per cell
+        skirt : float or None
+          Depth of the skirts along shared tile edges,
+          defaults to twice max_error
+        backend : str or None
+          Intersector backend of the tiles, see
+          `raytrace.backends.get_backend`
+        scene_key : hashable or None
+          Identity of the terrain in the registry,
+          e.g. DtmType.tile_id
+        registry : SceneRegistry or None
+          Where built tiles are kept, defaults to a registry
+          of this intersector's own, limited to max_bytes
+        max_bytes : int
+          Most memory the built tiles of the default
+          registry may take
+        workers : int
+          Threads each tile traces rays on
+        """
+        x_top_left, x_pixel_size, row_rot, y_top_left, col_rot, y_pixel_size = geo_transform
+        if row_rot != 0 or col_rot != 0:
+            raise ValueError("Rotated rasters are not supported")
+
+        self.shape = tuple(int(v) for v in shape)
+        if min(self.shape) < 2:
+            raise ValueError("Heights must be a 2D grid of at least 2x2 pixels")
+
+        self._read = read_heights
+        self.origin = np.array([x_top_left, y_top_left], dtype=np.float64)
+        self.pixel_size = np.array([x_pixel_size, y_pixel_size], dtype=np.float64)
+        self.nodata = nodata
+        self.tile_size = int(tile_size)
+        self.max_error = max_error
+        self.skirt = float(skirt if skirt is not None else 2 * (max_error or 0))
+        self.backend = backend
+        self.workers = workers
+
+        self._scene_key = scene_key if scene_key is not None else ("sharded", next(_instances))
+        self._registry = registry if registry is not None else SceneRegistry(max_scenes=np.inf,
+                                                                            max_bytes=max_bytes)
+
+        height, width = self.shape
+        self.tile_shape = (int(np.ceil((height - 1) / self.tile_size)),
+                           int(np.ceil((width - 1) / self.tile_size)))
+
+        self.tile_lower, self.tile_upper = self._tile_extents()
+        self._bounds_read = np.zeros(self.tile_shape, dtype=bool)
+
+    @classmethod
+    def from_dtm(cls, dtm, **kwargs):
+        """
+        Create an intersector over the raster window of a
+        DtmType, reading each tile's heights when it is built.
+
+        Parameters
+        -------------
+        dtm : DtmType
+          Terrain to do ray tests on
+        kwargs
+          Passed on to the constructor, e.g. tile_size
+
+        Returns
+        -------------
+        intersector : ShardedIntersector
+        """
+        xoff, yoff, width, height = dtm.raster_window
+        band = dtm.raster.GetRasterBand(1)
+
+        kwargs.setdefault("max_error", dtm.max_error)
+        kwargs.setdefault("scene_key", dtm.tile_id)
+
+        return cls(lambda col, row, w, h: band.ReadAsArray(xoff + col, yoff + row, w, h),
+                   (height, width),
+                   astuple(dtm.window_transform),
+                   nodata=dtm.nodata,
+                   **kwargs)
+
+    @classmethod
+    def from_heights(cls, heights, geo_transform, **kwargs):
+        """
+        Create an intersector over a height grid in memory.
+
+        Parameters
+        -------------
+        heights : (h, w) float
+          Elevation of every raster pixel
+        geo_transform : (6,) float
+          GDAL geo-transform of the raster
+
+        Returns
+        -------------
+        intersector : ShardedIntersector
+        """
+        heights = np.asarray(heights)
+        return cls(lambda col, row, w, h: heights[row:row + h, col:col + w],
+                   heights.shape, geo_transform, **kwargs)
+
+    @property
+    def face_count(self):
+        """
+        Number of faces the equivalent DtmType mesh would have.
+        """
+        height, width = self.shape
+        return 2 * (width - 1) * (height - 1)
+
+    @property
+    def attached(self):
+        """
+        (row, col) of every tile that is currently built.
+        """
+        return [tile for tile in np.ndindex(*self.tile_shape)
+                if self._key(tile) in self._registry]
+
+    def touched_tiles(self, ray_origins, ray_directions):
+        """
+        Find the tiles a bundle of rays, e.g. a camera
+        frustum, can hit.
+
+        Parameters
+        ----------
+        ray_origins : (n, 3) float
+          Origins of rays
+        ray_directions : (n, 3) float
+          Direction (vector) of rays
+
+        Returns
+        ---------
+        tiles : list of (2,) int
+          (row, col) of every tile whose bounds any ray
+          crosses, nearest first
+        """
+        origins = np.asanyarray(ray_origins, dtype=np.float64)
+        directions = util.unitize(np.asanyarray(ray_directions, dtype=np.float64))
+
+        tiles = []
+        entries = []
+        for tile in self._candidate_tiles(origins, directions):
+            t_enter, t_exit = clip_to_box(origins, directions, *self._tile_bounds(tile))
+            crosses = t_enter <= t_exit
+            if crosses.any():
+                tiles.append(tile)
+                entries.append(t_enter[crosses].min())
+
+        return [tiles[i] for i in np.argsort(entries, kind="stable")]
+
+    def _candidate_tiles(self, origins, directions):
+        """
+        Find the tiles rays may cross going by the bounds known
+        so far, without reading any heights.
+
+        Returns
+        ---------
+        tiles : list of (2,) int
+          (row, col) of the tiles, nearest first
+        """
+        # only rays crossing the whole terrain can hit any tile
+        lower = np.nanmin(self.tile_lower.reshape([-1, 3]), axis=0)
+        upper = np.nanmax(self.tile_upper.reshape([-1, 3]), axis=0)
+        t_enter, t_exit = clip_to_box(origins, directions, lower, upper)
+        live = t_enter <= t_exit
+        if not live.any():
+            return []
+
+        origins = origins[live, :2]
+        directions = directions[live, :2]
+
+        # the tiles under the part of the rays inside the terrain
+        # bounds, a vertical ray stays put even if they are unbounded
+        with np.errstate(invalid="ignore"):
+            ends = np.vstack((origins + directions * t_enter[live, None],
+                              origins + directions * t_exit[live, None]))
+        ends = np.where(np.vstack((directions, directions)) == 0, np.vstack((origins, origins)), ends)
+        pixels = (ends - self.origin) / self.pixel_size
+        first = np.clip(np.floor(pixels.min(axis=0) / self.tile_size), 0, None).astype(np.int64)
+        last = np.floor(pixels.max(axis=0) / self.tile_size).astype(np.int64)
+
+        tiles = []
+        entries = []
+        for row in range(first[1], min(last[1], self.tile_shape[0] - 1) + 1):
+            for col in range(first[0], min(last[0], self.tile_shape[1] - 1) + 1):
+                t_enter, t_exit = clip_to_box(origins, directions,
+                                              self.tile_lower[row, col, :2],
+                                              self.tile_upper[row, col, :2])
+                crosses = t_enter <= t_exit
+                if crosses.any():
+                    tiles.append((row, col))
+                    entries.append(t_enter[crosses].min())
+
+        return [tiles[i] for i in np.argsort(entries, kind="stable")]
+
+    def intersects_location(self,
+                            ray_origins,
+                            ray_directions,
+                            multiple_hits=True):
+        """
+        Return the location of where a ray hits the terrain.
+
+        Parameters
+        ----------
+        ray_origins : (n, 3) float
+          Origins of rays
+        ray_directions : (n, 3) float
+          Direction (vector) of rays
+        multiple_hits : bool
+          If True will return every hit along the ray
+          If False will only return first hit
+
+        Returns
+        ---------
+        locations : (m, 3) float
+          Intersection points
+        distances : (n,) or (m,) float
+          Distance along each ray when multiple_hits is False,
+          with inf for misses, otherwise distance of every hit
+        index_ray : (m,) int
+          Indexes of ray
+        index_tri : (m,) int
+          Indexes of the faces `DtmType.get_indices` would produce
+        """
+        (index_tri,
+         index_ray,
+         locations, distances) = self.intersects_id(
+            ray_origins=ray_origins,
+            ray_directions=ray_directions,
+            multiple_hits=multiple_hits,
+            return_locations=True)
+
+        return locations, distances, index_ray, index_tri
+
+    def intersects_id(self,
+                      ray_origins,
+                      ray_directions,
+                      multiple_hits=True,
+                      max_hits=20,
+                      return_locations=False):
+        """
+        Find the triangles hit by a list of rays, including
+        optionally multiple hits along a single ray.
+
+        Parameters
+        ----------
+        ray_origins : (n, 3) float
+          Origins of rays
+        ray_directions : (n, 3) float
+          Direction (vector) of rays
+        multiple_hits : bool
+          If True will return every hit along the ray
+          If False will only return first hit
+        max_hits : int
+          Maximum number of hits per ray
+        return_locations : bool
+          Should we return hit locations or not
+
+        Returns
+        ---------
+        index_tri : (m,) int
+          Indexes of mesh faces
+        index_ray : (m,) int
+          Indexes of ray
+        locations : (m, 3) float
+          Intersection points, only returned if return_locations
+        distances : (n,) or (m,) float
+          See `intersects_location`
+        """
+        ray_origins = np.asanyarray(ray_origins, dtype=np.float64)
+        ray_directions = util.unitize(np.asanyarray(ray_directions, dtype=np.float64))
+
+        if multiple_hits:
+            index_ray, index_tri, distances = self._all_hits(ray_origins, ray_directions, max_hits)
+        else:
+            hit_t, triangle_index = self._first_hits(ray_origins, ray_directions)
+            index_ray = np.nonzero(triangle_index >= 0)[0]
+            index_tri = triangle_index[index_ray]
+            distances = hit_t.astype(np.float64)
+
+        if return_locations:
+            t = distances if multiple_hits else distances[index_ray]
+            locations = ray_origins[index_ray] + ray_directions[index_ray] * t[:, None]
+            return index_tri, index_ray, locations, distances
+        return index_tri, index_ray, distances
+
+    def intersects_first_location(self,
+                                  ray_origins,
+                                  ray_directions):
+        """
+        Find the first hit of every ray, aligned to the rays.
+
+        Misses are left in place rather than compacted away,
+        so per ray results reshape into an image.
+
+        Parameters
+        ----------
+        ray_origins : (n, 3) float
+          Origins of rays
+        ray_directions : (n, 3) float
+          Direction (vector) of rays
+
+        Returns
+        ---------
+        locations : (n, 3) float
+          First hit of each ray, NaN on a miss
+        distances : (n,) float32
+          Distance along each ray to its hit, inf on a miss
+        triangle_index : (n,) int
+          Index of triangle ray hit, or -1 if not hit
+        """
+        ray_origins = np.asanyarray(ray_origins, dtype=np.float64)
+        ray_directions = util.unitize(np.asanyarray(ray_directions, dtype=np.float64))
+
+        distances, triangle_index = self._first_hits(ray_origins, ray_directions)
+
+        with np.errstate(invalid="ignore"):
+            locations = np.multiply(ray_directions, distances[:, None])
+        locations += ray_origins
+        locations[triangle_index < 0] = np.nan
+
+        return locations, distances, triangle_index
+
+    def intersects_first(self,
+                         ray_origins,
+                         ray_directions):
+        """
+        Find the index of the first triangle a ray hits.
+
+        Parameters
+        ----------
+        ray_origins : (n, 3) float
+          Origins of rays
+        ray_directions : (n, 3) float
+          Direction (vector) of rays
+
+        Returns
+        ----------
+        triangle_index : (n,) int
+          Index of triangle ray hit, or -1 if not hit
+        """
+        _, _, triangle_index = self.intersects_first_location(ray_origins, ray_directions)
+        return triangle_index
+
+    def intersects_any(self,
+                       ray_origins,
+                       ray_directions):
+        """
+        Check if a list of rays hits the surface.
+
+        Parameters
+        -----------
+        ray_origins : (n, 3) float
+          Origins of rays
+        ray_directions : (n, 3) float
+          Direction (vector) of rays
+
+        Returns
+        ----------
+        hit : (n,) bool
+          Did each ray hit the surface
+        """
+        first = self.intersects_first(ray_origins=ray_origins,
+                                      ray_directions=ray_directions)
+        return first != -1
+
+    def _first_hits(self, origins, directions):
+        """
+        Trace the tiles nearest first, only sending a tile the
+        rays that cross it before their closest hit so far. A
+        tile no ray gets to that way is never read.
+
+        Returns
+        ---------
+        distances : (n,) float32
+          Distance to the first hit, inf on a miss
+        triangle_index : (n,) int
+          Face of the first hit, -1 on a miss
+        """
+        distances = np.full(len(origins), np.inf, dtype=np.float32)
+        triangle_index = np.full(len(origins), -1, dtype=np.int64)
+
+        for tile in self._candidate_tiles(origins, directions):
+            if not self._bounds_read[tile]:
+                # only read the heights if a ray gets to the tile's plan before its closest hit
+                t_enter, t_exit = clip_to_box(origins, directions, self.tile_lower[tile], self.tile_upper[tile])
+                if not ((t_enter <= t_exit) & (t_enter < distances)).any():
+                    continue
+
+            t_enter, t_exit = clip_to_box(origins, directions, *self._tile_bounds(tile))
+            rays = np.nonzero((t_enter <= t_exit) & (t_enter < distances))[0]
+            if len(rays) == 0:
+                continue
+
+            with self._tile(tile) as shard:
+                _, t, tri = shard.intersector.intersects_first_location(origins[rays] - shard.offset,
+                                                                        directions[rays])
+
+                closer = t < distances[rays]
+                distances[rays[closer]] = t[closer]
+                triangle_index[rays[closer]] = shard.face_ids[tri[closer]]
+
+        return distances, triangle_index
+
+    def _all_hits(self, origins, directions, max_hits):
+        """
+        Collect every hit of every tile, keeping up to
+        max_hits per ray, nearest first.
+        """
+        index_ray = [np.zeros(0, dtype=np.int64)]
+        index_tri = [np.zeros(0, dtype=np.int64)]
+        distances = [np.zeros(0, dtype=np.float64)]
+
+        for tile in self.touched_tiles(origins, directions):
+            t_enter, t_exit = clip_to_box(origins, directions, *self._tile_bounds(tile))
+            rays = np.nonzero(t_enter <= t_exit)[0]
+
+            with self._tile(tile) as shard:
+                local = origins[rays] - shard.offset
+                tri, ray, locations, _ = shard.intersector.intersects_id(local,
+                                                                         directions[rays],
+                                                                         multiple_hits=True,
+                                                                         max_hits=max_hits,
+                                                                         return_locations=True)
+                index_tri.append(shard.face_ids[tri])
+
+            index_ray.append(rays[ray])
+            distances.append(np.linalg.norm(locations - local[ray], axis=1))
+
+        index_ray = np.concatenate(index_ray)
+        index_tri = np.concatenate(index_tri)
+        distances = np.concatenate(distances)
+
+        order = np.lexsort((distances, index_ray))
+        index_ray = index_ray[order]
+        rank = np.arange(len(index_ray)) - np.searchsorted(index_ray, index_ray)
+        keep = order[rank < max_hits]
+
+        return index_ray[rank < max_hits], index_tri[keep], distances[keep]
+
+    def _key(self, tile):
+        return "shard", self._scene_key, tuple(int(v) for v in tile)
+
+    def _tile(self, tile):
+        """
+        Borrow a tile from the registry, building it if it
+        isn't attached.
+        """
+        return self._registry.scene(self._key(tile), lambda: self._build_tile(tile))
+
+    def _pixel_range(self, tile):
+        """
+        First and last (col, row) of the pixels of a tile,
+        including the edge it shares with its neighbours.
+        """
+        row, col = tile
+        height, width = self.shape
+        c0 = col * self.tile_size
+        r0 = row * self.tile_size
+        return c0, r0, min(c0 + self.tile_size, width - 1), min(r0 + self.tile_size, height - 1)
+
+    def _read_tile(self, tile):
+        c0, r0, c1, r1 = self._pixel_range(tile)
+        zz = np.array(self._read(c0, r0, c1 - c0 + 1, r1 - r0 + 1), dtype=np.float64)
+        if self.nodata is not None:
+            zz[zz == self.nodata] = np.nan
+        return zz
+
+    def _tile_extents(self):
+        """
+        Bounds of every tile before any heights are read,
+        unbounded in z.
+
+        Returns
+        ---------
+        lower, upper : (rows, cols, 3) float
+          Corners of the bounding box of every tile
+        """
+        rows, cols = np.indices(self.tile_shape)
+        height, width = self.shape
+        c0 = cols * self.tile_size
+        r0 = rows * self.tile_size
+        c1 = np.minimum(c0 + self.tile_size, width - 1)
+        r1 = np.minimum(r0 + self.tile_size, height - 1)
+
+        corners = self.origin + np.stack((np.stack((c0, r0), axis=-1),
+                                          np.stack((c1, r1), axis=-1))) * self.pixel_size
+
+        lower = np.full(self.tile_shape + (3,), -np.inf)
+        upper = np.full(self.tile_shape + (3,), np.inf)
+        lower[..., :2] = corners.min(axis=0)
+        upper[..., :2] = corners.max(axis=0)
+
+        return lower, upper
+
+    def _tile_bounds(self, tile):
+        """
+        Read a tile's heights the first time its bounds are
+        needed, to narrow them down to the terrain.
+
+        Returns
+        ---------
+        lower, upper : (3,) float
+          Corners of the bounding box of the tile, skirts
+          included, NaN for a tile with no data
+        """
+        if not self._bounds_read[tile]:
+            zz = self._read_tile(tile)
+            if np.isnan(zz).all():
+                self.tile_lower[tile] = np.nan
+                self.tile_upper[tile] = np.nan
+            else:
+                self.tile_lower[tile][2] = np.nanmin(zz) - self.skirt
+                self.tile_upper[tile][2] = np.nanmax(zz)
+            self._bounds_read[tile] = True
+
+        return self.tile_lower[tile], self.tile_upper[tile]
+
+    def _build_tile(self, tile):
+        with instrument.span(instrument.MESH_BUILD):
+            c0, r0, _, _ = self._pixel_range(tile)
+            zz = self._read_tile(tile)
+
+            if self.max_error is None:
+                height, width = zz.shape
+                rows, cols = np.mgrid[0:height, 0:width]
+                pixels = np.column_stack((cols.ravel(), rows.ravel()))
+                faces = rtin.grid_faces(width, height).astype(np.int64)
+            else:
+                pixels, faces = rtin.triangulate(zz, self.max_error)
+                pixels = np.asarray(pixels, dtype=np.int64)
+                faces = np.asarray(faces, dtype=np.int64)
+
+            heights = zz[pixels[:, 1], pixels[:, 0]]
+            faces = faces[~np.isnan(heights[faces]).any(axis=1)]
+
+            # (col, row) of every vertex in the whole raster
+            pixels = (pixels + [c0, r0]).astype(np.float64)
+            face_ids = self._face_ids(pixels[faces].mean(axis=1))
+
+            if self.skirt > 0:
+                pixels, heights, faces, face_ids = self._add_skirts(tile, pixels, heights, faces, face_ids)
+
+            # float32 steps by 0.5 m at Web Mercator northings, so vertices are kept relative to the tile's corner
+            offset = np.zeros(3)
+            offset[:2] = self.origin + np.array([c0, r0]) * self.pixel_size
+
+            vertices = np.empty((len(pixels), 3), dtype=np.float32)
+            vertices[:, :2] = (pixels - [c0, r0]) * self.pixel_size
+            vertices[:, 2] = heights
+
+        instrument.count("tiles_built")
+        instrument.count("triangles", len(faces))
+
+        return _Shard(vertices, offset, faces, face_ids, self.backend, self.workers)
+
+    def _add_skirts(self, tile, pixels, heights, faces, face_ids):
+        """
+        Hang a skirt below every edge of a tile that it
+        shares with another tile.
+        """
+        c0, r0, c1, r1 = self._pixel_range(tile)
+        used = np.zeros(len(pixels), dtype=bool)
+        used[faces] = True
+
+        # (axis along the edge, axis across it, position, inwards)
+        edges = [(1, 0, c0, 1), (1, 0, c1, -1), (0, 1, r0, 1), (0, 1, r1, -1)]
+        height, width = self.shape
+        outer = (0, width - 1, 0, height - 1)
+
+        pixels = [pixels]
+        heights = [heights]
+        faces = [faces]
+        face_ids = [face_ids]
+        count = len(pixels[0])
+
+        for (along, across, position, inwards), border in zip(edges, outer):
+            if position == border:
+                continue
+
+            top = np.nonzero(used & (pixels[0][:, across] == position))[0]
+            top = top[np.argsort(pixels[0][top, along])]
+            if len(top) < 2:
+                continue
+
+            bottom = np.arange(count, count + len(top))
+            count += len(top)
+            pixels.append(pixels[0][top])
+            heights.append(heights[0][top] - self.skirt)
+
+            a, b = top[:-1], top[1:]
+            a_, b_ = bottom[:-1], bottom[1:]
+            faces.append(np.column_stack((a, b, b_, a, b_, a_)).reshape([-1, 3]))
+
+            # a skirt reports the face of the cell it hangs from
+            centre = (pixels[0][a] + pixels[0][b]) / 2
+            centre[:, across] += 0.25 * inwards
+            face_ids.append(np.repeat(self._face_ids(centre), 2))
+
+        return (np.concatenate(pixels), np.concatenate(heights),
+                np.concatenate(faces), np.concatenate(face_ids))
+
+    def _face_ids(self, pixels):
+        """
+        Index `DtmType.get_indices` gives the grid face under
+        each (col, row) point of the raster.
+        """
+        height, width = self.shape
+        c = np.clip(np.floor(pixels[:, 0]), 0, width - 2).astype(np.int64)
+        r = np.clip(np.floor(pixels[:, 1]), 0, height - 2).astype(np.int64)
+        u = pixels[:, 0] - c
+        v = pixels[:, 1] - r
+
+        # (a, a + width, a + width + 1) below the diagonal, then (a, a + width + 1, a + 1)
+        return 2 * (r * (width - 1) + c) + (u > v)
+
+
+class _Shard(object):
+    """
+    The mesh of one tile, and an intersector over it. The
+    mesh is relative to `offset`, so rays have to be moved by
+    -offset before they are traced against it.
+    """
+
+    def __init__(self, vertices, offset, faces, face_ids, backend, workers):
+        self.mesh = trimesh.Trimesh(vertices=vertices, faces=faces, process=False)
+        self.offset = offset
+        self.face_ids = face_ids
+
+        # the tile's scene lives and dies with the tile, and rays
+        # are already culled against the tile's bounds
+        self._registry = SceneRegistry(max_scenes=1)
+        self.intersector = make_intersector(self.mesh, backend=backend, registry=self._registry,
+                                            workers=workers, cull=False)
+
+    @property
+    def nbytes(self):
+        return (self.mesh.vertices.nbytes + self.mesh.faces.nbytes +
+                self.face_ids.nbytes + self._registry.nbytes)
+
+    def close(self):
+        """
+        Release the tile's scene, called by the registry when
+        the tile is detached.
+        """
+        self._registry.clear()
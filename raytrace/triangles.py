@@ -0,0 +1,76 @@
+"""
+Ray/triangle intersection, shared by the numpy backends so they
+treat rays through edges and corners the same way.
+"""
+
+import numpy as np
+
+# tolerance on barycentric coordinates so rays passing exactly
+# through a shared edge or the cell diagonal are not lost
+_barycentric_eps = 1e-7
+
+
+def ray_triangle(origins, directions, v0, v1, v2):
+    """
+    Vectorized Moller-Trumbore ray/triangle intersection.
+
+    Parameters
+    ----------
+    origins : (..., 3) float
+      Origins of rays
+    directions : (..., 3) float
+      Direction of rays
+    v0, v1, v2 : (..., 3) float
+      Triangle corners, broadcast against the rays
+
+    Returns
+    ----------
+    t : (...) float
+      Distance along each ray to its triangle, NaN on a miss
+    """
+    return ray_triangle_edges(origins, directions, v0, v1 - v0, v2 - v0)
+
+
+def ray_triangle_edges(origins, directions, v0, e1, e2):
+    """
+    Moller-Trumbore intersection of triangles given by their
+    first corner and the edges from it to the other two, which
+    can be computed once for a mesh, see `ray_triangle`.
+
+    Parameters
+    ----------
+    origins, directions : (..., 3) float
+      Rays
+    v0 : (..., 3) float
+      First corner of triangles
+    e1, e2 : (..., 3) float
+      Edges from the first corner to the other two
+
+    Returns
+    ----------
+    t : (...) float
+      Distance along each ray, NaN on a miss
+    """
+    e1 = np.asarray(e1, dtype=np.float64)
+    e2 = np.asarray(e2, dtype=np.float64)
+
+    p = np.cross(directions, e2)
+    det = np.einsum("...i,...i->...", e1, p)
+
+    # degenerate triangles and rays parallel to them give NaN,
+    # which every comparison below rejects
+    with np.errstate(divide="ignore", invalid="ignore"):
+        inv_det = 1.0 / det
+        s = origins - v0
+        u = np.einsum("...i,...i->...", s, p) * inv_det
+        q = np.cross(s, e1)
+        v = np.einsum("...i,...i->...", directions, q) * inv_det
+        t = np.einsum("...i,...i->...", e2, q) * inv_det
+
+        valid = ((det != 0) &
+                 (u >= -_barycentric_eps) &
+                 (v >= -_barycentric_eps) &
+                 (u + v <= 1 + _barycentric_eps) &
+                 (t >= 0))
+
+    return np.where(valid, t, np.nan)
@@ -0,0 +1,65 @@
+import contextlib
+import io
+import unittest
+
+import numpy as np
+
+from depthmap.batch import bbox_contains, bbox_grow, bbox_union, main, setup_group
+from depthmap.depthmap import make_camera
+from depthmap.planner import image_footprint
+from dtm.dtm import DtmType
+from tests.helpers import array_raster, survey_image
+
+
+class FlatDtmType(DtmType):
+    # Level ground at 100 m over whatever is asked for, high enough that make_camera raises the cameras by 200 m
+    def __init__(self, bbox, resolution=(2000, 2000), scale=1, max_error=None):
+        super().__init__(bbox, resolution, scale, cache=object(), max_error=max_error)
+
+    def get_raster(self, bbox):
+        width, height = (int(round(x * self.scale)) for x in self.resolution)
+        transform = (bbox[0], (bbox[2] - bbox[0]) / width, 0.0, bbox[3], 0.0, -(bbox[3] - bbox[1]) / height)
+        return array_raster(np.full((height, width), 100.0, dtype=np.float32), transform)
+
+
+class BatchTest(unittest.TestCase):
+    def assertRejected(self, *argv):
+        # Bad combinations of options fail while parsing, before any terrain is fetched
+        with self.assertRaises(SystemExit) as raised, contextlib.redirect_stderr(io.StringIO()):
+            main(["missing.csv", *argv])
+        self.assertEqual(raised.exception.code, 2)
+
+    def test_shards_need_one_mesh(self):
+        self.assertRejected("--shard-size", "64", "--incremental")
+        self.assertRejected("--shard-size", "64", "--progressive", "16")
+
+    def test_xyz_point_fields(self):
+        self.assertRejected("--points", "xyz", "--point-fields", "depth")
+
+    def test_heightfield_full_grid(self):
+        self.assertRejected("--backend", "heightfield", "--shard-size", "64")
+        self.assertRejected("--backend", "heightfield", "--max-error", "0.5")
+
+    def test_raised_cameras(self):
+        options = {"margin": 10, "dtm_scale": 0.1, "max_error": None, "resolution_scale": 0.01, "shard_size": 0,
+                   "backend": "numpy", "threads": 1, "radius": 3000}
+        jobs = [(f"{x}_{y}", survey_image(x, y, pitch=-60.0), (x, y)) for x, y in [(1000.0, 2000.0), (1200.0, 2050.0)]]
+
+        # Planned with the cameras 120 m above z = 0, as depthmap.planner does
+        bbox = None
+        for _, img, coords in jobs:
+            f = image_footprint(img, coords, radius=options["radius"])
+            bbox = f if bbox is None else bbox_union(bbox, f)
+
+        dtm, cameras, _ = setup_group(jobs, bbox, options, dtm_type=FlatDtmType)
+
+        for (_, img, coords), m_cam in zip(jobs, cameras):
+            self.assertEqual(m_cam.z_offset, 200.0)
+            # Rendered 220 m above the ground, the camera sees past the planned terrain, and the fetch covers it
+            needed = bbox_grow(m_cam.ground_footprint(100.0, max_distance=options["radius"]), options["margin"])
+            self.assertFalse(bbox_contains(bbox_grow(bbox, options["margin"]), needed))
+            self.assertTrue(bbox_contains(dtm.bbox, needed))
+
+
+if __name__ == '__main__':
+    unittest.main()
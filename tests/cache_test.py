@@ -0,0 +1,74 @@
+import os
+import tempfile
+import unittest
+
+from dtm.cache import RasterCache, RasterCacheMiss
+
+
+class RasterCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = RasterCache(self.tmp.name, max_bytes=1000, offline=False)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_key(self):
+        a = RasterCache.key("defra", (0, 0, 10, 10), "3857", "200,200")
+        self.assertEqual(a, RasterCache.key("defra", (0.0, 0.0, 10.0, 10.0), "3857", "200,200"))
+        self.assertNotEqual(a, RasterCache.key("gmrt", (0, 0, 10, 10), "3857", "200,200"))
+        self.assertNotEqual(a, RasterCache.key("defra", (0, 0, 10, 11), "3857", "200,200"))
+        self.assertNotEqual(a, RasterCache.key("defra", (0, 0, 10, 10), "3857", "100,100"))
+
+    def test_fetch_downloads_once(self):
+        calls = []
+
+        def download():
+            calls.append(1)
+            return b"raster"
+
+        key = RasterCache.key("defra", (0, 0, 10, 10), "3857", "200,200")
+        self.assertEqual(self.cache.fetch(key, download), b"raster")
+        self.assertEqual(self.cache.fetch(key, download), b"raster")
+        self.assertEqual(len(calls), 1)
+
+        # A second cache on the same directory, like another process, sees the entry
+        other = RasterCache(self.tmp.name, offline=True)
+        self.assertEqual(other.fetch(key, download), b"raster")
+
+    def test_offline(self):
+        cache = RasterCache(self.tmp.name, offline=True)
+
+        def download():
+            raise AssertionError("Offline caches must not download")
+
+        with self.assertRaises(RasterCacheMiss):
+            cache.fetch("missing", download)
+
+    def test_lru_eviction(self):
+        keys = [RasterCache.key("defra", (i, 0, 10, 10), "3857", "1") for i in range(4)]
+
+        for i, key in enumerate(keys):
+            self.cache.put(key, bytes(300))
+            # Make the order of use explicit, rather than relying on the clock resolution
+            os.utime(self.cache.path(key), (i, i))
+
+        self.cache.put(keys[0], bytes(300))
+        os.utime(self.cache.path(keys[0]), (10, 10))
+        self.cache.evict()
+
+        self.assertLessEqual(self.cache.size, 1000)
+        self.assertIsNotNone(self.cache.get(keys[0]))
+        self.assertIsNone(self.cache.get(keys[1]))
+        self.assertIsNotNone(self.cache.get(keys[3]))
+
+    def test_no_partial_files(self):
+        key = RasterCache.key("defra", (0, 0, 10, 10), "3857", "1")
+        self.cache.put(key, b"raster")
+
+        names = os.listdir(os.path.dirname(self.cache.path(key)))
+        self.assertEqual(names, [os.path.basename(self.cache.path(key))])
+
+
+if __name__ == '__main__':
+    unittest.main()
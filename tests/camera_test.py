@@ -0,0 +1,43 @@
+import unittest
+
+import numpy as np
+
+from depthmap.rays import image_rays
+from dtm.camera import DTCamera
+from tests.helpers import survey_image
+
+
+class CameraTest(unittest.TestCase):
+    def brute_force_footprint(self, m_cam, ground_z, max_distance):
+        # Follow the ray through every pixel down to the plane, or out to max_distance
+        width, height = (int(v) for v in m_cam.resolution)
+        rays = image_rays(width, height, m_cam.fov, distortion=m_cam.distortion).astype(np.float64)
+        rays = rays @ m_cam.image.rs_matrix()[:3, :3].T
+        origin = np.array(m_cam.cam_pt, dtype=np.float64)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = (ground_z - origin[2]) / rays[:, 2]
+        t = np.where(np.isfinite(t) & (t > 0), np.minimum(t, max_distance), max_distance)
+
+        pts = np.vstack((origin[:2] + rays[:, :2] * t[:, None], origin[:2]))
+        return np.concatenate((pts.min(axis=0), pts.max(axis=0)))
+
+    def test_ground_footprint(self):
+        for pitch, yaw, distortion in [(-5, 0, None), (-40, 30, None), (-60, 200, None), (-90, 0, None),
+                                       (-20, 75, (-0.15, 0.02, 0.001, 0.0005, 0.0))]:
+            img = survey_image(1000.0, 2000.0, yaw=yaw, pitch=pitch)
+            img.distortion = distortion
+            m_cam = DTCamera(image=img, coords=(1000.0, 2000.0))
+            m_cam.resolution = [400, 300]
+
+            footprint = np.array(m_cam.ground_footprint(0.0, max_distance=2000))
+            expected = self.brute_force_footprint(m_cam, 0.0, 2000)
+
+            # Covers every pixel, and not by much more
+            np.testing.assert_array_less(footprint[:2], expected[:2] + 0.5)
+            np.testing.assert_array_less(expected[2:], footprint[2:] + 0.5)
+            np.testing.assert_allclose(footprint, expected, rtol=0, atol=2.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
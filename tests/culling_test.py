@@ -0,0 +1,90 @@
+import unittest
+
+import numpy as np
+import trimesh
+
+import instrument
+from raytrace.culling import TerrainBounds
+from raytrace.numpyintersector import RayMeshIntersector
+from raytrace.scenecache import SceneRegistry
+from tests.helpers import grid_mesh
+
+
+class CullingTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(11)
+
+        yy, xx = np.mgrid[0:60, 0:80]
+        heights = 15 * np.sin(xx / 9) + 10 * np.cos(yy / 7) + rng.normal(0, 1, xx.shape)
+        # A valley along the middle, so low rays can pass over it
+        heights[25:35] -= 20
+        vertices, faces = grid_mesh(heights, (500000.0, 2.0, 0.0, 6000000.0, 0.0, -2.0))
+        self.mesh = trimesh.Trimesh(vertices=vertices.astype(np.float32), faces=faces, process=False)
+
+        # An oblique camera over the terrain, looking all around, up to above the horizon
+        n = 4000
+        self.origins = np.tile([500080.0, 5999940.0, 40.0], (n, 1))
+        yaw = rng.uniform(0, 2 * np.pi, n)
+        pitch = np.radians(rng.uniform(-60, 20, n))
+        self.directions = np.column_stack((np.cos(yaw) * np.cos(pitch), np.sin(yaw) * np.cos(pitch), np.sin(pitch)))
+
+    def test_bounds_contain_hits(self):
+        bounds = TerrainBounds.from_mesh(self.mesh.vertices, self.mesh.faces, cells=16)
+        self.assertEqual(bounds.cell_max.shape, (12, 16))
+        self.assertAlmostEqual(bounds.cell_max.max(), self.mesh.vertices[:, 2].max(), places=4)
+
+        t_near, t_far = bounds.clip(self.origins, self.directions)
+
+        _, distances, _ = RayMeshIntersector(self.mesh, registry=SceneRegistry(), cull=False) \
+            .intersects_first_location(self.origins, self.directions)
+        hit = np.isfinite(distances)
+
+        # Every hit is inside its ray's clipped range, and every ray above the horizon is culled
+        self.assertTrue(hit.any() and not hit.all())
+        self.assertTrue((t_near[hit] <= distances[hit]).all())
+        self.assertTrue((distances[hit] <= t_far[hit]).all())
+        self.assertTrue((t_near[self.directions[:, 2] > 0] > t_far[self.directions[:, 2] > 0]).all())
+
+        # Some rays that reach the terrain's box still provably miss, and others start well past the camera
+        in_box = (self.directions[:, 2] < 0) & ~hit
+        self.assertTrue((t_near[in_box] > t_far[in_box]).any())
+        self.assertGreater(np.median(t_near[hit]), 0)
+
+    def test_vertical_rays(self):
+        bounds = TerrainBounds.from_mesh(self.mesh.vertices, self.mesh.faces)
+
+        origins = np.array([[500050.3, 5999950.7, 100.0], [500050.3, 5999950.7, 100.0], [400000.0, 5999950.7, 100.0]])
+        t_near, t_far = bounds.clip(origins, [[0, 0, -1], [0, 0, 1], [0, 0, -1]])
+
+        np.testing.assert_array_equal(t_near <= t_far, [True, False, False])
+        self.assertLess(t_near[0], 100 - self.mesh.vertices[:, 2].max())
+        self.assertGreater(t_far[0], 100 - self.mesh.vertices[:, 2].min())
+
+    def test_same_results(self):
+        plain = RayMeshIntersector(self.mesh, registry=SceneRegistry(), cull=False)
+        culled = RayMeshIntersector(self.mesh, registry=SceneRegistry())
+
+        recorder = instrument.Recorder()
+        with instrument.recording(recorder):
+            locations, distances, triangles = culled.intersects_first_location(self.origins, self.directions)
+
+        expected_locations, expected_distances, expected_triangles = plain.intersects_first_location(
+            self.origins, self.directions)
+
+        np.testing.assert_array_equal(triangles, expected_triangles)
+        np.testing.assert_array_equal(distances, expected_distances)
+        np.testing.assert_array_equal(locations, expected_locations)
+
+        misses = int(np.isinf(expected_distances).sum())
+        self.assertGreater(recorder.counters["culled_rays"], misses / 2)
+        self.assertLessEqual(recorder.counters["culled_rays"], misses)
+
+        # Every hit along the rays
+        _, _, index_ray, index_tri = culled.intersects_location(self.origins, self.directions)
+        _, _, expected_ray, expected_tri = plain.intersects_location(self.origins, self.directions)
+        np.testing.assert_array_equal(index_ray, expected_ray)
+        np.testing.assert_array_equal(index_tri, expected_tri)
+
+
+if __name__ == '__main__':
+    unittest.main()
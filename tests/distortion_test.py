@@ -0,0 +1,34 @@
+import unittest
+
+import numpy as np
+
+from dtm.distortion import distort, undistort
+from dtm.image import Image
+
+
+class DistortionTest(unittest.TestCase):
+    def test_round_trip(self):
+        x, y = np.meshgrid(np.linspace(-0.7, 0.7, 30), np.linspace(-0.5, 0.5, 20))
+
+        for coefficients in [(-0.12, 0.03, 0.001, -0.0005, 0.0), (-0.25, 0.08, 0.0, 0.0, -0.01), (0.1, 0, 0, 0, 0)]:
+            xd, yd = distort(*undistort(x, y, coefficients), coefficients)
+
+            np.testing.assert_allclose(xd, x, atol=1e-9)
+            np.testing.assert_allclose(yd, y, atol=1e-9)
+
+    def test_barrel(self):
+        # Barrel distortion pulls points towards the centre, more so further out
+        xd, yd = distort(np.array([0.0, 0.2, 0.6]), np.zeros(3), (-0.2, 0, 0, 0, 0))
+
+        np.testing.assert_allclose(yd, 0)
+        self.assertEqual(xd[0], 0)
+        self.assertTrue((xd[1:] < [0.2, 0.6]).all())
+        self.assertLess(xd[2] / 0.6, xd[1] / 0.2)
+
+    def test_image_columns(self):
+        row = {"file_name": "a.jpg", "wkt_geom": "[0 0 100]", "vp_geom": "[0 0 0]", "roll": "0", "pitch": "-30",
+               "yaw": "0", "x_pixels": "4000", "y_pixels": "3000", "fov": "70"}
+
+        self.assertIsNone(Image(row).distortion)
+        self.assertIsNone(Image({**row, "k1": "0", "k2": ""}).distortion)
+        self.assertEqual(Image({**row, "k1": "-0.1", "p2": "0.002"}).distortion, (-0.1, 0, 0, 0.002, 0))
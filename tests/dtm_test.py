@@ -0,0 +1,67 @@
+import unittest
+
+import numpy as np
+
+from raytrace.backends import available_backends, make_dtm_intersector
+from raytrace.scenecache import SceneRegistry
+from tests.helpers import ArrayDtmType
+
+
+class DtmTest(unittest.TestCase):
+    def setUp(self):
+        yy, xx = np.mgrid[0:40, 0:50]
+        self.heights = (20 * np.sin(xx / 7) + 10 * np.cos(yy / 5) + 150).astype(np.float32)
+        # Web Mercator northings are ~7e6, where float32 steps by 0.5 m
+        self.transform = (-296820.3, 0.7, 0.0, 7007582.9, 0.0, -0.7)
+
+    def test_vertices_keep_precision(self):
+        dtm = ArrayDtmType(self.heights, self.transform)
+        dtm.set_window((-296810.0, 7007560.0, -296800.0, 7007570.0))
+
+        vertices, faces = dtm.mesh_arrays
+        self.assertEqual(vertices.dtype, np.float32)
+        self.assertEqual(faces.dtype, np.uint32)
+
+        xoff, yoff, width, height = dtm.raster_window
+        x = self.transform[0] + (xoff + np.arange(width)) * self.transform[1]
+        y = self.transform[3] + (yoff + np.arange(height)) * self.transform[5]
+        expected = np.column_stack((np.tile(x, height), np.repeat(y, width),
+                                    self.heights[yoff:yoff + height, xoff:xoff + width].ravel()))
+
+        # Relative to the origin in float32, and absolute in the float64 trimesh, both to well under a millimetre
+        np.testing.assert_allclose(vertices + dtm.origin, expected, rtol=0, atol=1e-4)
+        np.testing.assert_allclose(dtm.trimesh.vertices, expected, rtol=0, atol=1e-4)
+
+    def test_simplified_vertices_keep_precision(self):
+        dtm = ArrayDtmType(self.heights, self.transform, max_error=0.5)
+
+        vertices, _ = dtm.mesh_arrays
+        col = np.rint((vertices[:, 0] + dtm.origin[0] - self.transform[0]) / self.transform[1]).astype(int)
+        row = np.rint((vertices[:, 1] + dtm.origin[1] - self.transform[3]) / self.transform[5]).astype(int)
+
+        np.testing.assert_allclose(dtm.trimesh.vertices[:, 0], self.transform[0] + col * self.transform[1], atol=1e-4)
+        np.testing.assert_allclose(dtm.trimesh.vertices[:, 1], self.transform[3] + row * self.transform[5], atol=1e-4)
+        np.testing.assert_array_equal(vertices[:, 2], self.heights[row, col])
+
+    def test_intersectors_keep_precision(self):
+        # A slope up the rows, so half a metre of rounding in y shows as a quarter of a metre in the hit heights
+        yy, _ = np.mgrid[0:40, 0:50]
+        dtm = ArrayDtmType((100.0 + 0.5 * yy).astype(np.float32), self.transform)
+
+        rng = np.random.default_rng(2)
+        x = rng.uniform(-296819.0, -296787.0, 200)
+        y = rng.uniform(7007556.0, 7007581.0, 200)
+        origins = np.column_stack((x, y, np.full(len(x), 200.0)))
+        directions = np.tile([0.0, 0.0, -1.0], (len(origins), 1))
+        expected = 100.0 + 0.5 * (self.transform[3] - y) / -self.transform[5]
+
+        for backend in available_backends():
+            intersector = make_dtm_intersector(dtm, backend=backend, registry=SceneRegistry())
+            locations, distances, _ = intersector.intersects_first_location(origins, directions)
+
+            np.testing.assert_allclose(locations[:, 2], expected, rtol=0, atol=1e-3, err_msg=backend)
+            np.testing.assert_allclose(distances, 200.0 - expected, rtol=0, atol=1e-3, err_msg=backend)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import trimesh
+
+from depthmap.depthmap import render_depthmap
+from depthmap.export import PointWriter, open_point_writer, point_dtype, write_point_cloud
+from raytrace.numpyintersector import RayMeshIntersector
+from raytrace.scenecache import SceneRegistry
+from tests.helpers import grid_mesh, oblique_camera
+
+
+def read_ply(path):
+    # Minimal reader for the binary little endian PLYs PlyPointWriter writes
+    with open(path, "rb") as f:
+        header = []
+        while not header or header[-1] != "end_header":
+            header.append(f.readline().decode("ascii").strip())
+
+        types = {"double": "<f8", "float": "<f4", "int": "<i4"}
+        dtype = np.dtype([(line.split()[2], types[line.split()[1]]) for line in header if line.startswith("property")])
+        count = int(next(line for line in header if line.startswith("element vertex")).split()[2])
+
+        return header, np.frombuffer(f.read(), dtype=dtype, count=count)
+
+
+class ExportTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+        self.camera = (-297000.0, 7007000.0, 120.0)
+        self.hits = np.array([[False, True, True], [True, False, True]])
+        self.locs = np.array([[-297001.5, 7007002.25, 3.0], [-297002.0, 7007003.0, 4.5],
+                              [-297003.0, 7007004.0, 5.0], [-297004.0, 7007005.0, 6.0]])
+        self.triangles = np.array([7, 8, 9, 10])
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmp.name, name)
+
+    def test_ply(self):
+        path = self.path("points.ply")
+        write_point_cloud(path, self.camera, self.locs, self.hits, self.triangles,
+                          fields=("pixel", "depth", "triangle"))
+
+        header, points = read_ply(path)
+
+        self.assertIn("comment camera -297000.0 7007000.0 120.0", header)
+        self.assertEqual(list(points.dtype.names), ["x", "y", "z", "depth", "triangle", "col", "row"])
+        np.testing.assert_array_equal(np.column_stack((points["x"], points["y"], points["z"])), self.locs)
+        np.testing.assert_allclose(points["depth"], np.linalg.norm(self.locs - self.camera, axis=1), rtol=1e-6)
+        np.testing.assert_array_equal(points["triangle"], self.triangles)
+        np.testing.assert_array_equal(points["col"], [1, 2, 0, 2])
+        np.testing.assert_array_equal(points["row"], [0, 0, 1, 1])
+
+    def test_npy(self):
+        path = self.path("points.npy")
+        write_point_cloud(path, self.camera, self.locs, self.hits, fields=("pixel",))
+
+        points = np.load(path)
+
+        self.assertEqual(points.dtype, point_dtype(("pixel",)))
+        np.testing.assert_array_equal(points["x"], self.locs[:, 0])
+        np.testing.assert_array_equal(points["col"], [1, 2, 0, 2])
+
+    def test_append_tiles(self):
+        for name in ["points.ply", "points.npy"]:
+            path = self.path(name)
+
+            # Two tiles side by side, then a third after reopening the file
+            writer = open_point_writer(path, self.camera, ("pixel",))
+            writer.write(self.locs, self.hits, window=(0, 0, 3, 2))
+            writer.write(self.locs[:2], self.hits[:1], window=(3, 0, 3, 1))
+            writer.close()
+
+            writer = open_point_writer(path, self.camera, ("pixel",), append=True)
+            writer.write(self.locs[:1], self.hits[:1, :2], window=(0, 2, 2, 1))
+            writer.close()
+
+            points = read_ply(path)[1] if name.endswith(".ply") else np.load(path)
+            self.assertEqual(len(points), 7)
+            np.testing.assert_array_equal(points["col"], [1, 2, 0, 2, 4, 5, 1])
+            np.testing.assert_array_equal(points["row"], [0, 0, 1, 1, 0, 0, 2])
+
+            with self.assertRaises(ValueError):
+                open_point_writer(path, self.camera, ("depth",), append=True)
+
+    def test_xyz(self):
+        path = self.path("points.xyz")
+        write_point_cloud(path, self.camera, self.locs[:2])
+
+        with open(path) as f:
+            self.assertEqual(f.read(), "-297000.0,7007000.0,120.0\n-297001.5,7007002.25,3.0\n-297002.0,7007003.0,4.5\n")
+
+        with self.assertRaises(ValueError):
+            open_point_writer(path, self.camera, ("depth",))
+
+        # Every writer has to say what its header is
+        with self.assertRaises(TypeError):
+            PointWriter(path, self.camera)
+
+    def test_close_hits(self):
+        # Hits closer than half a metre have a depth of 0, but are still pixels with a hit
+        vertices, faces = grid_mesh(np.zeros((10, 10)), (0, 1, 0, 0, 0, 1))
+        intersector = RayMeshIntersector(trimesh.Trimesh(vertices=vertices, faces=faces, process=False),
+                                         registry=SceneRegistry())
+        m_cam = oblique_camera((4.5, 4.5, 0.3), yaw=0, tilt=0, resolution=(8, 6))
+
+        depth, locs, triangles, hits = render_depthmap(m_cam, intersector, return_triangles=True, return_hits=True)
+        self.assertTrue(hits.all())
+        self.assertTrue((depth == 0).any())
+
+        path = self.path("points.npy")
+        write_point_cloud(path, m_cam.cam_pt, locs, hits, triangles, fields=("pixel", "triangle"))
+
+        points = np.load(path)
+        rows, cols = np.mgrid[0:6, 0:8]
+        np.testing.assert_array_equal(points["col"], cols.ravel())
+        np.testing.assert_array_equal(points["row"], rows.ravel())
+
+    def test_missing_fields(self):
+        with self.assertRaises(ValueError):
+            point_dtype(("normal",))
+
+        writer = open_point_writer(self.path("points.ply"), self.camera, ("triangle", "pixel"))
+        try:
+            with self.assertRaises(ValueError):
+                writer.write(self.locs, self.hits)
+            with self.assertRaises(ValueError):
+                writer.write(self.locs[:3], self.hits, triangles=self.triangles[:3])
+        finally:
+            writer.close()
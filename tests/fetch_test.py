@@ -0,0 +1,219 @@
+import tempfile
+import threading
+import unittest
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+from osgeo import gdal
+
+from dtm.DefraDtmType import DefraDtmType
+from dtm.cache import RasterCache
+from dtm.fetch import ExpiringCache, fetch_tiles, make_session, split_bbox
+
+
+class TileHandler(BaseHTTPRequestHandler):
+    # Stands in for the ImageServer, echoing the requested bbox, and failing the first request for every bbox
+    failed = set()
+    lock = threading.Lock()
+
+    def do_GET(self):
+        bbox = parse_qs(urlparse(self.path).query)["bbox"][0]
+
+        with self.lock:
+            first = bbox not in self.failed
+            self.failed.add(bbox)
+
+        if first:
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        body = bbox.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def plane(x, y):
+    # Terrain the ExportHandler serves, a tilted plane so every pixel has a different height
+    return 0.25 * (x - 1000) + 0.5 * (y - 2000)
+
+
+def geotiff(bbox: (float, float, float, float), size: (int, int)) -> bytes:
+    minx, miny, maxx, maxy = bbox
+    width, height = size
+    px, py = (maxx - minx) / width, (maxy - miny) / height
+
+    name = f"/vsimem/{uuid.uuid4().hex}.tiff"
+    ds = gdal.GetDriverByName("GTiff").Create(name, width, height, 1, gdal.GDT_Float32)
+    ds.SetGeoTransform((minx, px, 0, maxy, 0, -py))
+    x = minx + (np.arange(width) + 0.5) * px
+    y = maxy - (np.arange(height) + 0.5) * py
+    ds.GetRasterBand(1).WriteArray(plane(x[None, :], y[:, None]))
+    ds = None
+
+    f = gdal.VSIFOpenL(name, "rb")
+    gdal.VSIFSeekL(f, 0, 2)
+    length = gdal.VSIFTellL(f)
+    gdal.VSIFSeekL(f, 0, 0)
+    data = gdal.VSIFReadL(1, length, f)
+    gdal.VSIFCloseL(f)
+    gdal.Unlink(name)
+
+    return data
+
+
+class ExportHandler(BaseHTTPRequestHandler):
+    # Stands in for the ImageServer's exportImage, rendering a GeoTIFF of the requested bbox and size
+    requests = []
+    lock = threading.Lock()
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        bbox = tuple(float(v) for v in query["bbox"][0].split(","))
+        size = tuple(int(float(v)) for v in query["size"][0].split(","))
+
+        with self.lock:
+            self.requests.append((bbox, size))
+
+        body = geotiff(bbox, size)
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FetchTest(unittest.TestCase):
+    def setUp(self):
+        TileHandler.failed = set()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), TileHandler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/exportImage"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_split_bbox(self):
+        tiles = split_bbox((1000, 2000, 1500, 2300), (5000, 3000), 2000)
+
+        self.assertEqual(len(tiles), 6)
+        self.assertEqual(tiles[0].offset, (0, 0))
+        self.assertEqual(tiles[0].size, (2000, 2000))
+        self.assertEqual(tiles[-1].offset, (4000, 2000))
+        self.assertEqual(tiles[-1].size, (1000, 1000))
+
+        # The first tile is the top left, and tiles cover the bbox exactly
+        self.assertEqual(tiles[0].bbox, (1000, 2100, 1200, 2300))
+        self.assertEqual(sum(t.size[0] * t.size[1] for t in tiles), 5000 * 3000)
+        self.assertAlmostEqual(min(t.bbox[1] for t in tiles), 2000)
+        self.assertAlmostEqual(max(t.bbox[2] for t in tiles), 1500)
+
+    def test_single_tile(self):
+        tiles = split_bbox((0, 0, 10, 10), (100, 100), 2000)
+        self.assertEqual(len(tiles), 1)
+        self.assertEqual(tiles[0].bbox, (0, 0, 10, 10))
+
+    def test_fetch_retries_and_keeps_order(self):
+        session = make_session(pool_size=4, retries=3, backoff=0)
+        tiles = split_bbox((0, 0, 40, 30), (40, 30), 10)
+
+        def download(tile):
+            resp = session.get(self.url, params={"bbox": ",".join(str(x) for x in tile.bbox)})
+            resp.raise_for_status()
+            return resp.content
+
+        data = fetch_tiles(tiles, download, workers=4)
+
+        self.assertEqual(len(data), 12)
+        self.assertEqual([d.decode("utf-8") for d in data], [",".join(str(x) for x in t.bbox) for t in tiles])
+
+
+class DefraDtmTypeTest(unittest.TestCase):
+    def setUp(self):
+        gdal.UseExceptions()
+        ExportHandler.requests = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), ExportHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = RasterCache(self.tmp.name, offline=False)
+
+        url = f"http://127.0.0.1:{self.server.server_address[1]}/exportImage"
+        self.dtm_type = type("LocalDefraDtmType", (DefraDtmType,), {"url": url, "max_tile_size": 16})
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def test_mosaic(self):
+        dtm = self.dtm_type((1000, 2000, 1040, 2030), resolution=(40, 30), cache=self.cache,
+                            session=make_session(retries=0))
+
+        # Fetched as 3 x 2 tiles, and stitched back into the whole raster
+        self.assertEqual(len(ExportHandler.requests), 6)
+        self.assertEqual((dtm.raster.RasterXSize, dtm.raster.RasterYSize), (40, 30))
+        np.testing.assert_allclose(dtm.raster.GetGeoTransform(), (1000, 1, 0, 2030, 0, -1))
+
+        x = 1000.5 + np.arange(40)
+        y = 2029.5 - np.arange(30)
+        np.testing.assert_allclose(dtm.read_heights(), plane(x[None, :], y[:, None]), atol=1e-3)
+
+        # The VRT and every tile live in /vsimem until the DTM is closed
+        names = dtm.raster.GetFileList()
+        self.assertEqual(len(names), 7)
+        self.assertTrue(all(n.startswith("/vsimem/") and gdal.VSIStatL(n) is not None for n in names))
+
+        dtm.close()
+        self.assertTrue(all(gdal.VSIStatL(n) is None for n in names))
+
+        # The tiles are cached, so reopening doesn't download them again
+        dtm = self.dtm_type((1000, 2000, 1040, 2030), resolution=(40, 30), cache=self.cache,
+                            session=make_session(retries=0))
+        self.assertEqual(len(ExportHandler.requests), 6)
+        dtm.close()
+
+    def test_single_request(self):
+        dtm = self.dtm_type((1000, 2000, 1010, 2010), resolution=(10, 10), cache=self.cache,
+                            session=make_session(retries=0))
+        self.assertEqual(ExportHandler.requests, [((1000, 2000, 1010, 2010), (10, 10))])
+
+        names = dtm.raster.GetFileList()
+        self.assertEqual(len(names), 1)
+
+        dtm.close()
+        self.assertIsNone(gdal.VSIStatL(names[0]))
+
+
+class ExpiringCacheTest(unittest.TestCase):
+    def test_ttl(self):
+        now = [0.0]
+        built = []
+        cache = ExpiringCache(ttl=10, clock=lambda: now[0])
+
+        def factory():
+            built.append(now[0])
+            return len(built)
+
+        self.assertEqual(cache.get("wms", factory), 1)
+        now[0] = 9
+        self.assertEqual(cache.get("wms", factory), 1)
+        self.assertEqual(cache.get("other", factory), 2)
+
+        # Expired values are rebuilt
+        now[0] = 10
+        self.assertEqual(cache.get("wms", factory), 3)
+
+        cache.clear()
+        self.assertEqual(cache.get("wms", factory), 4)
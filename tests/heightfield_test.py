@@ -0,0 +1,115 @@
+import unittest
+
+import numpy as np
+import trimesh
+
+from raytrace import backends
+from raytrace.heightfieldintersector import HeightfieldIntersector
+from raytrace.scenecache import SceneRegistry
+from tests.helpers import ArrayDtmType, brute_force_first, grid_mesh
+
+
+class HeightfieldTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(42)
+
+        yy, xx = np.mgrid[0:20, 0:25]
+        self.heights = 10 * np.sin(xx / 5) + 8 * np.cos(yy / 4) + rng.normal(0, 1, xx.shape)
+        self.transform = (1000.0, 2.0, 0.0, 5000.0, 0.0, -2.0)
+
+        n = 1000
+        self.origins = np.column_stack((rng.uniform(1000, 1048, n),
+                                        rng.uniform(4962, 5000, n),
+                                        rng.uniform(20, 60, n)))
+        directions = np.column_stack((rng.normal(0, 0.3, n),
+                                      rng.normal(0, 0.3, n),
+                                      rng.uniform(-1, -0.05, n)))
+        self.directions = directions / np.linalg.norm(directions, axis=1)[:, None]
+
+        self.intersector = HeightfieldIntersector(self.heights, self.transform)
+        self.vertices, self.faces = grid_mesh(self.heights, self.transform)
+
+    def test_matches_mesh(self):
+        expected_tri, expected_t = brute_force_first(self.origins, self.directions,
+                                                     self.vertices, self.faces)
+
+        locations, distances, index_ray, index_tri = self.intersector.intersects_location(
+            self.origins, self.directions, multiple_hits=False)
+
+        self.assertTrue((expected_tri >= 0).any())
+        np.testing.assert_array_equal(self.intersector.intersects_first(self.origins, self.directions),
+                                      expected_tri)
+        np.testing.assert_array_equal(np.isinf(distances), np.isinf(expected_t))
+        np.testing.assert_allclose(distances[index_ray], expected_t[index_ray])
+        np.testing.assert_allclose(locations,
+                                   self.origins[index_ray] + self.directions[index_ray] * distances[index_ray, None])
+
+    def test_first_location_aligned(self):
+        locations, distances, index_tri = self.intersector.intersects_first_location(self.origins, self.directions)
+        compact, _, index_ray, _ = self.intersector.intersects_location(self.origins, self.directions,
+                                                                        multiple_hits=False)
+
+        self.assertEqual(distances.dtype, np.float32)
+        np.testing.assert_array_equal(index_tri, self.intersector.intersects_first(self.origins, self.directions))
+        np.testing.assert_array_equal(np.nonzero(index_tri >= 0)[0], index_ray)
+        np.testing.assert_array_equal(np.isinf(distances), index_tri < 0)
+        self.assertTrue(np.isnan(locations[index_tri < 0]).all())
+        np.testing.assert_allclose(locations[index_ray], compact, atol=1e-3)
+
+    def test_multiple_hits(self):
+        _, _, index_ray, index_tri = self.intersector.intersects_location(
+            self.origins, self.directions, multiple_hits=True)
+
+        first = self.intersector.intersects_first(self.origins, self.directions)
+        self.assertGreaterEqual(len(index_ray), (first >= 0).sum())
+
+        # The first hit reported for each ray is its nearest one
+        _, start = np.unique(index_ray, return_index=True)
+        np.testing.assert_array_equal(index_tri[start], first[index_ray[start]])
+
+    def test_nodata(self):
+        heights = self.heights.copy()
+        heights[:, :] = -9999
+        intersector = HeightfieldIntersector(heights, self.transform, nodata=-9999)
+
+        self.assertFalse(intersector.intersects_any(self.origins, self.directions).any())
+
+    def test_backend(self):
+        dtm = ArrayDtmType(self.heights, self.transform)
+        heightfield = backends.make_dtm_intersector(dtm, backend="heightfield", workers=4)
+        self.assertIsInstance(heightfield, HeightfieldIntersector)
+        heightfield.build_scene()
+
+        locations, distances, triangles = heightfield.intersects_first_location(self.origins, self.directions)
+        self.assertTrue((triangles >= 0).any() and (triangles < 0).any())
+        # No mesh is built to trace the grid
+        self.assertIsNone(dtm._trimesh)
+
+        # The same first hits as the mesh backends, through the same factory
+        for backend in backends.available_backends(meshes=True):
+            expected_locations, expected_distances, expected_triangles = backends.make_dtm_intersector(
+                dtm, backend=backend, registry=SceneRegistry()).intersects_first_location(self.origins, self.directions)
+
+            hit = expected_triangles >= 0
+            np.testing.assert_array_equal(triangles >= 0, hit, err_msg=backend)
+            self.assertGreater((triangles == expected_triangles).mean(), 0.99, msg=backend)
+            np.testing.assert_allclose(distances[hit], expected_distances[hit], rtol=1e-5, err_msg=backend)
+            np.testing.assert_allclose(locations[hit], expected_locations[hit], atol=1e-3, err_msg=backend)
+
+        # The mesh it is asked for has the faces of its face ids
+        np.testing.assert_array_equal(heightfield.mesh.faces, dtm.get_indices())
+
+    def test_backend_needs_dtm(self):
+        self.assertIn("heightfield", backends.available_backends())
+        self.assertNotIn("heightfield", backends.available_backends(meshes=True))
+
+        vertices, faces = grid_mesh(self.heights, self.transform)
+        with self.assertRaises(ValueError):
+            backends.make_intersector(trimesh.Trimesh(vertices=vertices, faces=faces, process=False),
+                                      backend="heightfield")
+        with self.assertRaises(ValueError):
+            HeightfieldIntersector.from_dtm(ArrayDtmType(self.heights, self.transform, max_error=0.5))
+
+
+if __name__ == '__main__':
+    unittest.main()
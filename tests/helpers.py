@@ -0,0 +1,75 @@
+"""
+Meshes, rays and cameras shared by the tests.
+"""
+
+import types
+
+import numpy as np
+from scipy.spatial.transform import Rotation
+
+from dtm import rtin
+from dtm.dtm import DtmType
+from dtm.image import Image
+from raytrace.triangles import ray_triangle
+
+
+def grid_mesh(heights, geo_transform):
+    # Build the same vertices and faces as DtmType.get_vertices / get_indices
+    x0, px, _, y0, _, py = geo_transform
+    height, width = heights.shape
+
+    xx, yy = np.meshgrid(np.arange(width) * px + x0, np.arange(height) * py + y0)
+    vertices = np.column_stack((xx.ravel(), yy.ravel(), heights.ravel()))
+
+    return vertices, rtin.grid_faces(width, height)
+
+
+def brute_force_first(origins, directions, vertices, faces):
+    # Test every ray against every triangle
+    n, f = len(origins), len(faces)
+    tri = vertices[faces]
+
+    t = ray_triangle(np.repeat(origins, f, axis=0),
+                     np.repeat(directions, f, axis=0),
+                     np.tile(tri[:, 0], (n, 1)),
+                     np.tile(tri[:, 1], (n, 1)),
+                     np.tile(tri[:, 2], (n, 1))).reshape(n, f)
+    t = np.where(np.isnan(t), np.inf, t)
+
+    first = np.where(np.isinf(t).all(axis=1), -1, np.argmin(t, axis=1))
+    return first, t.min(axis=1)
+
+
+def oblique_camera(position, yaw, tilt=55.0, resolution=(80, 60), fov=(60.0, 47.0), distortion=None):
+    # Tilted up from looking straight down, then turned about the vertical
+    rotation = Rotation.from_euler("ZX", [yaw, tilt], degrees=True).as_matrix()
+
+    return types.SimpleNamespace(resolution=list(resolution), fov=np.array(fov), cam_pt=np.array(position),
+                                 distortion=distortion, image=types.SimpleNamespace(rs_matrix=lambda: rotation))
+
+
+def survey_image(x, y, yaw=0.0, pitch=-40.0):
+    return Image({"file_name": f"{x}_{y}.jpg", "wkt_geom": "[0 0 120]", "vp_geom": "[0 0 0]", "roll": "0",
+                  "pitch": str(pitch), "yaw": str(yaw), "x_pixels": "4000", "y_pixels": "3000", "fov": "70"})
+
+
+def array_raster(heights, geo_transform):
+    # Just enough of a GDAL dataset over an in-memory array for DtmType
+    band = types.SimpleNamespace(
+        ReadAsArray=lambda xoff=0, yoff=0, xsize=None, ysize=None: heights[
+            yoff:yoff + (ysize or heights.shape[0]), xoff:xoff + (xsize or heights.shape[1])],
+        GetNoDataValue=lambda: None)
+
+    return types.SimpleNamespace(GetGeoTransform=lambda: geo_transform, GetRasterBand=lambda i: band,
+                                 GetFileList=lambda: [], RasterXSize=heights.shape[1], RasterYSize=heights.shape[0])
+
+
+class ArrayDtmType(DtmType):
+    # A DTM over an in-memory array
+    def __init__(self, heights, geo_transform, max_error=None):
+        self.heights = heights
+        self.transform = geo_transform
+        super().__init__((0, 0, 0, 0), resolution=heights.shape[::-1], cache=object(), max_error=max_error)
+
+    def get_raster(self, bbox):
+        return array_raster(self.heights, self.transform)
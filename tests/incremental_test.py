@@ -0,0 +1,65 @@
+import unittest
+
+import numpy as np
+
+from benchmarks.synthetic import synthetic_mesh
+from depthmap.depthmap import camera_rays
+from depthmap.incremental import project, render_frame, render_sequence
+from raytrace.numpyintersector import RayMeshIntersector
+from tests.helpers import oblique_camera
+
+
+def full_depth(m_cam, intersector):
+    vectors = camera_rays(m_cam) @ m_cam.image.rs_matrix()[:3, :3].T
+    origins = np.broadcast_to(m_cam.cam_pt, vectors.shape)
+    _, distances, triangles = intersector.intersects_first_location(origins, vectors)
+
+    return np.where(triangles >= 0, np.round(distances), 0).astype(np.float32).reshape([m_cam.resolution[1], -1])
+
+
+class IncrementalTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.intersector = RayMeshIntersector(synthetic_mesh(150))
+
+    def test_project(self):
+        for distortion in [None, (-0.15, 0.02, 0.001, 0.0005, 0.0)]:
+            m_cam = oblique_camera((75, 20, 60), yaw=10, distortion=distortion)
+            vectors = camera_rays(m_cam) @ m_cam.image.rs_matrix()[:3, :3].T
+
+            cols, rows, distance = project(m_cam, m_cam.cam_pt + vectors * 30)
+
+            rr, cc = np.mgrid[0:60, 0:80]
+            np.testing.assert_allclose(cols, cc.ravel(), atol=1e-4)
+            np.testing.assert_allclose(rows, rr.ravel(), atol=1e-4)
+            np.testing.assert_allclose(distance, 30, rtol=1e-6)
+
+    def test_first_frame(self):
+        m_cam = oblique_camera((75, 20, 60), yaw=10)
+        frame = render_frame(m_cam, self.intersector)
+
+        self.assertEqual(frame.traced, 80 * 60)
+        np.testing.assert_array_equal(frame.depth, full_depth(m_cam, self.intersector))
+        self.assertEqual(len(frame.hits), (frame.depth > 0).sum())
+
+    def test_sequence_matches_full_render(self):
+        # Fine enough that pixels are about the size of the triangles
+        cameras = [oblique_camera((75 + 0.5 * i, 20 + 0.25 * i, 30), yaw=10 + 0.3 * i, resolution=(160, 120))
+                   for i in range(4)]
+        frames = list(render_sequence(cameras, self.intersector))
+
+        for m_cam, frame in zip(cameras, frames):
+            np.testing.assert_array_equal(frame.depth, full_depth(m_cam, self.intersector))
+
+        # Most of the terrain is still in view, so most pixels are reused
+        for frame in frames[1:]:
+            self.assertLess(frame.traced, 0.5 * (frame.depth > 0).sum() + (frame.depth == 0).sum())
+
+    def test_large_move(self):
+        previous = render_frame(oblique_camera((75, 20, 60), yaw=10), self.intersector)
+
+        # Looking the other way, nothing can be reused
+        m_cam = oblique_camera((75, 130, 60), yaw=190)
+        frame = render_frame(m_cam, self.intersector, previous)
+
+        np.testing.assert_array_equal(frame.depth, full_depth(m_cam, self.intersector))
@@ -0,0 +1,77 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+import instrument
+
+
+class InstrumentTest(unittest.TestCase):
+    def test_inactive_is_noop(self):
+        self.assertIsNone(instrument.active())
+
+        with instrument.span(instrument.TRACE):
+            instrument.count("rays", 10)
+
+    def test_spans_and_counters(self):
+        recorder = instrument.Recorder("img")
+
+        with instrument.recording(recorder):
+            for _ in range(2):
+                with instrument.span(instrument.TRACE):
+                    instrument.count("rays", 100)
+                    instrument.count("hits", 25)
+
+            # Counts from other threads go to the same recorder
+            t = threading.Thread(target=instrument.count, args=("bytes_downloaded", 1024))
+            t.start()
+            t.join()
+
+        self.assertIsNone(instrument.active())
+        self.assertEqual(recorder.spans[instrument.TRACE]["calls"], 2)
+        self.assertEqual(recorder.counters, {"rays": 200, "hits": 50, "bytes_downloaded": 1024})
+
+        record = recorder.to_dict()
+        self.assertEqual(record["hit_rate"], 0.25)
+        self.assertGreater(record["rays_per_sec"], 0)
+
+    def test_nested_recorders(self):
+        outer = instrument.Recorder("group")
+        inner = instrument.Recorder("img")
+
+        with instrument.recording(outer):
+            instrument.count("triangles", 8)
+            with instrument.recording(inner):
+                instrument.count("rays", 4)
+            instrument.count("triangles", 8)
+
+        self.assertEqual(outer.counters, {"triangles": 16})
+        self.assertEqual(inner.counters, {"rays": 4})
+
+    def test_write_json_lines(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "metrics.jsonl")
+
+            for name in ("a", "b"):
+                recorder = instrument.Recorder(name)
+                recorder.set(resolution=[4, 3])
+                recorder.write(path)
+
+            with open(path) as f:
+                records = [json.loads(line) for line in f]
+
+        self.assertEqual([r["name"] for r in records], ["a", "b"])
+        self.assertEqual(records[0]["resolution"], [4, 3])
+
+    def test_profile_and_trace_memory(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            recorder = instrument.Recorder("img", profile={instrument.TRACE}, trace_memory={instrument.TRACE},
+                                           profile_dir=tmp)
+
+            with recorder.span(instrument.TRACE):
+                data = [bytes(1000) for _ in range(100)]
+
+            self.assertTrue(os.path.exists(os.path.join(tmp, "img-trace.prof")))
+            self.assertGreaterEqual(recorder.counters["trace_traced_peak_bytes"], 100 * 1000)
+            del data
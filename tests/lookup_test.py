@@ -0,0 +1,108 @@
+import os
+import tempfile
+import types
+import unittest
+
+import PIL.Image
+import numpy as np
+from scipy.spatial.transform import Rotation
+
+from depthmap.lookup import DepthMapLookup, map_depth, pose_path, write_pose
+from depthmap.rays import image_rays
+
+
+def flat_ground_depth(width, height, fov, altitude):
+    # Distance along every pixel's ray, as in depthmap.camera_rays, from a camera looking straight down
+    right, top = np.tan(np.radians(fov) / 2.0) * (1 - 1.0 / np.array([width, height]))
+    xx, yy = np.meshgrid(np.linspace(-right, right, width), np.linspace(top, -top, height))
+
+    return (altitude * np.sqrt(xx ** 2 + yy ** 2 + 1)).astype(np.float32), xx, yy
+
+
+class LookupTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.width, self.height, self.fov, self.altitude = 64, 48, (60.0, 50.0), 100.0
+        self.position = (-297000.0, 7007000.0, self.altitude)
+
+        self.depth, self.xx, self.yy = flat_ground_depth(self.width, self.height, self.fov, self.altitude)
+        # The sky, which the renderer leaves at 0
+        self.depth[0, 0] = 0
+
+        self.m_cam = types.SimpleNamespace(
+            resolution=[self.width, self.height], fov=np.array(self.fov), cam_pt=self.position,
+            image=types.SimpleNamespace(uri="IMG_0001.jpg", rs_matrix=lambda: np.eye(3)))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name):
+        path = os.path.join(self.tmp.name, name)
+        if name.endswith(".npy"):
+            np.save(path, self.depth)
+        else:
+            PIL.Image.fromarray(self.depth, mode="F").save(path, "TIFF")
+
+        write_pose(self.m_cam, path)
+        return path
+
+    def test_pixels_to_world(self):
+        lookup = DepthMapLookup.open(self.write("img.npy"))
+
+        rows, cols = np.mgrid[0:self.height, 0:self.width]
+        points = lookup.pixels_to_world(cols, rows).reshape([self.height, self.width, 3])
+
+        self.assertTrue(np.isnan(points[0, 0]).all())
+        np.testing.assert_allclose(points[..., 2].ravel()[1:], 0, atol=1e-3)
+        np.testing.assert_allclose(points[..., 0].ravel()[1:], (self.position[0] + self.altitude * self.xx).ravel()[1:])
+        np.testing.assert_allclose(points[..., 1].ravel()[1:], (self.position[1] + self.altitude * self.yy).ravel()[1:])
+
+    def test_uv(self):
+        lookup = DepthMapLookup.open(self.write("img.tiff"))
+        self.assertIsInstance(lookup.depth, np.memmap)
+
+        # The centre of the bottom right pixel, and a point outside of the image
+        u = np.array([1 - 1 / self.width, 1.5])
+        v = np.array([1 - 1 / self.height, 0])
+        points = lookup.uv_to_world(u, v)
+
+        expected = lookup.pixels_to_world([self.width - 1], [self.height - 1])
+        np.testing.assert_allclose(points[0], expected[0])
+        self.assertTrue(np.isnan(points[1]).all())
+
+    def test_wgs84(self):
+        lookup = DepthMapLookup.open(self.write("img.npy"))
+
+        lonlat = lookup.pixels_to_world([32], [24], srs="EPSG:4326")[0]
+        self.assertAlmostEqual(lonlat[0], -2.668, places=2)
+        self.assertAlmostEqual(lonlat[1], 53.13, places=1)
+        self.assertAlmostEqual(lonlat[2], 0, places=3)
+
+    def test_rotated_camera(self):
+        rotation = Rotation.from_euler("xz", [20, 35], degrees=True).as_matrix()
+        self.m_cam.image.rs_matrix = lambda: rotation
+        lookup = DepthMapLookup.open(self.write("img.npy"))
+
+        rays = lookup.pixels_to_rays([0, 10], [0, 5])
+        unrotated = DepthMapLookup(self.depth, dict(lookup.pose, rotation=np.eye(3).tolist()))
+        np.testing.assert_allclose(rays, unrotated.pixels_to_rays([0, 10], [0, 5]) @ rotation.T)
+
+    def test_distortion(self):
+        self.m_cam.distortion = (-0.2, 0.05, 0.001, -0.002, 0.0)
+        lookup = DepthMapLookup.open(self.write("img.npy"))
+
+        # The rays the depth map was rendered with
+        rows, cols = np.mgrid[0:self.height, 0:self.width]
+        np.testing.assert_allclose(lookup.pixels_to_rays(cols, rows),
+                                   image_rays(self.width, self.height, self.fov, distortion=self.m_cam.distortion),
+                                   atol=1e-6)
+
+    def test_map_depth(self):
+        path = self.write("img.tiff")
+        self.assertTrue(os.path.exists(pose_path(path)))
+        np.testing.assert_array_equal(map_depth(path), self.depth)
+
+    def test_shape_mismatch(self):
+        path = self.write("img.npy")
+        with self.assertRaises(ValueError):
+            DepthMapLookup(np.zeros((2, 2), dtype=np.float32), DepthMapLookup.open(path).pose)
@@ -0,0 +1,154 @@
+import unittest
+
+import numpy as np
+import trimesh
+
+import instrument
+from raytrace import backends
+from raytrace.heightfieldintersector import HeightfieldIntersector
+from raytrace.numpyintersector import RayMeshIntersector, _NumpyBVH
+from raytrace.scenecache import SceneRegistry
+from tests.helpers import brute_force_first, grid_mesh
+
+
+class NumpyIntersectorTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(7)
+
+        yy, xx = np.mgrid[0:30, 0:23]
+        heights = 10 * np.sin(xx / 5) + 8 * np.cos(yy / 4) + rng.normal(0, 1, xx.shape)
+        vertices, faces = grid_mesh(heights, (500000.0, 2.0, 0.0, 6000000.0, 0.0, -2.0))
+        self.mesh = trimesh.Trimesh(vertices=vertices, faces=faces, process=False)
+
+        n = 2000
+        self.origins = np.column_stack((rng.uniform(500000, 500044, n),
+                                        rng.uniform(5999942, 6000000, n),
+                                        rng.uniform(20, 60, n)))
+        directions = np.column_stack((rng.normal(0, 0.5, n),
+                                      rng.normal(0, 0.5, n),
+                                      rng.uniform(-1, 0.1, n)))
+        self.directions = directions / np.linalg.norm(directions, axis=1)[:, None]
+
+        self.intersector = RayMeshIntersector(self.mesh, registry=SceneRegistry())
+
+    def test_matches_brute_force(self):
+        expected_tri, expected_t = brute_force_first(self.origins, self.directions,
+                                                     self.mesh.vertices, self.mesh.faces)
+
+        locations, distances, index_ray, index_tri = self.intersector.intersects_location(
+            self.origins, self.directions, multiple_hits=False)
+
+        self.assertTrue((expected_tri >= 0).any())
+        self.assertTrue((expected_tri < 0).any())
+        np.testing.assert_array_equal(np.isinf(distances), np.isinf(expected_t))
+        np.testing.assert_allclose(distances[index_ray], expected_t[index_ray], rtol=1e-6)
+        np.testing.assert_allclose(locations,
+                                   self.origins[index_ray] + self.directions[index_ray] * distances[index_ray, None])
+
+        # Rays through a shared edge may report either triangle, at the same distance
+        first = self.intersector.intersects_first(self.origins, self.directions)
+        np.testing.assert_array_equal(first >= 0, expected_tri >= 0)
+        self.assertGreater((first == expected_tri).mean(), 0.99)
+        np.testing.assert_array_equal(self.intersector.intersects_any(self.origins, self.directions), first >= 0)
+
+    def test_first_location_aligned(self):
+        locations, distances, index_tri = self.intersector.intersects_first_location(self.origins, self.directions)
+        compact, _, index_ray, _ = self.intersector.intersects_location(self.origins, self.directions,
+                                                                        multiple_hits=False)
+
+        self.assertEqual(distances.dtype, np.float32)
+        np.testing.assert_array_equal(index_tri, self.intersector.intersects_first(self.origins, self.directions))
+        np.testing.assert_array_equal(np.nonzero(index_tri >= 0)[0], index_ray)
+        np.testing.assert_array_equal(np.isinf(distances), index_tri < 0)
+        self.assertTrue(np.isnan(locations[index_tri < 0]).all())
+        np.testing.assert_allclose(locations[index_ray], compact, atol=1e-3)
+
+    def test_multiple_hits(self):
+        index_tri, index_ray, distances = self.intersector.intersects_id(
+            self.origins, self.directions, multiple_hits=True, max_hits=3)
+
+        first = self.intersector.intersects_first(self.origins, self.directions)
+        counts = np.bincount(index_ray, minlength=len(self.origins))
+
+        np.testing.assert_array_equal(counts > 0, first >= 0)
+        self.assertLessEqual(counts.max(), 3)
+
+        # Hits come back nearest first along every ray
+        same_ray = index_ray[1:] == index_ray[:-1]
+        self.assertTrue((np.diff(distances)[same_ray] >= 0).all())
+
+    def test_threads_match_serial(self):
+        serial = self.intersector.intersects_first(self.origins, self.directions)
+
+        threaded = RayMeshIntersector(self.mesh, registry=SceneRegistry(), workers=4)
+        origins = np.tile(self.origins, (3, 1))
+        directions = np.tile(self.directions, (3, 1))
+
+        np.testing.assert_array_equal(threaded.intersects_first(origins, directions), np.tile(serial, 3))
+
+    def test_tree_bounds_children(self):
+        bvh = _NumpyBVH(self.mesh.vertices, self.mesh.faces)
+        self.assertEqual(len(bvh.node_lower), 2 * bvh.leaf_count - 1)
+
+        # Every internal node's box contains both of its children's
+        for k in range(bvh.leaf_count - 1):
+            for child in (2 * k + 1, 2 * k + 2):
+                if np.isnan(bvh.node_lower[child]).any():
+                    continue
+                self.assertTrue((bvh.node_lower[k] <= bvh.node_lower[child]).all())
+                self.assertTrue((bvh.node_upper[k] >= bvh.node_upper[child]).all())
+
+        self.assertEqual(sorted(bvh.tri_index[bvh.tri_index >= 0]), list(range(len(self.mesh.faces))))
+
+    def test_single_triangle(self):
+        mesh = trimesh.Trimesh(vertices=[[0, 0, 0], [1, 0, 0], [0, 1, 0]], faces=[[0, 1, 2]], process=False)
+        intersector = RayMeshIntersector(mesh, registry=SceneRegistry())
+
+        first = intersector.intersects_first([[0.2, 0.2, 1], [2, 2, 1]], [[0, 0, -1], [0, 0, -1]])
+        np.testing.assert_array_equal(first, [0, -1])
+
+    def test_edge_hits(self):
+        # Vertical rays straight down every vertex, edge and cell diagonal of the grid
+        xx, yy = np.meshgrid(np.arange(500000.0, 500044.0, 1.0), np.arange(6000000.0, 5999942.0, -1.0))
+        origins = np.column_stack((xx.ravel(), yy.ravel(), np.full(xx.size, 100.0)))
+        directions = np.tile([0.0, 0.0, -1.0], (len(origins), 1))
+
+        self.assertTrue(self.intersector.intersects_any(origins, directions).all())
+
+        # The same tolerance as the heightfield backend, through raytrace.triangles
+        heights = self.mesh.vertices[:, 2].reshape([30, 23])
+        heightfield = HeightfieldIntersector(heights, (500000.0, 2.0, 0.0, 6000000.0, 0.0, -2.0))
+        np.testing.assert_allclose(self.intersector.intersects_first_location(origins, directions)[1],
+                                   heightfield.intersects_first_location(origins, directions)[1], rtol=1e-6)
+
+    def test_build_scene(self):
+        group, image = instrument.Recorder("group"), instrument.Recorder("image")
+
+        with instrument.recording(group):
+            self.intersector.build_scene()
+        with instrument.recording(image):
+            self.intersector.intersects_first(self.origins, self.directions)
+
+        # The BVH is built up front, and only once
+        self.assertEqual(group.spans[instrument.BVH_BUILD]["calls"], 1)
+        self.assertNotIn(instrument.BVH_BUILD, image.spans)
+        self.assertIn(self.intersector.scene_key, self.intersector._registry)
+
+
+class BackendsTest(unittest.TestCase):
+    def test_numpy_always_available(self):
+        self.assertIn("numpy", backends.available_backends())
+        self.assertIs(backends.get_backend("numpy"), RayMeshIntersector)
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            backends.get_backend("nope")
+
+    def test_missing_backend(self):
+        backends.register_backend("missing", "raytrace.does_not_exist", priority=1000)
+        try:
+            self.assertNotIn("missing", backends.available_backends())
+            with self.assertRaises(ImportError):
+                backends.get_backend("missing")
+        finally:
+            del backends._backends["missing"]
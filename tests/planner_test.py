@@ -0,0 +1,69 @@
+import unittest
+
+import numpy as np
+
+from depthmap.planner import hilbert_index, image_footprint, plan_clusters
+from tests.helpers import survey_image
+
+
+class PlannerTest(unittest.TestCase):
+    def test_hilbert_index(self):
+        y, x = np.mgrid[0:16, 0:16]
+        d = hilbert_index(x.ravel(), y.ravel(), order=4)
+
+        # Every cell is visited once, and each step moves to a neighbouring cell
+        self.assertEqual(sorted(d), list(range(256)))
+        path = np.empty((256, 2), dtype=np.int64)
+        path[d] = np.column_stack((x.ravel(), y.ravel()))
+        self.assertTrue((np.abs(np.diff(path, axis=0)).sum(axis=1) == 1).all())
+
+    def test_footprint(self):
+        coords = (-297000.0, 7007000.0)
+        footprint = image_footprint(survey_image(*coords), coords, radius=2000)
+
+        # Inside the square generate_bbox would give, and containing the camera
+        self.assertTrue(coords[0] - 2000 <= footprint[0] <= coords[0] <= footprint[2] <= coords[0] + 2000)
+        self.assertTrue(coords[1] - 2000 <= footprint[1] <= coords[1] <= footprint[3] <= coords[1] + 2000)
+
+    def test_dense_survey(self):
+        # A 10 x 10 grid of cameras 100 m apart share the terrain of one or two tiles, not 100
+        rng = np.random.default_rng(0)
+        coords = [(x * 100.0, y * 100.0) for y in range(10) for x in range(10)]
+        footprints = [image_footprint(survey_image(*c, yaw=rng.uniform(0, 360)), c, radius=500) for c in coords]
+
+        clusters = plan_clusters(footprints, cluster_size=3000)
+
+        self.assertLessEqual(len(clusters), 4)
+        self.assertEqual(sorted(i for c in clusters for i in c.images), list(range(100)))
+        for cluster in clusters:
+            for i in cluster.images:
+                f = footprints[i]
+                b = cluster.bbox
+                self.assertTrue(b[0] <= f[0] and b[1] <= f[1] and f[2] <= b[2] and f[3] <= b[3])
+
+            # Consecutive images look at nearby terrain, compared to a random order
+            if len(cluster.images) > 2:
+                centres = np.array([(np.add(footprints[i][:2], footprints[i][2:])) / 2 for i in cluster.images])
+                planned = np.linalg.norm(np.diff(centres, axis=0), axis=1).mean()
+                shuffled = np.linalg.norm(np.diff(rng.permutation(centres), axis=0), axis=1).mean()
+                self.assertLess(planned, 0.75 * shuffled)
+
+    def test_cluster_order(self):
+        # One image in each of a row of tiles, in shuffled order
+        footprints = [(x * 1000.0, 0, x * 1000.0 + 10, 10) for x in [3, 0, 2, 1]]
+        clusters = plan_clusters(footprints, cluster_size=1000)
+
+        self.assertEqual([c.images for c in clusters], [[1], [3], [2], [0]])
+        self.assertEqual(plan_clusters([]), [])
+
+    def test_capture_order(self):
+        # A flight line that doubles back inside one tile
+        xs = [100.0, 300.0, 500.0, 700.0, 600.0, 400.0, 200.0]
+        footprints = [(x, y, x + 10, y + 10) for x, y in zip(xs, [100.0] * 4 + [600.0] * 3)]
+
+        swept, = plan_clusters(footprints, cluster_size=1000)
+        self.assertNotEqual(swept.images, list(range(len(xs))))
+
+        captured, = plan_clusters(footprints, cluster_size=1000, capture_order=True)
+        self.assertEqual(captured.images, list(range(len(xs))))
+        self.assertEqual(captured.bbox, swept.bbox)
@@ -0,0 +1,73 @@
+import unittest
+
+import numpy as np
+import trimesh
+
+import instrument
+from benchmarks.synthetic import synthetic_mesh
+from depthmap.depthmap import render_depthmap
+from depthmap.progressive import render_progressive
+from raytrace.numpyintersector import RayMeshIntersector
+from tests.helpers import grid_mesh, oblique_camera
+
+
+class ProgressiveTest(unittest.TestCase):
+    def render(self, m_cam, intersector, **kwargs):
+        recorder = instrument.Recorder()
+        with instrument.recording(recorder):
+            depth, locs = render_progressive(m_cam, intersector, **kwargs)
+
+        return depth, locs, recorder.counters
+
+    def test_sloping_plane(self):
+        # An inclined plane is smooth everywhere, so only the first grid and the blocks at the horizon are traced
+        yy, xx = np.mgrid[0:100, 0:100].astype(np.float64)
+        vertices, faces = grid_mesh(0.3 * xx + 0.1 * yy, (0, 1, 0, 0, 0, 1))
+        intersector = RayMeshIntersector(trimesh.Trimesh(vertices=vertices, faces=faces, process=False))
+
+        m_cam = oblique_camera((50, 5, 60), yaw=0, tilt=30, resolution=(129, 97))
+        expected, _ = render_depthmap(m_cam, intersector)
+        depth, locs, counters = self.render(m_cam, intersector, block=16)
+
+        np.testing.assert_array_equal(depth, expected)
+        self.assertEqual(len(locs), (depth > 0).sum())
+        self.assertLess(counters["rays"], 0.2 * depth.size)
+
+    def test_rolling_terrain(self):
+        intersector = RayMeshIntersector(synthetic_mesh(150))
+        m_cam = oblique_camera((75, 20, 40), yaw=10, resolution=(160, 120))
+
+        expected, _ = render_depthmap(m_cam, intersector)
+        depth, _, counters = self.render(m_cam, intersector)
+
+        # Silhouettes and misses are traced at full rate, the interpolated hillsides are close
+        np.testing.assert_array_equal(depth == 0, expected == 0)
+        self.assertTrue((np.abs(depth - expected) <= 1 + 0.02 * expected).all())
+        self.assertLess(np.abs(depth - expected).mean(), 0.1)
+        self.assertLess(counters["rays"], depth.size)
+        self.assertEqual(counters["rays"] + counters["interpolated_pixels"], depth.size)
+
+    def test_preview(self):
+        intersector = RayMeshIntersector(synthetic_mesh(150))
+        m_cam = oblique_camera((75, 20, 40), yaw=10, resolution=(160, 120))
+
+        depth, locs, counters = self.render(m_cam, intersector, block=8, preview=True)
+
+        self.assertEqual(counters["rays"], 21 * 16)
+        self.assertEqual(depth.shape, (120, 160))
+        self.assertEqual(len(locs), (depth > 0).sum())
+
+    def test_small_images(self):
+        intersector = RayMeshIntersector(synthetic_mesh(150))
+
+        for resolution in [(1, 1), (1, 7), (9, 1), (5, 3)]:
+            m_cam = oblique_camera((75, 20, 40), yaw=10, resolution=resolution)
+            expected, _ = render_depthmap(m_cam, intersector)
+            depth, _, counters = self.render(m_cam, intersector, block=4)
+
+            self.assertEqual(depth.shape, expected.shape)
+            self.assertLessEqual(np.abs(depth - expected).max(), 1)
+
+    def test_block_size(self):
+        with self.assertRaises(ValueError):
+            render_progressive(oblique_camera((0, 0, 10), yaw=0), None, block=12)
@@ -0,0 +1,90 @@
+import types
+import unittest
+
+import numpy as np
+
+from depthmap.depthmap import camera_rays
+from depthmap.rays import RayBundleCache, image_rays, ray_bundle
+from dtm.distortion import distort
+
+
+def camera(width, height, fov, distortion=None):
+    return types.SimpleNamespace(resolution=[width, height], fov=np.array([fov, fov]), distortion=distortion)
+
+
+class RayBundleTest(unittest.TestCase):
+    def test_rays(self):
+        bundle = RayBundleCache().get(camera(5, 3, 90.0))
+
+        self.assertEqual(bundle.directions.dtype, np.float32)
+        np.testing.assert_allclose(np.linalg.norm(bundle.directions, axis=1), 1, rtol=1e-6)
+
+        # Row major with the top row first, the middle pixel looks straight down the camera's -z
+        np.testing.assert_allclose(bundle.directions[7], [0, 0, -1])
+        self.assertTrue((bundle.directions[:5, 1] > 0).all())
+        self.assertTrue((np.diff(bundle.directions[:5, 0]) > 0).all())
+        np.testing.assert_array_equal(bundle.pixels[7], [2, 1])
+
+        # Windows are the same rays
+        np.testing.assert_array_equal(image_rays(5, 3, (90.0, 90.0), (1, 1, 3, 2)),
+                                      bundle.directions.reshape([3, 5, 3])[1:3, 1:4].reshape([-1, 3]))
+
+    def test_shared_and_read_only(self):
+        cache = RayBundleCache()
+        bundle = cache.get(camera(64, 48, 60.0))
+
+        self.assertIs(cache.get(camera(64, 48, 60.0)), bundle)
+        self.assertIsNot(cache.get(camera(64, 48, 50.0)), bundle)
+        self.assertEqual(len(cache), 2)
+
+        with self.assertRaises(ValueError):
+            bundle.directions[0] = 0
+
+    def test_distortion(self):
+        cache = RayBundleCache()
+        coefficients = (-0.2, 0.05, 0.001, -0.002, 0.0)
+
+        pinhole = cache.get(camera(40, 30, 70.0))
+        bundle = cache.get(camera(40, 30, 70.0, coefficients))
+        self.assertIsNot(bundle, pinhole)
+        self.assertIs(cache.get(camera(40, 30, 70.0, list(coefficients))), bundle)
+
+        # Distorting every ray lands it back on its pixel centre
+        x, y = distort(bundle.directions[:, 0] / -bundle.directions[:, 2],
+                       bundle.directions[:, 1] / bundle.directions[:, 2], coefficients)
+        np.testing.assert_allclose(x, pinhole.directions[:, 0] / -pinhole.directions[:, 2], atol=1e-6)
+        np.testing.assert_allclose(-y, pinhole.directions[:, 1] / -pinhole.directions[:, 2], atol=1e-6)
+
+        # Barrel distortion widens the view
+        self.assertLess(bundle.directions[0, 0], pinhole.directions[0, 0])
+
+        np.testing.assert_array_equal(image_rays(40, 30, (70.0, 70.0), (5, 7, 10, 4), coefficients),
+                                      bundle.directions.reshape([30, 40, 3])[7:11, 5:15].reshape([-1, 3]))
+
+    def test_camera_windows(self):
+        for distortion in [None, (-0.2, 0.05, 0.001, -0.002, 0.0)]:
+            m_cam = camera(40, 30, 70.0, distortion)
+            whole = camera_rays(m_cam)
+            self.assertIs(whole, ray_bundle(m_cam).directions)
+
+            # Tiles are the same rays
+            window = camera_rays(m_cam, (5, 7, 10, 4))
+            np.testing.assert_array_equal(window, whole.reshape([30, 40, 3])[7:11, 5:15].reshape([-1, 3]))
+
+    def test_eviction(self):
+        one = RayBundleCache().get(camera(100, 100, 60.0)).nbytes
+        cache = RayBundleCache(max_bytes=2 * one)
+
+        first = cache.get(camera(100, 100, 60.0))
+        cache.get(camera(100, 100, 61.0))
+        # Using the first bundle again makes the second one the least recently used
+        cache.get(camera(100, 100, 60.0))
+        cache.get(camera(100, 100, 62.0))
+
+        self.assertEqual(len(cache), 2)
+        self.assertIs(cache.get(camera(100, 100, 60.0)), first)
+        self.assertLessEqual(cache.nbytes, 2 * one)
+
+        # A bundle bigger than the limit is still kept on its own
+        cache.get(camera(300, 300, 60.0))
+        self.assertEqual(len(cache), 1)
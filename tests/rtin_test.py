@@ -0,0 +1,115 @@
+import unittest
+from collections import Counter
+
+import numpy as np
+
+from dtm.rtin import compute_errors, triangulate
+
+
+def martini_errors(heights):
+    # Direct port of the error pass of the Martini library, one triangle at a time
+    size = heights.shape[0]
+    tile = size - 1
+    num_triangles = tile * tile * 2 - 2
+    num_parents = num_triangles - tile * tile
+
+    terrain = heights.ravel()
+    errors = np.zeros(size * size)
+
+    for i in range(num_triangles - 1, -1, -1):
+        tid = i + 2
+        ax = ay = bx = by = cx = cy = 0
+        if tid & 1:
+            bx = by = cx = tile
+        else:
+            ax = ay = cy = tile
+
+        tid >>= 1
+        while tid > 1:
+            mx, my = (ax + bx) >> 1, (ay + by) >> 1
+            if tid & 1:
+                bx, by, ax, ay = ax, ay, cx, cy
+            else:
+                ax, ay, bx, by = bx, by, cx, cy
+            cx, cy = mx, my
+            tid >>= 1
+
+        mx, my = (ax + bx) >> 1, (ay + by) >> 1
+        middle = my * size + mx
+        interpolated = (terrain[ay * size + ax] + terrain[by * size + bx]) / 2
+        errors[middle] = max(errors[middle], abs(interpolated - terrain[middle]))
+
+        if i < num_parents:
+            left = ((ay + cy) >> 1) * size + ((ax + cx) >> 1)
+            right = ((by + cy) >> 1) * size + ((bx + cx) >> 1)
+            errors[middle] = max(errors[middle], errors[left], errors[right])
+
+    return errors.reshape([size, size])
+
+
+def martini_mesh(errors, max_error):
+    tile = errors.shape[0] - 1
+    triangles = []
+
+    def process(ax, ay, bx, by, cx, cy):
+        mx, my = (ax + bx) >> 1, (ay + by) >> 1
+        if abs(ax - cx) + abs(ay - cy) > 1 and errors[my, mx] > max_error:
+            process(cx, cy, ax, ay, mx, my)
+            process(bx, by, cx, cy, mx, my)
+        else:
+            triangles.append(frozenset([(ax, ay), (bx, by), (cx, cy)]))
+
+    process(0, 0, tile, tile, tile, 0)
+    process(tile, tile, 0, 0, 0, tile)
+    return set(triangles)
+
+
+def terrain(width, height, seed=0):
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:height, 0:width]
+    heights = 5 * np.sin(xx / 7) + 3 * np.cos(yy / 9) + rng.normal(0, 0.05, xx.shape)
+    # A flat field
+    heights[:height // 3, :width // 3] = 1
+    return heights
+
+
+class RtinTest(unittest.TestCase):
+    def test_matches_martini(self):
+        for size in (3, 9, 33):
+            heights = terrain(size, size)
+            errors = compute_errors(heights)
+            np.testing.assert_allclose(errors, martini_errors(heights))
+
+            for max_error in (0.1, 1, 3):
+                pixels, faces = triangulate(heights, max_error)
+                triangles = set(frozenset(tuple(p) for p in pixels[f]) for f in faces)
+                self.assertEqual(triangles, martini_mesh(errors, max_error))
+
+    def test_crack_free(self):
+        for width, height in ((50, 37), (64, 100), (7, 3), (2, 2)):
+            heights = terrain(width, height)
+
+            for max_error in (0, 0.2, 1):
+                pixels, faces = triangulate(heights, max_error)
+                p = pixels[faces].astype(np.float64)
+
+                # Same winding as DtmType.get_indices, and the mesh covers the raster exactly
+                cross = ((p[:, 1, 0] - p[:, 0, 0]) * (p[:, 2, 1] - p[:, 0, 1]) -
+                         (p[:, 1, 1] - p[:, 0, 1]) * (p[:, 2, 0] - p[:, 0, 0]))
+                self.assertTrue((cross < 0).all())
+                self.assertAlmostEqual(np.abs(cross).sum() / 2, (width - 1) * (height - 1))
+
+                # Every edge is shared by two triangles, unless it is on the raster edge
+                edges = Counter(tuple(sorted((f[a], f[b]))) for f in faces for a, b in ((0, 1), (1, 2), (2, 0)))
+                for (a, b), count in edges.items():
+                    (xa, ya), (xb, yb) = pixels[a], pixels[b]
+                    border = (xa == xb and xa in (0, width - 1)) or (ya == yb and ya in (0, height - 1))
+                    self.assertTrue(count == 2 or (count == 1 and border))
+
+    def test_reduces_flat_terrain(self):
+        pixels, faces = triangulate(np.zeros((65, 80)), 0.5)
+        self.assertLess(len(faces), 2 * 64 * 79 / 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+import threading
+import unittest
+
+from raytrace.scenecache import SceneRegistry
+
+
+class FakeScene:
+    def __init__(self, nbytes=0):
+        self.nbytes = nbytes
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class SceneRegistryTest(unittest.TestCase):
+    def test_reuse(self):
+        registry = SceneRegistry(max_scenes=2)
+        built = []
+
+        def factory():
+            built.append(FakeScene())
+            return built[-1]
+
+        with registry.scene("a", factory) as first:
+            pass
+        with registry.scene("a", factory) as second:
+            pass
+
+        self.assertIs(first, second)
+        self.assertEqual(len(built), 1)
+        self.assertFalse(first.closed)
+
+    def test_lru_eviction(self):
+        registry = SceneRegistry(max_scenes=2)
+        scenes = {k: FakeScene() for k in "abc"}
+
+        for k in "abac":
+            with registry.scene(k, lambda: scenes[k]):
+                pass
+
+        # b was least recently used
+        self.assertTrue(scenes["b"].closed)
+        self.assertFalse(scenes["a"].closed)
+        self.assertFalse(scenes["c"].closed)
+        self.assertNotIn("b", registry)
+
+    def test_memory_eviction(self):
+        registry = SceneRegistry(max_scenes=10, max_bytes=100)
+        scenes = {k: FakeScene(60) for k in "ab"}
+
+        for k in "ab":
+            with registry.scene(k, lambda: scenes[k]):
+                pass
+
+        self.assertTrue(scenes["a"].closed)
+        self.assertEqual(registry.nbytes, 60)
+
+    def test_pinned_scenes_are_kept(self):
+        registry = SceneRegistry(max_scenes=1)
+        a, b = FakeScene(), FakeScene()
+
+        with registry.scene("a", lambda: a):
+            with registry.scene("b", lambda: b):
+                self.assertFalse(a.closed)
+            self.assertFalse(a.closed)
+
+        self.assertTrue(a.closed or b.closed)
+        self.assertEqual(len(registry), 1)
+
+        registry.clear()
+        self.assertTrue(a.closed and b.closed)
+
+    def test_build_outside_lock(self):
+        registry = SceneRegistry(max_scenes=4)
+        with registry.scene("a", FakeScene):
+            pass
+
+        started, release = threading.Event(), threading.Event()
+        built = []
+
+        def slow_factory():
+            started.set()
+            release.wait(5)
+            built.append(FakeScene())
+            return built[-1]
+
+        def borrow(out):
+            with registry.scene("b", slow_factory) as scene:
+                out.append(scene)
+
+        first, second = [], []
+        threads = [threading.Thread(target=borrow, args=(first,))]
+        threads[0].start()
+        self.assertTrue(started.wait(5))
+        threads.append(threading.Thread(target=borrow, args=(second,)))
+        threads[1].start()
+
+        # A built scene is lent out while another one is being built
+        done = threading.Event()
+
+        def lookup():
+            with registry.scene("a", FakeScene):
+                done.set()
+
+        threading.Thread(target=lookup).start()
+        self.assertTrue(done.wait(5))
+
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        # The second borrower waited for the first build rather than building again
+        self.assertEqual(len(built), 1)
+        self.assertIs(first[0], second[0])
+
+    def test_failed_build(self):
+        registry = SceneRegistry()
+
+        def broken():
+            raise RuntimeError("no scene")
+
+        with self.assertRaises(RuntimeError):
+            with registry.scene("a", broken):
+                pass
+
+        with registry.scene("a", FakeScene) as scene:
+            self.assertIsInstance(scene, FakeScene)
+
+
+if __name__ == '__main__':
+    unittest.main()
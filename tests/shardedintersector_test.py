@@ -0,0 +1,149 @@
+import unittest
+
+import numpy as np
+import trimesh
+
+from raytrace.numpyintersector import RayMeshIntersector
+from raytrace.scenecache import SceneRegistry
+from raytrace.shardedintersector import ShardedIntersector
+from tests.helpers import grid_mesh
+
+
+class ShardedIntersectorTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(3)
+
+        yy, xx = np.mgrid[0:70, 0:90]
+        self.heights = 10 * np.sin(xx / 5) + 8 * np.cos(yy / 4) + rng.normal(0, 1, xx.shape)
+        self.transform = (500000.0, 2.0, 0.0, 6000000.0, 0.0, -2.0)
+
+        vertices, faces = grid_mesh(self.heights, self.transform)
+        mesh = trimesh.Trimesh(vertices=vertices.astype(np.float32), faces=faces, process=False)
+        self.monolithic = RayMeshIntersector(mesh, registry=SceneRegistry())
+
+        n = 3000
+        self.origins = np.column_stack((rng.uniform(500000, 500178, n),
+                                        rng.uniform(5999862, 6000000, n),
+                                        rng.uniform(20, 60, n)))
+        directions = np.column_stack((rng.normal(0, 0.5, n),
+                                      rng.normal(0, 0.5, n),
+                                      rng.uniform(-1, 0.2, n)))
+        self.directions = directions / np.linalg.norm(directions, axis=1)[:, None]
+
+    def sharded(self, **kwargs):
+        return ShardedIntersector.from_heights(self.heights, self.transform, tile_size=16, backend="numpy", **kwargs)
+
+    def test_matches_monolithic(self):
+        intersector = self.sharded()
+        self.assertEqual(intersector.tile_shape, (5, 6))
+        self.assertEqual(intersector.face_count, len(self.monolithic.mesh.faces))
+        self.assertEqual(intersector.attached, [])
+
+        locations, distances, triangles = intersector.intersects_first_location(self.origins, self.directions)
+        expected_locations, expected_distances, expected_triangles = self.monolithic.intersects_first_location(
+            self.origins, self.directions)
+
+        hit = np.isfinite(expected_distances)
+        self.assertTrue(hit.any() and not hit.all())
+        self.assertEqual(distances.dtype, np.float32)
+        np.testing.assert_array_equal(np.isfinite(distances), hit)
+        np.testing.assert_allclose(distances[hit], expected_distances[hit], rtol=1e-5)
+        np.testing.assert_allclose(locations[hit], expected_locations[hit], atol=1e-3)
+        self.assertGreater((triangles == expected_triangles).mean(), 0.99)
+
+        # Every hit along the rays, across tiles
+        _, _, index_ray, index_tri = intersector.intersects_location(self.origins, self.directions)
+        _, _, expected_ray, _ = self.monolithic.intersects_location(self.origins, self.directions)
+        np.testing.assert_array_equal(np.bincount(index_ray, minlength=len(self.origins)),
+                                      np.bincount(expected_ray, minlength=len(self.origins)))
+        self.assertTrue((index_tri < intersector.face_count).all())
+
+    def test_lazy_tiles(self):
+        intersector = self.sharded()
+
+        # Looking straight down at the top left corner only touches its tile
+        origins = np.column_stack((np.linspace(500002.3, 500019.7, 10), np.linspace(5999998.3, 5999980.1, 10),
+                                   np.full(10, 100.0)))
+        directions = np.tile([0.0, 0.0, -1.0], (10, 1))
+        self.assertEqual(intersector.touched_tiles(origins, directions), [(0, 0)])
+
+        self.assertTrue(intersector.intersects_any(origins, directions).all())
+        self.assertEqual(intersector.attached, [(0, 0)])
+
+        # Rays into the sky touch nothing
+        self.assertEqual(intersector.touched_tiles(origins, -directions), [])
+
+    def test_lazy_reads(self):
+        reads = []
+
+        def read_heights(col, row, w, h):
+            reads.append((col, row))
+            return self.heights[row:row + h, col:col + w]
+
+        intersector = ShardedIntersector(read_heights, self.heights.shape, self.transform, tile_size=16,
+                                         backend="numpy")
+        self.assertEqual(reads, [])
+
+        # Oblique rays from above the top left tile, pointing across the raster, land in it and read no other tile
+        origins = np.tile([500010.0, 5999990.0, 40.0], (20, 1))
+        directions = np.column_stack((np.linspace(0.2, 1, 20), np.linspace(-1, -0.2, 20), np.full(20, -2.0)))
+        directions /= np.linalg.norm(directions, axis=1)[:, None]
+
+        _, distances, _ = intersector.intersects_first_location(origins, directions)
+        _, expected, _ = self.monolithic.intersects_first_location(origins, directions)
+        np.testing.assert_allclose(distances, expected, rtol=1e-5)
+        self.assertEqual(set(reads), {(0, 0)})
+
+    def test_detach(self):
+        intersector = self.sharded()
+        intersector.intersects_first(self.origins, self.directions)
+        one = intersector._registry.nbytes / len(intersector.attached)
+
+        limited = self.sharded(max_bytes=int(4 * one))
+        np.testing.assert_array_equal(limited.intersects_first(self.origins, self.directions),
+                                      intersector.intersects_first(self.origins, self.directions))
+        self.assertLess(len(limited.attached), len(intersector.attached))
+
+    def test_simplified_skirts(self):
+        intersector = self.sharded(max_error=0.5)
+        self.assertEqual(intersector.skirt, 1.0)
+
+        # Vertical rays over the whole raster, crossing every tile seam, all land
+        xx, yy = np.meshgrid(np.arange(500000.013, 500178, 0.61), np.arange(5999999.98, 5999862, -0.61))
+        origins = np.column_stack((xx.ravel(), yy.ravel(), np.full(xx.size, 100.0)))
+        directions = np.tile([0.0, 0.0, -1.0], (len(origins), 1))
+
+        _, distances, triangles = intersector.intersects_first_location(origins, directions)
+        self.assertTrue(np.isfinite(distances).all())
+
+        # Heights are within about the error of the full mesh
+        _, expected, _ = self.monolithic.intersects_first_location(origins, directions)
+        self.assertLess(np.median(np.abs(distances - expected)), 0.5)
+        self.assertTrue(((triangles >= 0) & (triangles < intersector.face_count)).all())
+
+    def test_keeps_precision(self):
+        # A slope up the rows at Web Mercator northings, ~7e6, where float32 steps by 0.5 m
+        yy, xx = np.mgrid[0:40, 0:50]
+        heights = 100.0 + 0.5 * yy
+        transform = (-296820.3, 0.7, 0.0, 7007582.9, 0.0, -0.7)
+        intersector = ShardedIntersector.from_heights(heights, transform, tile_size=16, backend="numpy")
+
+        rng = np.random.default_rng(5)
+        x = rng.uniform(-296819.0, -296787.0, 200)
+        y = rng.uniform(7007556.0, 7007581.0, 200)
+        origins = np.column_stack((x, y, np.full(len(x), 200.0)))
+        directions = np.tile([0.0, 0.0, -1.0], (len(origins), 1))
+
+        locations, distances, _ = intersector.intersects_first_location(origins, directions)
+        expected = 100.0 + 0.5 * (transform[3] - y) / 0.7
+        np.testing.assert_allclose(locations[:, 2], expected, rtol=0, atol=1e-3)
+        np.testing.assert_allclose(distances, 200.0 - expected, rtol=0, atol=1e-3)
+
+        # Every hit along the rays too
+        _, all_distances, index_ray, _ = intersector.intersects_location(origins, directions)
+        first = np.searchsorted(index_ray, np.arange(len(origins)))
+        np.testing.assert_allclose(all_distances[first], 200.0 - expected, rtol=0, atol=1e-3)
+
+
+if __name__ == '__main__':
+    unittest.main()